@@ -0,0 +1,149 @@
+"""
+Контроль нагрузки: глобальный лимит одновременно обрабатываемых апдейтов,
+ограниченная очередь ожидания с приоритетами и сброс лишнего с коротким ответом «заняты».
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты: меньше — важнее
+HIGH = 0
+NORMAL = 1
+DEFERRED = 2
+
+BUSY_TEXT = "⏳ Бот сейчас перегружен, попробуйте через минуту."
+
+
+class _Waiter:
+    __slots__ = ("priority", "future", "done")
+
+    def __init__(self, priority: int, future: asyncio.Future):
+        self.priority = priority
+        self.future = future
+        self.done = False
+
+
+class AdmissionController(BaseMiddleware):
+    """
+    Outer-middleware на апдейты. classify(update) возвращает приоритет:
+    HIGH обслуживается первым и может вытеснить из очереди NORMAL,
+    DEFERRED (админские команды) ждёт без таймаута и никогда не сбрасывается.
+    """
+
+    def __init__(self, classify: Callable[[Update], int], max_concurrency: int = 100,
+                 max_pending: int = 1000, max_wait: float = 10.0):
+        self.classify = classify
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self._active = 0
+        self._pending = 0
+        self._heap = []
+        self._seq = itertools.count()
+        self.stats = {"admitted": 0, "queued": 0, "shed_full": 0, "shed_timeout": 0, "shed_evicted": 0}
+
+    @property
+    def queue_depth(self) -> int:
+        return self._pending
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def _evict_lowest(self, priority: int) -> bool:
+        """Вытеснить из очереди самый неважный сбрасываемый апдейт, если он хуже priority"""
+        victim = None
+        for _, _, waiter in self._heap:
+            if waiter.done or waiter.priority == DEFERRED or waiter.priority <= priority:
+                continue
+            if victim is None or waiter.priority > victim.priority:
+                victim = waiter
+        if victim is None:
+            return False
+        victim.done = True
+        self._pending -= 1
+        victim.future.set_result("shed_evicted")
+        return True
+
+    async def _acquire(self, priority: int) -> str:
+        """Занять слот. Возвращает "ok" или причину сброса."""
+        if self._active < self.max_concurrency and not self._pending:
+            self._active += 1
+            return "ok"
+
+        if self._pending >= self.max_pending and not self._evict_lowest(priority):
+            if priority != DEFERRED:
+                return "shed_full"
+
+        waiter = _Waiter(priority, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._heap, (priority, next(self._seq), waiter))
+        self._pending += 1
+        self.stats["queued"] += 1
+        timeout = None if priority == DEFERRED else self.max_wait
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except asyncio.TimeoutError:
+            if waiter.future.done():
+                return waiter.future.result()
+            waiter.done = True
+            self._pending -= 1
+            return "shed_timeout"
+        except asyncio.CancelledError:
+            if waiter.future.done() and waiter.future.result() == "ok":
+                self._release()
+            elif not waiter.done:
+                waiter.done = True
+                self._pending -= 1
+            raise
+
+    def _release(self):
+        self._active -= 1
+        while self._heap and self._active < self.max_concurrency:
+            _, _, waiter = heapq.heappop(self._heap)
+            if waiter.done:
+                continue
+            waiter.done = True
+            self._pending -= 1
+            self._active += 1
+            waiter.future.set_result("ok")
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        priority = self.classify(event)
+        result = await self._acquire(priority)
+        if result != "ok":
+            self.stats[result] += 1
+            await self._reply_busy(event)
+            return None
+
+        self.stats["admitted"] += 1
+        try:
+            return await handler(event, data)
+        finally:
+            self._release()
+
+    async def _reply_busy(self, update: Update):
+        """Короткий ответ вместо бесконечного ожидания в очереди"""
+        try:
+            if update.callback_query:
+                await update.callback_query.answer(BUSY_TEXT)
+            elif update.message and update.message.text:
+                await update.message.answer(BUSY_TEXT)
+        except Exception as e:
+            logger.debug(f"Не удалось отправить ответ о перегрузке: {e}")
+
+    def snapshot(self) -> dict:
+        """Состояние очереди и счётчики сброса"""
+        return {**self.stats, "active": self._active, "pending": self._pending,
+                "limit": self.max_concurrency}
@@ -0,0 +1,160 @@
+"""
+Клиент Telegram Bot API на stdlib с keep-alive соединениями.
+Соединения живут в модуле и переиспользуются между вызовами «тёплой» функции Vercel.
+"""
+import bisect
+import http.client
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+API_URL = "https://api.telegram.org"
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+# Ошибки, после которых соединение считается мёртвым и запрос повторяется на новом
+_RECONNECT_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.CannotSendRequest,
+    http.client.ResponseNotReady,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    BrokenPipeError,
+)
+
+
+class TelegramClient:
+    """Пул HTTPS-соединений к api.telegram.org с прозрачным переподключением"""
+
+    def __init__(self, token, base_url=API_URL, timeout=10.0, pool_size=4):
+        self.token = token
+        url = urlsplit(base_url)
+        self.host = url.netloc
+        self.path_prefix = url.path.rstrip("/")
+        # http:// — только для локального Bot API-сервера или бенчмарков
+        self._connection_class = http.client.HTTPConnection if url.scheme == "http" else http.client.HTTPSConnection
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._executor = None
+        # method -> [счётчики по бакетам, сумма секунд, число вызовов, число ошибок]
+        self._stats = {}
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connection_class(self.host, timeout=self.timeout)
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def _request(self, conn, method, body, timeout):
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        conn.request("POST", f"{self.path_prefix}/bot{self.token}/{method}", body=body, headers={
+            "Content-Type": "application/json",
+            "Connection": "keep-alive",
+        })
+        response = conn.getresponse()
+        return response, response.read()
+
+    def _observe(self, method, elapsed, failed):
+        with self._lock:
+            state = self._stats.get(method)
+            if state is None:
+                state = self._stats[method] = [[0] * len(LATENCY_BUCKETS), 0.0, 0, 0]
+            state[0][bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+            state[1] += elapsed
+            state[2] += 1
+            state[3] += int(failed)
+
+    def call(self, method, data, timeout=None):
+        """Вызов метода Bot API. Возвращает разобранный JSON или None при ошибке."""
+        start = time.perf_counter()
+        result = self._call(method, data, timeout)
+        self._observe(method, time.perf_counter() - start, result is None)
+        return result
+
+    def _call(self, method, data, timeout):
+        body = json.dumps(data).encode()
+        timeout = timeout or self.timeout
+        conn = self._acquire()
+        try:
+            try:
+                response, payload = self._request(conn, method, body, timeout)
+            except _RECONNECT_ERRORS:
+                # Сервер закрыл простаивающее соединение — пробуем один раз на новом
+                conn.close()
+                conn = self._connection_class(self.host, timeout=timeout)
+                response, payload = self._request(conn, method, body, timeout)
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            print(f"Error calling {method}: {e}")
+            return None
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+
+        if response.status != 200:
+            print(f"Error calling {method}: HTTP {response.status} {payload[:200]!r}")
+            return None
+        try:
+            return json.loads(payload)
+        except ValueError as e:
+            # Обрезанный ответ или HTML-страница прокси — такой же неудачный вызов, как обрыв связи
+            print(f"Error calling {method}: bad JSON {payload[:200]!r}: {e}")
+            return None
+
+    def call_many(self, calls, timeout=None):
+        """Параллельный вызов независимых методов: calls — список (method, data)"""
+        if len(calls) == 1:
+            method, data = calls[0]
+            return [self.call(method, data, timeout)]
+        with self._lock:
+            if self._executor is None:
+                # concurrent.futures заметно удлиняет холодный старт, а нужен только для пакетов
+                from concurrent.futures import ThreadPoolExecutor
+
+                self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="tg")
+        futures = [self._executor.submit(self.call, method, data, timeout) for method, data in calls]
+        return [future.result() for future in futures]
+
+    def metrics_text(self):
+        """Время и ошибки вызовов по методам в формате Prometheus"""
+        lines = [
+            "# HELP telegram_api_seconds Время вызова Bot API",
+            "# TYPE telegram_api_seconds histogram",
+        ]
+        with self._lock:
+            stats = {method: (list(state[0]), state[1], state[2], state[3]) for method, state in self._stats.items()}
+        for method, (counts, total, count, _) in stats.items():
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS, counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'telegram_api_seconds_bucket{{method="{method}",le="{le}"}} {cumulative}')
+            lines.append(f'telegram_api_seconds_sum{{method="{method}"}} {total!r}')
+            lines.append(f'telegram_api_seconds_count{{method="{method}"}} {count}')
+        lines += [
+            "# HELP telegram_api_errors_total Ошибки вызовов Bot API",
+            "# TYPE telegram_api_errors_total counter",
+        ]
+        for method, (_, _, _, errors) in stats.items():
+            lines.append(f'telegram_api_errors_total{{method="{method}"}} {errors}')
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        """Закрыть все простаивающие соединения"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
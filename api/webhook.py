@@ -4,9 +4,15 @@ Telegram Bot Webhook для Vercel
 from http.server import BaseHTTPRequestHandler
 import json
 import os
-import urllib.request
-import urllib.parse
-from urllib.error import HTTPError
+import sys
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from urllib.parse import quote, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _telegram import TelegramClient
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "8560064127:AAESCPlqu9_ht76zTNZ6V8Z1v9SyNyvonHQ")
 WEBAPP_URL = os.environ.get("WEBAPP_URL", "")
@@ -14,170 +20,331 @@ CHANNEL_ID = os.environ.get("CHANNEL_ID")
 CHANNEL_URL = os.environ.get("CHANNEL_URL")
 # URL для доступа к баннеру (предполагается, что файлы из public доступны в корне)
 BANNER_URL = f"{WEBAPP_URL}/subscribe_banner.jpg" if WEBAPP_URL else None
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")
+# Эндпоинт загрузки видео (uploads.py в bot.py) — передаётся в Mini App параметром
+UPLOAD_URL = os.environ.get("UPLOAD_URL")
+TELEGRAM_TIMEOUT = float(os.environ.get("TELEGRAM_TIMEOUT", "10"))
+# getChatMember на критическом пути /start — ждём его меньше
+CHECK_TIMEOUT = float(os.environ.get("TELEGRAM_CHECK_TIMEOUT", "5"))
+
+# Живёт между вызовами «тёплого» инстанса: TLS-соединения переиспользуются
+telegram = TelegramClient(BOT_TOKEN, base_url=TELEGRAM_API_URL, timeout=TELEGRAM_TIMEOUT)
 
-def send_telegram_request(method, data):
+def send_telegram_request(method, data, timeout=None):
     """Отправка запроса к Telegram API"""
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/{method}"
-    req = urllib.request.Request(
-        url,
-        data=json.dumps(data).encode(),
-        headers={"Content-Type": "application/json"}
-    )
-    try:
-        with urllib.request.urlopen(req) as response:
-            return json.loads(response.read().decode())
-    except HTTPError as e:
-        print(f"Error calling {method}: {e}")
-        return None
-
-def send_message(chat_id, text, reply_markup=None):
-    data = {
-        "chat_id": chat_id,
-        "text": text,
-        "parse_mode": "HTML"
-    }
+    return telegram.call(method, data, timeout)
+
+# Если включено, последнее действие по апдейту уходит телом ответа на вебхук, а не отдельным запросом
+WEBHOOK_REPLY = os.environ.get("WEBHOOK_REPLY", "1") != "0"
+# Метрики клиента Bot API: GET /api/webhook?metrics
+METRICS_PATH = "/api/webhook"
+
+
+class Reply:
+    """
+    Ответ бота с неизменной частью, сериализованной в JSON один раз.
+    На каждый апдейт подставляется только адресат (chat_id или callback_query_id).
+    """
+    __slots__ = ("method", "fields", "target", "_head", "_tail")
+
+    def __init__(self, method, fields, target="chat_id"):
+        self.method = method
+        self.fields = fields
+        self.target = target
+        self._head = f'{{"method":"{method}","{target}":'.encode()
+        self._tail = json.dumps(fields, ensure_ascii=False, separators=(",", ":"))[1:].encode()
+
+    def body(self, value):
+        """Тело ответа на вебхук"""
+        return self._head + json.dumps(value).encode() + b"," + self._tail
+
+    def request(self, value):
+        """(method, data) для отдельного вызова Bot API"""
+        return self.method, {self.target: value, **self.fields}
+
+
+def message_reply(text, reply_markup=None):
+    fields = {"text": text, "parse_mode": "HTML"}
     if reply_markup:
-        data["reply_markup"] = reply_markup
-    send_telegram_request("sendMessage", data)
-
-def send_photo(chat_id, photo_url, caption=None, reply_markup=None):
-    data = {
-        "chat_id": chat_id,
-        "photo": photo_url,
-        "parse_mode": "HTML"
-    }
+        fields["reply_markup"] = reply_markup
+    return Reply("sendMessage", fields)
+
+
+def photo_reply(photo_url, caption=None, reply_markup=None):
+    fields = {"photo": photo_url, "parse_mode": "HTML"}
     if caption:
-        data["caption"] = caption
+        fields["caption"] = caption
     if reply_markup:
-        data["reply_markup"] = reply_markup
-    send_telegram_request("sendPhoto", data)
+        fields["reply_markup"] = reply_markup
+    return Reply("sendPhoto", fields)
+
+
+# Кэш ответов getChatMember: живёт между запросами в «тёплом» инстансе
+SUB_CACHE_SIZE = int(os.environ.get("SUB_CACHE_SIZE", "10000"))
+SUB_CACHE_TTL = float(os.environ.get("SUB_CACHE_TTL", "600"))
+SUB_CACHE_NEGATIVE_TTL = float(os.environ.get("SUB_CACHE_NEGATIVE_TTL", "20"))
+_sub_cache = OrderedDict()
+_sub_inflight = {}
+_sub_lock = threading.Lock()
+
+
+def _cache_get(key):
+    with _sub_lock:
+        entry = _sub_cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del _sub_cache[key]
+            return None
+        _sub_cache.move_to_end(key)
+        return entry[1]
+
+
+def _cache_set(key, value, ttl):
+    with _sub_lock:
+        _sub_cache[key] = (time.monotonic() + ttl, value)
+        _sub_cache.move_to_end(key)
+        while len(_sub_cache) > SUB_CACHE_SIZE:
+            _sub_cache.popitem(last=False)
+
+
+def invalidate_subscription(user_id):
+    """Сброс кэша подписки (по апдейту chat_member)"""
+    with _sub_lock:
+        _sub_cache.pop((CHANNEL_ID, user_id), None)
+
+
+def fetch_subscription(user_id):
+    """Запрос статуса у Telegram. Возвращает (подписан, можно_кэшировать)."""
+    data = {"chat_id": CHANNEL_ID, "user_id": user_id}
+    result = send_telegram_request("getChatMember", data, timeout=CHECK_TIMEOUT)
+
+    if result and result.get("ok"):
+        status = result["result"]["status"]
+        return status in ["creator", "administrator", "member", "restricted"], True
+    return True, False # В случае ошибки (например, бот не админ) пропускаем, но не кэшируем
+
 
 def check_subscription(user_id):
     """Проверка подписки"""
     if not CHANNEL_ID:
         return True
-    
-    data = {"chat_id": CHANNEL_ID, "user_id": user_id}
-    result = send_telegram_request("getChatMember", data)
-    
-    if result and result.get("ok"):
-        status = result["result"]["status"]
-        return status in ["creator", "administrator", "member", "restricted"]
-    return True # В случае ошибки (например, бот не админ) пропускаем
 
+    key = (CHANNEL_ID, user_id)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+
+    # Параллельные проверки одного пользователя ждут один запрос
+    with _sub_lock:
+        event = _sub_inflight.get(key)
+        leader = event is None
+        if leader:
+            event = _sub_inflight[key] = threading.Event()
+    if not leader:
+        event.wait(10)
+        cached = _cache_get(key)
+        if cached is not None:
+            return cached
+
+    try:
+        is_sub, cacheable = fetch_subscription(user_id)
+        if cacheable:
+            _cache_set(key, is_sub, SUB_CACHE_TTL if is_sub else SUB_CACHE_NEGATIVE_TTL)
+        return is_sub
+    finally:
+        if leader:
+            with _sub_lock:
+                _sub_inflight.pop(key, None)
+            event.set()
+
+
+def _base_url(host):
+    return WEBAPP_URL or f"https://{host}"
 
-def send_subscription_prompt(chat_id, host=""):
-    # Используем WEBAPP_URL из env или собираем из host
-    base_url = WEBAPP_URL or f"https://{host}"
-    
-    # URL картинки
-    photo_url = f"{base_url}/subscribe_banner.jpg"
 
+def webapp_url(base_url):
+    if not UPLOAD_URL:
+        return base_url
+    return f"{base_url}{'&' if '?' in base_url else '?'}upload={quote(UPLOAD_URL, safe='')}"
+
+
+HELP_REPLY = message_reply(
+    "📖 <b>Помощь</b>\n\n"
+    "/start - Открыть редактор видео\n"
+    "/help - Справка"
+)
+
+NOT_SUBSCRIBED_REPLY = Reply(
+    "answerCallbackQuery",
+    {"text": "❌ Вы пока не подписались на канал!", "show_alert": True},
+    target="callback_query_id",
+)
+
+
+@lru_cache(maxsize=16)
+def subscription_prompt_reply(base_url):
+    """sendPhoto с просьбой подписаться"""
     reply_markup = {
         "inline_keyboard": [
             [{"text": "📢 Подписаться", "url": CHANNEL_URL or "https://t.me/"}],
             [{"text": "✅ Проверить подписку", "callback_data": "check_subscription"}]
         ]
     }
-    
     caption = (
         "👋 <b>Привет!</b>\n\n"
         "Для использования бота необходимо подписаться на наш канал:\n"
         f"<b>AI Laboratory</b>\n\n"
         "После подписки нажмите кнопку «Проверить подписку»."
     )
-    
-    print(f"Sending prompt with photo: {photo_url}")
-    # Пробуем отправить фото, если не получится - текст
-    try:
-         send_photo(chat_id, photo_url, caption, reply_markup)
-    except Exception as e:
-         print(f"Failed to send photo: {e}")
-         send_message(chat_id, caption, reply_markup)
+    return photo_reply(f"{base_url}/subscribe_banner.jpg", caption, reply_markup)
 
 
-def send_welcome(chat_id, host):
-    webapp_url = WEBAPP_URL or f"https://{host}"
+@lru_cache(maxsize=16)
+def welcome_reply(base_url):
+    """sendMessage с приветствием"""
     reply_markup = {
         "inline_keyboard": [[{
             "text": "🎬 Улучшить видео",
-            "web_app": {"url": webapp_url}
+            "web_app": {"url": webapp_url(base_url)}
         }]]
     }
-    send_message(
-        chat_id,
+    return message_reply(
         "👋 <b>Добро пожаловать в Upscale Video Bot!</b>\n\n"
         "🎥 Этот бот улучшает качество видео с помощью AI.\n\n"
         "📱 Нажмите кнопку ниже, чтобы открыть редактор:",
         reply_markup
     )
 
+
+@lru_cache(maxsize=16)
+def video_reply(base_url):
+    """sendMessage со ссылкой на Mini App для присланного видео"""
+    reply_markup = {
+        "inline_keyboard": [[{
+            "text": "🎬 Открыть редактор",
+            "web_app": {"url": webapp_url(base_url)}
+        }]]
+    }
+    return message_reply(
+        "📹 Видео нужно загрузить через Mini App.\n"
+        "Нажмите кнопку ниже:",
+        reply_markup
+    )
+
+
+# С заданным WEBAPP_URL ответы не зависят от хоста и сериализуются при импорте
+if WEBAPP_URL:
+    subscription_prompt_reply(WEBAPP_URL)
+    welcome_reply(WEBAPP_URL)
+    video_reply(WEBAPP_URL)
+
+
+def on_start(message, host):
+    chat_id = message["chat"]["id"]
+    if check_subscription(message["from"]["id"]):
+        return welcome_reply(_base_url(host)), chat_id
+    return subscription_prompt_reply(_base_url(host)), chat_id
+
+
+def on_help(message, host):
+    return HELP_REPLY, message["chat"]["id"]
+
+
+def on_check_subscription(callback, host):
+    chat_id = callback["message"]["chat"]["id"]
+    if check_subscription(callback["from"]["id"]):
+        # Удаляем сообщение с просьбой подписаться, приветствие уходит ответом
+        delete = ("deleteMessage", {"chat_id": chat_id, "message_id": callback["message"]["message_id"]})
+        return welcome_reply(_base_url(host)), chat_id, [delete]
+    return NOT_SUBSCRIBED_REPLY, callback["id"]
+
+
+COMMANDS = {
+    "/start": on_start,
+    "/help": on_help,
+}
+
+CALLBACKS = {
+    "check_subscription": on_check_subscription,
+}
+
+
+def on_message(message, host):
+    command = COMMANDS.get(message.get("text"))
+    if command is not None:
+        return command(message, host)
+    if "video" in message:
+        return video_reply(_base_url(host)), message["chat"]["id"]
+    return None
+
+
+def on_callback_query(callback, host):
+    route = CALLBACKS.get(callback.get("data"))
+    return route(callback, host) if route is not None else None
+
+
+def on_chat_member(event, host):
+    invalidate_subscription(event["new_chat_member"]["user"]["id"])
+    return None
+
+
+ROUTES = {
+    "message": on_message,
+    "callback_query": on_callback_query,
+    "chat_member": on_chat_member,
+}
+
+
+def handle_update(update, host):
+    """
+    Обработка апдейта. Финальное действие возвращается как (Reply, адресат),
+    чтобы уйти телом ответа на вебхук; третьим элементом — побочные вызовы [(method, data)].
+    """
+    for kind, payload in update.items():
+        route = ROUTES.get(kind)
+        if route is not None:
+            return route(payload, host)
+    return None
+
+
 class handler(BaseHTTPRequestHandler):
     def do_POST(self):
         content_length = int(self.headers['Content-Length'])
         body = self.rfile.read(content_length)
         update = json.loads(body)
         host = self.headers.get('Host', '')
-        
-        if "callback_query" in update:
-            callback = update["callback_query"]
-            chat_id = callback["message"]["chat"]["id"]
-            user_id = callback["from"]["id"]
-            data = callback.get("data")
-            callback_id = callback["id"]
-            message_id = callback["message"]["message_id"]
-
-            if data == "check_subscription":
-                if check_subscription(user_id):
-                    # Удаляем сообщение с просьбой подписаться
-                    send_telegram_request("deleteMessage", {"chat_id": chat_id, "message_id": message_id})
-                    send_welcome(chat_id, host)
-                else:
-                    send_telegram_request("answerCallbackQuery", {
-                        "callback_query_id": callback_id,
-                        "text": "❌ Вы пока не подписались на канал!",
-                        "show_alert": True
-                    })
-
-        elif "message" in update:
-            message = update["message"]
-            chat_id = message["chat"]["id"]
-            user_id = message["from"]["id"]
-            text = message.get("text", "")
-            
-            if text == "/start":
-                if check_subscription(user_id):
-                    send_welcome(chat_id, host)
-                else:
-                    send_subscription_prompt(chat_id, host)
-                    
-            elif text == "/help":
-                send_message(
-                    chat_id,
-                    "📖 <b>Помощь</b>\n\n"
-                    "/start - Открыть редактор видео\n"
-                    "/help - Справка"
-                )
-            elif "video" in message:
-                webapp_url = WEBAPP_URL or f"https://{host}"
-                reply_markup = {
-                    "inline_keyboard": [[{
-                        "text": "🎬 Открыть редактор", 
-                        "web_app": {"url": webapp_url}
-                    }]]
-                }
-                send_message(
-                    chat_id,
-                    "📹 Видео нужно загрузить через Mini App.\n"
-                    "Нажмите кнопку ниже:",
-                    reply_markup
-                )
-        
+
+        reply = handle_update(update, host)
+        calls = reply[2] if reply and len(reply) > 2 else []
+
+        if reply and WEBHOOK_REPLY:
+            if calls:
+                telegram.call_many(calls)
+            payload = reply[0].body(reply[1])
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+
+        if reply:
+            # Без ответа телом все вызовы независимы и идут параллельно
+            telegram.call_many(calls + [reply[0].request(reply[1])])
         self.send_response(200)
         self.end_headers()
         self.wfile.write(b"OK")
     
     def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path.rstrip("/") == METRICS_PATH and url.query == "metrics":
+            payload = telegram.metrics_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.end_headers()
+            self.wfile.write(payload)
+            return
         self.send_response(200)
         self.end_headers()
         self.wfile.write(b"Upscale Video Bot is running!")
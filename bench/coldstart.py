@@ -0,0 +1,121 @@
+"""
+Холодный и тёплый старт функции Vercel (api/webhook.py) без сети.
+
+    python -m bench.coldstart --samples 15 --cold-budget-ms 120 --warm-budget-us 40
+
+Холодный старт — отдельный процесс на каждый замер: время импорта модуля и первого апдейта
+(/help, ответ телом вебхука). Тёплый — обработка апдейтов в уже загруженном модуле.
+Превышение бюджета — код выхода 1.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_DIR = os.path.join(ROOT, "api")
+
+# Без CHANNEL_ID проверка подписки не ходит в сеть; WEBAPP_URL как в проде
+ENV = {"BOT_TOKEN": "1:bench", "WEBAPP_URL": "https://bench.example", "CHANNEL_ID": ""}
+
+
+def make_update(kind: str, seq: int = 1) -> dict:
+    message = {"message_id": seq, "date": 0, "chat": {"id": seq, "type": "private"}, "from": {"id": seq}}
+    if kind == "video":
+        message["video"] = {"file_id": "v", "file_unique_id": "v", "width": 640, "height": 360, "duration": 5}
+    else:
+        message["text"] = f"/{kind}"
+    return {"update_id": seq, "message": message}
+
+
+COLD_SNIPPET = """
+import time
+started = time.perf_counter()
+import json, sys
+sys.path.insert(0, {api_dir!r})
+import webhook
+imported = time.perf_counter()
+update = json.loads({update!r})
+reply = webhook.handle_update(update, "bench.example")
+reply[0].body(reply[1])
+done = time.perf_counter()
+print(json.dumps({{"import_ms": (imported - started) * 1000, "first_ms": (done - imported) * 1000}}))
+"""
+
+
+def cold_sample() -> dict:
+    env = dict(os.environ, **ENV)
+    code = COLD_SNIPPET.format(api_dir=API_DIR, update=json.dumps(make_update("help")))
+    started = time.perf_counter()
+    output = subprocess.check_output([sys.executable, "-c", code], env=env, cwd=API_DIR, text=True)
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process_ms"] = (time.perf_counter() - started) * 1000
+    return result
+
+
+def warm(iterations: int) -> dict:
+    os.environ.update(ENV)
+    sys.path.insert(0, API_DIR)
+    import webhook
+
+    results = {}
+    for kind in ("start", "help", "video"):
+        update = make_update(kind)
+        timings = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            reply = webhook.handle_update(update, "bench.example")
+            reply[0].body(reply[1])
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        results[kind] = {
+            "p50_us": round(timings[len(timings) // 2] * 1e6, 2),
+            "p99_us": round(timings[int(len(timings) * 0.99)] * 1e6, 2),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Холодный и тёплый старт api/webhook.py")
+    parser.add_argument("--samples", type=int, default=10, help="замеров холодного старта")
+    parser.add_argument("--iterations", type=int, default=20000, help="апдейтов на вид в тёплом замере")
+    parser.add_argument("--cold-budget-ms", type=float, default=150.0,
+                        help="бюджет на импорт + первый апдейт (медиана)")
+    parser.add_argument("--warm-budget-us", type=float, default=50.0, help="бюджет p99 тёплого апдейта")
+    parser.add_argument("--json", help="записать результат в файл")
+    args = parser.parse_args()
+
+    samples = [cold_sample() for _ in range(args.samples)]
+    cold = {
+        key: round(statistics.median(sample[key] for sample in samples), 2)
+        for key in ("import_ms", "first_ms", "process_ms")
+    }
+    cold["total_ms"] = round(cold["import_ms"] + cold["first_ms"], 2)
+    result = {"cold": cold, "warm": warm(args.iterations)}
+
+    print(f"холодный старт (медиана из {args.samples}): импорт {cold['import_ms']} мс, "
+          f"первый апдейт {cold['first_ms']} мс, процесс целиком {cold['process_ms']} мс")
+    for kind, timings in result["warm"].items():
+        print(f"тёплый {kind}: p50 {timings['p50_us']} мкс, p99 {timings['p99_us']} мкс")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    failures = []
+    if cold["total_ms"] > args.cold_budget_ms:
+        failures.append(f"холодный старт {cold['total_ms']} мс > {args.cold_budget_ms} мс")
+    for kind, timings in result["warm"].items():
+        if timings["p99_us"] > args.warm_budget_us:
+            failures.append(f"тёплый {kind}: p99 {timings['p99_us']} мкс > {args.warm_budget_us} мкс")
+    for line in failures:
+        print(f"ПРЕВЫШЕН БЮДЖЕТ: {line}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Фейковый Telegram Bot API для нагрузочных тестов.
+Отвечает на методы, которыми пользуются bot.py и api/webhook.py, с настраиваемой
+задержкой и долей ответов 429, и отдаёт в getUpdates апдейты от генератора нагрузки.
+"""
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+
+class FakeTelegram:
+    """In-process сервер Bot API: очередь апдейтов + журнал ответов бота по chat_id"""
+
+    def __init__(self, latency: float = 0.02, jitter: float = 0.01, error_rate: float = 0.0,
+                 retry_after: int = 1, subscribed_ratio: float = 1.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.subscribed_ratio = subscribed_ratio
+
+        self._updates = []
+        self._next_update_id = 1
+        self._new_updates = asyncio.Event()
+        self._message_id = 0
+        self._runner = None
+
+        # chat_id -> время первого ответа бота после ожидания (см. expect)
+        self._waiting = {}
+        self.replies = {}
+        # (chat_id, время) каждого sendMessage/sendPhoto — для скорости рассылки
+        self.deliveries = []
+        self.calls = {}
+        self.throttled = 0
+
+    # --- сторона генератора нагрузки ---
+
+    def push_update(self, update: dict) -> int:
+        """Поставить апдейт в очередь getUpdates"""
+        update_id = self._next_update_id
+        self._next_update_id += 1
+        self._updates.append({"update_id": update_id, **update})
+        self._new_updates.set()
+        return update_id
+
+    def next_update_id(self) -> int:
+        """Зарезервировать update_id для апдейта, который отправляется вебхуком"""
+        update_id = self._next_update_id
+        self._next_update_id += 1
+        return update_id
+
+    def expect(self, chat_id: int):
+        """Начать ждать ответ бота в чат chat_id"""
+        self._waiting[chat_id] = time.perf_counter()
+
+    def is_subscribed(self, user_id: int) -> bool:
+        return (user_id * 2654435761 % 1000) / 1000 < self.subscribed_ratio
+
+    # --- HTTP ---
+
+    def _record_reply(self, chat_id, delivery: bool = True):
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            return
+        now = time.perf_counter()
+        if delivery:
+            self.deliveries.append((chat_id, now))
+        if chat_id in self._waiting and chat_id not in self.replies:
+            self.replies[chat_id] = now
+
+    def _message(self, chat_id, **extra) -> dict:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            **extra,
+        }
+
+    async def _params(self, request: web.Request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        form = await request.post()
+        params = {}
+        for key, value in form.items():
+            if isinstance(value, str):
+                try:
+                    params[key] = json.loads(value)
+                except ValueError:
+                    params[key] = value
+            else:
+                params[key] = value
+        return params
+
+    async def _get_updates(self, params: dict):
+        offset = int(params.get("offset") or 0)
+        timeout = min(float(params.get("timeout") or 0), 1.0)
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        return self._updates[:limit]
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = await self._params(request)
+
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+
+        await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if self.error_rate and random.random() < self.error_rate:
+            self.throttled += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+
+        chat_id = params.get("chat_id")
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method == "getChatMember":
+            user_id = int(params["user_id"])
+            status = "member" if user_id == 1 or self.is_subscribed(user_id) else "left"
+            if user_id == 1:
+                status = "administrator"
+            result = {"status": status, "user": {"id": user_id, "is_bot": False, "first_name": "u"}}
+            if status == "administrator":
+                result.update({
+                    "can_be_edited": False, "is_anonymous": False, "can_manage_chat": True,
+                    "can_delete_messages": True, "can_manage_video_chats": True,
+                    "can_restrict_members": True, "can_promote_members": False,
+                    "can_change_info": True, "can_invite_users": True, "can_post_stories": False,
+                    "can_edit_stories": False, "can_delete_stories": False,
+                })
+        elif method == "sendMessage":
+            self._record_reply(chat_id)
+            result = self._message(chat_id, text=str(params.get("text", "")))
+        elif method == "sendPhoto":
+            self._record_reply(chat_id)
+            photo = [{"file_id": "bench-photo", "file_unique_id": "bench", "width": 1280, "height": 853}]
+            result = self._message(chat_id, photo=photo)
+        elif method == "editMessageText":
+            result = self._message(chat_id or 0, text=str(params.get("text", "")))
+        elif method == "answerCallbackQuery":
+            # Ответ на callback не несёт chat_id; генератор использует callback id = chat_id
+            self._record_reply(params.get("callback_query_id"), delivery=False)
+            result = True
+        else:
+            # setWebhook, deleteWebhook, deleteMessage и прочее
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запустить сервер; возвращает базовый URL для TELEGRAM_API_URL"""
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
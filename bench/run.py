@@ -0,0 +1,482 @@
+"""
+Нагрузочный прогон бота против фейкового Bot API.
+
+    python -m bench.run --target bot --rate 200 --duration 30 --database-url postgresql://localhost/bench
+    python -m bench.run --target webhook --rate 100 --duration 20
+
+target=bot запускает bot.py (поллинг) отдельным процессом, target=webhook поднимает
+handler из api/webhook.py в этом же процессе. Результат пишется в
+bench/results/<время>-<коммит>.json и сравнивается с прошлым прогоном того же target:
+рост p99 или падение пропускной способности больше порога — код выхода 1.
+Для target=bot нужна отдельная (не боевая) база: рассылка засевает в неё пользователей.
+"""
+import argparse
+import asyncio
+import glob
+import importlib.util
+import json
+import logging
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import aiohttp
+
+from bench.fake_telegram import FakeTelegram
+
+logger = logging.getLogger("bench")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+
+BOT_TOKEN = "1:bench"
+ADMIN_ID = 42
+CHANNEL_ID = "-1001"
+# Пользователи нагрузки и получатели рассылки не пересекаются
+LOAD_USER_BASE = 10_000_000
+BROADCAST_USER_BASE = 20_000_000
+
+KINDS = ("start", "callback", "video")
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q * (len(values) - 1))))
+    return values[index]
+
+
+def latency_summary(values: list) -> dict:
+    """Сводка задержек в миллисекундах"""
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 0.5) * 1000, 2),
+        "p90": round(percentile(values, 0.9) * 1000, 2),
+        "p99": round(percentile(values, 0.99) * 1000, 2),
+        "max": round(max(values) * 1000, 2) if values else 0.0,
+    }
+
+
+def parse_mix(value: str) -> dict:
+    """"start=0.6,callback=0.3,video=0.1" -> веса по видам апдейтов"""
+    mix = {}
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f"неизвестный вид апдейта: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def make_update(kind: str, user_id: int, seq: int) -> dict:
+    """Синтетический апдейт; chat_id совпадает с user_id, id колбэка — тоже"""
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{seq}", "username": f"bench{seq}"}
+    chat = {"id": user_id, "type": "private"}
+    message = {"message_id": seq, "date": int(time.time()), "chat": chat, "from": user}
+    if kind == "start":
+        message.update(text="/start", entities=[{"type": "bot_command", "offset": 0, "length": 6}])
+        return {"message": message}
+    if kind == "video":
+        message["video"] = {
+            "file_id": f"video{seq}", "file_unique_id": f"v{seq}",
+            "width": 640, "height": 360, "duration": 5,
+        }
+        return {"message": message}
+    return {"callback_query": {
+        "id": str(user_id), "from": user, "chat_instance": "bench",
+        "data": "check_subscription", "message": {**message, "text": "subscribe"},
+    }}
+
+
+def git_revision() -> str:
+    try:
+        sha = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"], cwd=ROOT).returncode != 0
+        return sha + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "nogit"
+
+
+class DatabaseProbe:
+    """Дельты pg_stat_database за прогон — нагрузка, которую бот создал на базу"""
+
+    QUERY = (
+        "SELECT xact_commit, xact_rollback, tup_returned, tup_fetched, tup_inserted,"
+        " tup_updated, tup_deleted, blks_read, blks_hit"
+        " FROM pg_stat_database WHERE datname = current_database()"
+    )
+
+    def __init__(self, dsn: str):
+        import psycopg2
+        import psycopg2.extras
+
+        self._conn = psycopg2.connect(dsn)
+        self._conn.autocommit = True
+        self._extras = psycopg2.extras
+        self._before = None
+
+    def _read(self) -> dict:
+        with self._conn.cursor(cursor_factory=self._extras.RealDictCursor) as cur:
+            # Статистика в pg_stat кэшируется на транзакцию; сбрасываем снимок
+            cur.execute("SELECT pg_stat_clear_snapshot()")
+            cur.execute(self.QUERY)
+            return dict(cur.fetchone())
+
+    def start(self):
+        self._before = self._read()
+
+    def finish(self, elapsed: float) -> dict:
+        after = self._read()
+        delta = {key: after[key] - self._before[key] for key in after}
+        delta["xact_per_sec"] = round(delta["xact_commit"] / elapsed, 1) if elapsed else 0.0
+        with self._conn.cursor() as cur:
+            cur.execute("SELECT count(*) FROM pg_stat_activity WHERE datname = current_database()")
+            delta["connections"] = cur.fetchone()[0]
+        return delta
+
+    def seed_users(self, count: int):
+        """Получатели рассылки: пользователи с id от BROADCAST_USER_BASE"""
+        with self._conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO users (id, username, first_name)"
+                " SELECT %s + g, 'bench' || g, 'Bench' FROM generate_series(1, %s) AS g"
+                " ON CONFLICT (id) DO UPDATE SET active = TRUE",
+                (BROADCAST_USER_BASE, count),
+            )
+
+    def close(self):
+        self._conn.close()
+
+
+class BotTarget:
+    """bot.py в режиме поллинга; апдейты уходят через getUpdates фейкового API"""
+
+    name = "bot"
+
+    def __init__(self, fake: FakeTelegram, api_url: str, database_url: str):
+        self.fake = fake
+        self.api_url = api_url
+        self.database_url = database_url
+        self.process = None
+        self.log_path = None
+
+    async def start(self):
+        env = dict(
+            os.environ,
+            BOT_TOKEN=BOT_TOKEN,
+            TELEGRAM_API_URL=self.api_url,
+            DATABASE_URL=self.database_url,
+            ADMIN_ID=str(ADMIN_ID),
+            CHANNEL_ID=CHANNEL_ID,
+            WEBHOOK_URL="",
+            METRICS_PORT="0",
+        )
+        log = tempfile.NamedTemporaryFile("wb", prefix="bench-bot-", suffix=".log", delete=False)
+        self.log_path = log.name
+        self.process = subprocess.Popen(
+            [sys.executable, "bot.py"], cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT
+        )
+        log.close()
+        # Бот готов, когда начал поллинг
+        deadline = time.monotonic() + 60
+        while not self.fake.calls.get("getUpdates"):
+            if self.process.poll() is not None:
+                raise RuntimeError(f"bot.py завершился при старте, лог: {self.log_path}")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"bot.py не начал поллинг за 60 с, лог: {self.log_path}")
+            await asyncio.sleep(0.1)
+
+    async def send(self, update: dict, chat_id: int):
+        self.fake.expect(chat_id)
+        self.fake.push_update(update)
+
+    def latency(self, chat_id: int, sent_at: float):
+        replied = self.fake.replies.get(chat_id)
+        return None if replied is None else replied - sent_at
+
+    async def stop(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.send_signal(signal.SIGINT)
+        try:
+            await asyncio.to_thread(self.process.wait, 30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class WebhookTarget:
+    """handler из api/webhook.py на локальном HTTP-сервере; задержка — время ответа на POST"""
+
+    name = "webhook"
+
+    def __init__(self, fake: FakeTelegram, api_url: str):
+        self.fake = fake
+        self.api_url = api_url
+        self.server = None
+        self.session = None
+        self.url = None
+        self.results = {}
+
+    async def start(self):
+        os.environ.update(BOT_TOKEN=BOT_TOKEN, TELEGRAM_API_URL=self.api_url, CHANNEL_ID=CHANNEL_ID)
+        spec = importlib.util.spec_from_file_location("bench_webhook", os.path.join(ROOT, "api", "webhook.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        # Без журнала запросов BaseHTTPRequestHandler в stderr
+        quiet = type("handler", (module.handler,), {"log_message": lambda self, *args: None})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), quiet)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/api/webhook"
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=256))
+
+    async def _post(self, update: dict, chat_id: int):
+        start = time.perf_counter()
+        try:
+            async with self.session.post(self.url, json=update) as response:
+                await response.read()
+                ok = response.status == 200
+        except aiohttp.ClientError:
+            ok = False
+        if ok:
+            self.results[chat_id] = time.perf_counter() - start
+
+    async def send(self, update: dict, chat_id: int):
+        update["update_id"] = self.fake.next_update_id()
+        asyncio.create_task(self._post(update, chat_id))
+
+    def latency(self, chat_id: int, sent_at: float):
+        return self.results.get(chat_id)
+
+    async def stop(self):
+        if self.session is not None:
+            await self.session.close()
+        if self.server is not None:
+            self.server.shutdown()
+
+
+async def run(args) -> dict:
+    if args.target == "bot" and not args.database_url:
+        raise SystemExit("target=bot требует --database-url (или BENCH_DATABASE_URL)")
+    fake = FakeTelegram(
+        latency=args.api_latency / 1000,
+        jitter=args.api_jitter / 1000,
+        error_rate=args.error_rate,
+        retry_after=args.retry_after,
+        subscribed_ratio=args.subscribed,
+    )
+    api_url = await fake.start()
+
+    probe = DatabaseProbe(args.database_url) if args.database_url else None
+    if args.target == "bot":
+        target = BotTarget(fake, api_url, args.database_url)
+    else:
+        target = WebhookTarget(fake, api_url)
+
+    sent = []
+    broadcast = None
+    try:
+        await target.start()
+        logger.info(f"Цель {target.name} запущена, фейковый API на {api_url}")
+
+        if args.broadcast_users and args.target == "bot":
+            probe.seed_users(args.broadcast_users)
+        if probe is not None:
+            probe.start()
+
+        kinds, weights = zip(*args.mix.items())
+        interval = 1 / args.rate
+        started = time.perf_counter()
+
+        if args.broadcast_users and args.target == "bot":
+            text = f"/broadcast bench {int(time.time())}"
+            admin_update = make_update("start", ADMIN_ID, 0)
+            admin_update["message"].update(text=text, entities=[{"type": "bot_command", "offset": 0, "length": 10}])
+            fake.push_update(admin_update)
+            broadcast = {"users": args.broadcast_users, "started": started}
+
+        # Открытая модель нагрузки: апдейты идут по расписанию, не дожидаясь ответов
+        seq = 0
+        while True:
+            now = time.perf_counter()
+            if now - started >= args.duration:
+                break
+            due = int((now - started) / interval) + 1
+            while seq < due:
+                seq += 1
+                kind = random.choices(kinds, weights)[0]
+                chat_id = LOAD_USER_BASE + seq
+                sent_at = time.perf_counter()
+                await target.send(make_update(kind, chat_id, seq), chat_id)
+                sent.append((kind, chat_id, sent_at))
+            await asyncio.sleep(min(interval, 0.005))
+        load_elapsed = time.perf_counter() - started
+
+        # Дожидаемся хвоста ответов
+        deadline = time.perf_counter() + args.drain
+        while time.perf_counter() < deadline:
+            if all(target.latency(chat_id, sent_at) is not None for _, chat_id, sent_at in sent):
+                break
+            await asyncio.sleep(0.1)
+        elapsed = time.perf_counter() - started
+
+        by_kind = {kind: [] for kind in args.mix}
+        for kind, chat_id, sent_at in sent:
+            value = target.latency(chat_id, sent_at)
+            if value is not None:
+                by_kind[kind].append(value)
+        everything = [value for values in by_kind.values() for value in values]
+        completed = len(everything)
+
+        if broadcast is not None:
+            times = [t for chat_id, t in fake.deliveries if chat_id > BROADCAST_USER_BASE]
+            span = (max(times) - broadcast["started"]) if times else 0.0
+            broadcast = {
+                "users": args.broadcast_users,
+                "delivered": len(times),
+                "messages_per_sec": round(len(times) / span, 1) if span else 0.0,
+            }
+
+        # pg_stat обновляется с задержкой до секунды
+        db_stats = None
+        if probe is not None:
+            await asyncio.sleep(1.0)
+            db_stats = probe.finish(elapsed)
+
+        return {
+            "target": target.name,
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": {
+                "rate": args.rate,
+                "duration": args.duration,
+                "mix": args.mix,
+                "api_latency_ms": args.api_latency,
+                "api_jitter_ms": args.api_jitter,
+                "error_rate": args.error_rate,
+                "subscribed": args.subscribed,
+            },
+            "sent": len(sent),
+            "completed": completed,
+            "lost": len(sent) - completed,
+            "updates_per_sec": round(completed / load_elapsed, 1) if load_elapsed else 0.0,
+            "latency_ms": latency_summary(everything),
+            "latency_by_kind_ms": {kind: latency_summary(values) for kind, values in by_kind.items()},
+            "broadcast": broadcast,
+            "db": db_stats,
+            "telegram_calls": dict(fake.calls),
+            "telegram_throttled": fake.throttled,
+        }
+    finally:
+        await target.stop()
+        await fake.stop()
+        if probe is not None:
+            probe.close()
+
+
+def previous_result(target: str, exclude: str) -> str | None:
+    """Последний сохранённый прогон того же target"""
+    for path in sorted(glob.glob(os.path.join(RESULTS_DIR, "*.json")), reverse=True):
+        if os.path.abspath(path) == os.path.abspath(exclude):
+            continue
+        with open(path, encoding="utf-8") as f:
+            if json.load(f).get("target") == target:
+                return path
+    return None
+
+
+def compare(current: dict, baseline: dict, threshold: float, min_delta_ms: float) -> list[str]:
+    """Список регрессий: рост p99 и падение пропускной способности сверх порога"""
+    regressions = []
+    pairs = [("всего", current["latency_ms"], baseline["latency_ms"])]
+    for kind, summary in current["latency_by_kind_ms"].items():
+        old = baseline.get("latency_by_kind_ms", {}).get(kind)
+        if old:
+            pairs.append((kind, summary, old))
+    for name, new, old in pairs:
+        if not new["count"] or not old["count"]:
+            continue
+        if new["p99"] > old["p99"] * (1 + threshold) and new["p99"] - old["p99"] > min_delta_ms:
+            regressions.append(f"p99 {name}: {old['p99']:.1f} → {new['p99']:.1f} мс")
+    old_rate, new_rate = baseline["updates_per_sec"], current["updates_per_sec"]
+    if old_rate and new_rate < old_rate * (1 - threshold):
+        regressions.append(f"пропускная способность: {old_rate:.1f} → {new_rate:.1f} апд/с")
+    return regressions
+
+
+def print_report(result: dict):
+    latency = result["latency_ms"]
+    print(f"\n{result['target']} @ {result['revision']}: отправлено {result['sent']}, "
+          f"обработано {result['completed']}, потеряно {result['lost']}")
+    print(f"  {result['updates_per_sec']} апд/с, p50 {latency['p50']} мс, p99 {latency['p99']} мс, "
+          f"max {latency['max']} мс")
+    for kind, summary in result["latency_by_kind_ms"].items():
+        print(f"  {kind:<9} {summary['count']:>7}  p50 {summary['p50']:>8} мс  p99 {summary['p99']:>8} мс")
+    if result["broadcast"]:
+        b = result["broadcast"]
+        print(f"  рассылка: {b['delivered']}/{b['users']}, {b['messages_per_sec']} сообщ/с")
+    if result["db"]:
+        d = result["db"]
+        print(f"  БД: {d['xact_commit']} транзакций ({d['xact_per_sec']}/с), "
+              f"вставлено {d['tup_inserted']}, обновлено {d['tup_updated']}, соединений {d['connections']}")
+    if result["telegram_throttled"]:
+        print(f"  фейковый API ответил 429: {result['telegram_throttled']} раз")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота против фейкового Bot API")
+    parser.add_argument("--target", choices=("bot", "webhook"), default="bot")
+    parser.add_argument("--rate", type=float, default=50, help="апдейтов в секунду")
+    parser.add_argument("--duration", type=float, default=20, help="длительность нагрузки, с")
+    parser.add_argument("--drain", type=float, default=15, help="сколько ждать хвост ответов, с")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("start=0.6,callback=0.3,video=0.1"))
+    parser.add_argument("--broadcast-users", type=int, default=0,
+                        help="запустить /broadcast на столько засеянных пользователей (только target=bot)")
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL") or os.getenv("DATABASE_URL"))
+    parser.add_argument("--api-latency", type=float, default=30, help="задержка фейкового API, мс")
+    parser.add_argument("--api-jitter", type=float, default=10, help="разброс задержки, мс")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--subscribed", type=float, default=0.8, help="доля подписанных на канал")
+    parser.add_argument("--baseline", help="файл результата для сравнения (по умолчанию — прошлый прогон)")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимая регрессия, доля")
+    parser.add_argument("--min-delta-ms", type=float, default=5, help="игнорировать рост p99 меньше этого")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    result = asyncio.run(run(args))
+    print_report(result)
+
+    path = ""
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{result['revision']}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"  сохранено: {os.path.relpath(path, ROOT)}")
+
+    baseline_path = args.baseline or previous_result(result["target"], path)
+    if not baseline_path:
+        return
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare(result, baseline, args.threshold, args.min_delta_ms)
+    print(f"  сравнение с {os.path.basename(baseline_path)} ({baseline.get('revision')}):")
+    if regressions:
+        for line in regressions:
+            print(f"    РЕГРЕССИЯ {line}")
+        sys.exit(1)
+    print("    без регрессий")
+
+
+if __name__ == "__main__":
+    main()
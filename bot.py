@@ -3,21 +3,59 @@ Upscaler Video Bot — Telegram-бот для апскейла видео с п
 С PostgreSQL для постоянного хранения пользователей
 """
 import asyncio
+import hashlib
+import hmac
+import html
 import logging
 import os
-import csv
-import io
-from datetime import datetime, timedelta
+import signal
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
 from dotenv import load_dotenv
 
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import execute_values
 
 from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.filters import Command
-from aiogram.types import Message, WebAppInfo, BufferedInputFile, FSInputFile, CallbackQuery
+from aiogram.types import Message, WebAppInfo, CallbackQuery, ChatMemberUpdated, FSInputFile, Update
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
+from admission import DEFERRED, HIGH, NORMAL, AdmissionController
+from broadcast import BroadcastEngine
+from cache import TTLCache
+from db import Database
+from export import SpooledInputFile, spooled_file, write_users_csv
+from instrumentation import (
+    HandlerMetricsMiddleware,
+    TelegramMetricsMiddleware,
+    TracingMiddleware,
+    metrics_handler,
+    start_metrics_server,
+)
+from jobs import JobQueue, QueueFull
+from media_cache import MediaCache
+from metrics import (
+    BROADCAST_MESSAGES,
+    DB_QUERY_LATENCY,
+    HANDLER_LATENCY,
+    REGISTRY,
+    TELEGRAM_ERRORS,
+    TELEGRAM_LATENCY,
+    latency_table,
+)
+from result_cache import ResultCache
+from staging import FileTooLarge, VideoStager
+from subscriptions import SubscriptionIndex, is_member
+from throttling import ThrottlingMiddleware
+from tracing import tracer
+from upscale import UpscaleError, UpscalePipeline, UpscaleTimeout
+from uploads import UploadError, UploadServer, UploadStore
+from webhook_server import UpdateDeduplicator, WebhookServer
+from write_behind import WriteBehindBuffer
+
 load_dotenv()
 
 logging.basicConfig(
@@ -32,124 +70,523 @@ ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 DATABASE_URL = os.getenv("DATABASE_URL")
 CHANNEL_ID = os.getenv("CHANNEL_ID")
 CHANNEL_URL = os.getenv("CHANNEL_URL")
+BANNER_PATH = "public/subscribe_banner.jpg"
+# Режим вебхука включается, если задан публичный адрес
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8080"))
+# В режиме поллинга /metrics поднимается отдельно, если задан порт
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Публичный адрес загрузок из Mini App; в режиме вебхука они на том же сервере,
+# в режиме поллинга сервер загрузок слушает PORT
+UPLOAD_URL = os.getenv("UPLOAD_URL")
+UPLOAD_PATH = os.getenv("UPLOAD_PATH", "/upload")
 
-bot = Bot(token=BOT_TOKEN)
+# Свой Bot API-сервер (локальный telegram-bot-api или фейковый для бенчмарков).
+# TELEGRAM_API_LOCAL=1 — сервер запущен с --local на этом же хосте: файлы видео копируются с его диска
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+TELEGRAM_API_LOCAL = os.getenv("TELEGRAM_API_LOCAL", "0") == "1"
+session = AiohttpSession(
+    api=TelegramAPIServer.from_base(TELEGRAM_API_URL, is_local=TELEGRAM_API_LOCAL)
+) if TELEGRAM_API_URL else None
+bot = Bot(token=BOT_TOKEN, session=session)
 dp = Dispatcher()
 
+ADMIN_COMMANDS = ("/stats", "/export", "/broadcast", "/queue")
+
 
-def get_db():
-    """Подключение к PostgreSQL"""
-    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+def classify_update(update: Update) -> int:
+    """Приоритет апдейта при перегрузке: /start и проверка подписки первыми, админка — последней"""
+    if update.callback_query:
+        return HIGH if update.callback_query.data == "check_subscription" else NORMAL
+    message = update.message
+    if message and message.text:
+        command = message.text.split()[0].split("@")[0]
+        if command == "/start":
+            return HIGH
+        if command in ADMIN_COMMANDS:
+            return DEFERRED
+    return NORMAL
 
 
-def init_db():
+if os.getenv("TRACE_FILE", "traces/traces.jsonl"):
+    tracer.configure(
+        os.getenv("TRACE_FILE", "traces/traces.jsonl"),
+        sample_rate=float(os.getenv("TRACE_SAMPLE_RATE", "0.01")),
+        slow_threshold=float(os.getenv("TRACE_SLOW_MS", "1000")) / 1000,
+        max_bytes=int(os.getenv("TRACE_MAX_BYTES", str(10 * 1024 * 1024))),
+        backup_count=int(os.getenv("TRACE_BACKUPS", "5")),
+    )
+# Трасса открывается до очереди нагрузки, чтобы ожидание в ней попадало в корневой спан
+dp.update.outer_middleware(TracingMiddleware())
+
+admission = AdmissionController(
+    classify_update,
+    max_concurrency=int(os.getenv("MAX_CONCURRENT_UPDATES", "100")),
+    max_pending=int(os.getenv("MAX_PENDING_UPDATES", "1000")),
+    max_wait=float(os.getenv("MAX_UPDATE_WAIT", "10")),
+)
+dp.update.outer_middleware(admission)
+
+throttling = ThrottlingMiddleware(
+    limit=int(os.getenv("THROTTLE_LIMIT", "5")),
+    window=float(os.getenv("THROTTLE_WINDOW", "10")),
+    maxsize=int(os.getenv("THROTTLE_MAX_TRACKED", "100000")),
+    exempt={ADMIN_ID} if ADMIN_ID else set(),
+)
+dp.message.middleware(throttling)
+dp.callback_query.middleware(throttling)
+
+handler_metrics = HandlerMetricsMiddleware()
+dp.message.middleware(handler_metrics)
+dp.callback_query.middleware(handler_metrics)
+dp.chat_member.middleware(handler_metrics)
+dp.my_chat_member.middleware(handler_metrics)
+bot.session.middleware(TelegramMetricsMiddleware())
+
+
+db = Database(
+    DATABASE_URL,
+    min_size=int(os.getenv("DB_POOL_MIN", "1")),
+    max_size=int(os.getenv("DB_POOL_MAX", "10")),
+    acquire_timeout=float(os.getenv("DB_ACQUIRE_TIMEOUT", "5")),
+    health_check_interval=float(os.getenv("DB_HEALTH_CHECK_INTERVAL", "30")),
+)
+
+
+async def init_db():
     """Создание таблицы пользователей"""
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("""
+    await db.execute("""
         CREATE TABLE IF NOT EXISTS users (
             id BIGINT PRIMARY KEY,
             username VARCHAR(255),
             first_name VARCHAR(255),
             joined TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             active BOOLEAN DEFAULT TRUE
-        )
-    """)
-    conn.commit()
-    cur.close()
-    conn.close()
+        );
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS status_changed TIMESTAMPTZ;
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires TIMESTAMPTZ NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS webhook_updates (
+            update_id BIGINT PRIMARY KEY,
+            received TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS webhook_updates_received_idx ON webhook_updates (received);
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY,
+            text TEXT NOT NULL,
+            status VARCHAR(16) NOT NULL DEFAULT 'running',
+            chat_id BIGINT,
+            message_id BIGINT,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished TIMESTAMP
+        );
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id INTEGER NOT NULL REFERENCES broadcasts(id) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL,
+            status SMALLINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (broadcast_id, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS users_joined_idx ON users (joined);
+        CREATE INDEX IF NOT EXISTS users_active_idx ON users (id) WHERE active = TRUE;
+        CREATE TABLE IF NOT EXISTS user_stats_hourly (
+            hour TIMESTAMP PRIMARY KEY,
+            joins INTEGER NOT NULL DEFAULT 0,
+            reactivations INTEGER NOT NULL DEFAULT 0,
+            deactivations INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS user_stats_daily (
+            day DATE PRIMARY KEY,
+            joins INTEGER NOT NULL DEFAULT 0,
+            reactivations INTEGER NOT NULL DEFAULT 0,
+            deactivations INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS user_counters (
+            id SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+            total BIGINT NOT NULL DEFAULT 0,
+            active BIGINT NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS media_cache (
+            content_hash VARCHAR(64) PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE IF NOT EXISTS upscale_jobs (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            file_id TEXT NOT NULL,
+            file_unique_id TEXT NOT NULL,
+            file_size BIGINT,
+            status_message_id BIGINT,
+            priority SMALLINT NOT NULL DEFAULT 0,
+            state VARCHAR(16) NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker TEXT,
+            lease_until TIMESTAMPTZ,
+            run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
+            error TEXT,
+            created TIMESTAMPTZ NOT NULL DEFAULT now(),
+            started TIMESTAMPTZ,
+            finished TIMESTAMPTZ
+        );
+        CREATE INDEX IF NOT EXISTS upscale_jobs_queued_idx ON upscale_jobs (priority DESC, created)
+            WHERE state = 'queued';
+        CREATE INDEX IF NOT EXISTS upscale_jobs_running_idx ON upscale_jobs (lease_until)
+            WHERE state = 'running';
+        CREATE INDEX IF NOT EXISTS upscale_jobs_user_idx ON upscale_jobs (user_id)
+            WHERE state IN ('queued', 'running');
+        ALTER TABLE upscale_jobs ADD COLUMN IF NOT EXISTS upload_id TEXT;
+        ALTER TABLE upscale_jobs ALTER COLUMN file_id DROP NOT NULL;
+        CREATE TABLE IF NOT EXISTS channel_members (
+            channel_id TEXT NOT NULL,
+            user_id BIGINT NOT NULL,
+            status VARCHAR(16) NOT NULL,
+            subscribed BOOLEAN NOT NULL,
+            checked TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (channel_id, user_id)
+        );
+        -- Срок следующей сверки; уже проиндексированные записи получают случайный срок в ближайшие сутки,
+        -- чтобы после миграции их не перепроверяли все сразу
+        ALTER TABLE channel_members ADD COLUMN IF NOT EXISTS next_check TIMESTAMPTZ NOT NULL
+            DEFAULT now() + random() * interval '1 day';
+        DROP INDEX IF EXISTS channel_members_checked_idx;
+        -- Обход активных пользователей страницами при поиске тех, кого нет в индексе
+        CREATE INDEX IF NOT EXISTS users_active_joined_idx ON users (joined, id) WHERE active = TRUE;
+        CREATE INDEX IF NOT EXISTS channel_members_next_check_idx ON channel_members (channel_id, next_check);
+        CREATE INDEX IF NOT EXISTS channel_members_subscribed_idx ON channel_members (channel_id, user_id)
+            WHERE subscribed;
+        CREATE TABLE IF NOT EXISTS upscale_results (
+            cache_key TEXT PRIMARY KEY,
+            file_unique_id TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            created TIMESTAMPTZ NOT NULL DEFAULT now(),
+            last_hit TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """, name="init_db")
+    await db.run(_backfill_stats, name="init_db")
     logger.info("База данных инициализирована")
 
 
-def add_user(user_id: int, username: str = None, first_name: str = None):
-    """Добавление нового пользователя"""
-    conn = get_db()
-    cur = conn.cursor()
+def _backfill_stats(cur):
+    """Первичное заполнение счётчиков и роллапов по существующим пользователям (один раз)"""
+    cur.execute("""
+        INSERT INTO user_counters (id, total, active)
+        SELECT 1, COUNT(*), COUNT(*) FILTER (WHERE active) FROM users
+        ON CONFLICT (id) DO NOTHING
+    """)
+    if cur.rowcount == 0:
+        return
+    cur.execute("""
+        INSERT INTO user_stats_hourly (hour, joins)
+        SELECT date_trunc('hour', joined), COUNT(*) FROM users
+        WHERE joined IS NOT NULL GROUP BY 1
+        ON CONFLICT (hour) DO NOTHING
+    """)
+    cur.execute("""
+        INSERT INTO user_stats_daily (day, joins)
+        SELECT joined::date, COUNT(*) FROM users
+        WHERE joined IS NOT NULL GROUP BY 1
+        ON CONFLICT (day) DO NOTHING
+    """)
+    logger.info("Счётчики статистики заполнены по существующим пользователям")
+
+
+def _bump_stats(cur, joins: int = 0, reactivations: int = 0, deactivations: int = 0):
+    """Инкрементальное обновление роллапов и счётчиков в той же транзакции, что и запись"""
+    if not (joins or reactivations or deactivations):
+        return
+    params = (joins, reactivations, deactivations)
+    cur.execute("""
+        INSERT INTO user_stats_hourly AS s (hour, joins, reactivations, deactivations)
+        VALUES (date_trunc('hour', LOCALTIMESTAMP), %s, %s, %s)
+        ON CONFLICT (hour) DO UPDATE SET
+            joins = s.joins + EXCLUDED.joins,
+            reactivations = s.reactivations + EXCLUDED.reactivations,
+            deactivations = s.deactivations + EXCLUDED.deactivations
+    """, params)
     cur.execute("""
-        INSERT INTO users (id, username, first_name)
-        VALUES (%s, %s, %s)
-        ON CONFLICT (id) DO UPDATE SET
-            username = EXCLUDED.username,
-            first_name = EXCLUDED.first_name,
-            active = TRUE
-    """, (user_id, username, first_name))
-    conn.commit()
-    cur.close()
-    conn.close()
-
-
-def get_all_user_ids():
+        INSERT INTO user_stats_daily AS s (day, joins, reactivations, deactivations)
+        VALUES (CURRENT_DATE, %s, %s, %s)
+        ON CONFLICT (day) DO UPDATE SET
+            joins = s.joins + EXCLUDED.joins,
+            reactivations = s.reactivations + EXCLUDED.reactivations,
+            deactivations = s.deactivations + EXCLUDED.deactivations
+    """, params)
+    cur.execute(
+        "UPDATE user_counters SET total = total + %s, active = active + %s WHERE id = 1",
+        (joins, joins + reactivations - deactivations)
+    )
+
+
+async def _flush_users(rows: list):
+    """Пакетный upsert накопленных пользователей одним запросом"""
+    def _upsert_users(cur):
+        # prev видит состояние до вставки: по нему отличаем новых от вернувшихся
+        execute_values(cur, """
+            WITH input (id, username, first_name) AS (VALUES %s),
+            prev AS (
+                SELECT users.id, users.active FROM users JOIN input ON users.id = input.id
+            ),
+            upserted AS (
+                INSERT INTO users (id, username, first_name)
+                SELECT id, username, first_name FROM input
+                ON CONFLICT (id) DO UPDATE SET
+                    username = EXCLUDED.username,
+                    first_name = EXCLUDED.first_name,
+                    active = TRUE
+                RETURNING id
+            )
+            SELECT
+                COUNT(*) FILTER (WHERE prev.id IS NULL) AS joins,
+                COUNT(*) FILTER (WHERE prev.active = FALSE) AS reactivations
+            FROM upserted LEFT JOIN prev ON prev.id = upserted.id
+        """, rows, template="(%s::bigint, %s::varchar, %s::varchar)", page_size=len(rows))
+        counts = cur.fetchone()
+        _bump_stats(cur, joins=counts['joins'], reactivations=counts['reactivations'])
+
+    await db.run(_upsert_users, name="add_user")
+
+
+user_writes = WriteBehindBuffer(
+    _flush_users,
+    name="users",
+    batch_size=int(os.getenv("USER_BATCH_SIZE", "500")),
+    flush_interval=float(os.getenv("USER_FLUSH_INTERVAL", "1")),
+    max_pending=int(os.getenv("USER_MAX_PENDING", "10000")),
+)
+
+
+async def add_user(user_id: int, username: str = None, first_name: str = None):
+    """Добавление нового пользователя (запись откладывается и объединяется в пакет)"""
+    await user_writes.put(user_id, (user_id, username, first_name))
+
+
+async def get_all_user_ids():
     """Получение всех ID активных пользователей"""
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM users WHERE active = TRUE")
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+    rows = await db.fetchall("SELECT id FROM users WHERE active = TRUE", name="get_all_user_ids")
     return [row['id'] for row in rows]
 
 
-def mark_inactive(user_id: int):
-    """Пометить пользователя как неактивного"""
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET active = FALSE WHERE id = %s", (user_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
+async def _flush_status(rows: list):
+    """Пакетная смена активности пользователей; более раннее событие не перетирает более позднее"""
+    def _update_status(cur):
+        execute_values(cur, """
+            WITH input (id, active, changed) AS (VALUES %s),
+            prev AS (
+                SELECT users.id, users.active FROM users JOIN input ON users.id = input.id
+            ),
+            updated AS (
+                UPDATE users SET active = input.active, status_changed = input.changed
+                FROM input
+                WHERE users.id = input.id
+                  AND (users.status_changed IS NULL OR users.status_changed <= input.changed)
+                RETURNING users.id, users.active
+            )
+            SELECT
+                COUNT(*) FILTER (WHERE updated.active AND NOT prev.active) AS reactivations,
+                COUNT(*) FILTER (WHERE NOT updated.active AND prev.active) AS deactivations
+            FROM updated JOIN prev ON prev.id = updated.id
+        """, rows, template="(%s::bigint, %s::boolean, %s::timestamptz)", page_size=len(rows))
+        counts = cur.fetchone()
+        _bump_stats(cur, reactivations=counts['reactivations'], deactivations=counts['deactivations'])
 
+    await db.run(_update_status, name="user_status")
 
-def get_stats():
-    """Получение статистики"""
-    conn = get_db()
-    cur = conn.cursor()
-    
-    cur.execute("SELECT COUNT(*) as total FROM users")
-    total = cur.fetchone()['total']
-    
-    cur.execute("SELECT COUNT(*) as active FROM users WHERE active = TRUE")
-    active = cur.fetchone()['active']
-    
-    day_ago = datetime.now() - timedelta(hours=24)
-    cur.execute("SELECT COUNT(*) as new_24h FROM users WHERE joined > %s", (day_ago,))
-    new_24h = cur.fetchone()['new_24h']
-    
-    cur.close()
-    conn.close()
-    
-    return {"total": total, "new_24h": new_24h, "active": active}
 
+status_writes = WriteBehindBuffer(_flush_status, name="user_status", batch_size=500, flush_interval=2)
 
-def export_users():
-    """Экспорт всех пользователей"""
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT id, username, first_name, joined, active FROM users ORDER BY joined DESC")
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    return rows
 
+async def set_user_active(user_id: int, active: bool, changed: datetime = None):
+    """Сменить активность пользователя (запись объединяется в пакет, побеждает последнее событие)"""
+    await status_writes.put(user_id, (user_id, active, changed or datetime.now(timezone.utc)))
 
-async def check_subscription(user_id: int) -> tuple[bool, str]:
-    """Проверка подписки. Возвращает (True/False, ошибка)."""
-    if not CHANNEL_ID:
-        logger.warning("CHANNEL_ID не установлен")
-        return True, ""
-        
+
+async def mark_inactive(user_id: int):
+    """Пометить пользователя как неактивного (например, по ошибке рассылки)"""
+    await set_user_active(user_id, False)
+
+
+broadcasts = BroadcastEngine(
+    bot,
+    db,
+    on_blocked=mark_inactive,
+    rate=float(os.getenv("BROADCAST_RATE", "28")),
+    concurrency=int(os.getenv("BROADCAST_CONCURRENCY", "20")),
+)
+
+
+async def get_stats(days: int = 7):
+    """Получение статистики из счётчиков и роллапов (без сканирования users)"""
+    def _get_stats(cur):
+        cur.execute("SELECT total, active FROM user_counters WHERE id = 1")
+        counters = cur.fetchone() or {"total": 0, "active": 0}
+
+        cur.execute("""
+            SELECT COALESCE(SUM(joins), 0) AS new_24h FROM user_stats_hourly
+            WHERE hour > date_trunc('hour', LOCALTIMESTAMP) - INTERVAL '24 hours'
+        """)
+        new_24h = cur.fetchone()['new_24h']
+
+        cur.execute("""
+            SELECT day, joins, reactivations, deactivations FROM user_stats_daily
+            WHERE day > CURRENT_DATE - %s ORDER BY day
+        """, (days,))
+        history = cur.fetchall()
+
+        return {
+            "total": counters['total'],
+            "new_24h": new_24h,
+            "active": counters['active'],
+            "history": history,
+        }
+
+    return await db.run(_get_stats, name="get_stats")
+
+
+def format_histogram(history: list, days: int, width: int = 16) -> str:
+    """Текстовая гистограмма новых пользователей по дням"""
+    by_day = {row['day']: row['joins'] for row in history}
+    today = datetime.now().date()
+    series = [(today - timedelta(days=i), by_day.get(today - timedelta(days=i), 0)) for i in reversed(range(days))]
+    peak = max((joins for _, joins in series), default=0) or 1
+    return "\n".join(
+        f"{day.strftime('%d.%m')} {'█' * round(joins / peak * width):<{width}} {joins}"
+        for day, joins in series
+    )
+
+
+media = MediaCache(bot, db, cache_dir=os.getenv("MEDIA_CACHE_DIR", ".cache/media"))
+
+
+REGISTRY.gauge("db_pool_in_use", "Занятые соединения пула БД", callback=lambda: db.snapshot()["in_use"])
+REGISTRY.gauge("subscription_cache_size", "Записей в кэше подписок", callback=lambda: len(subscription_cache))
+REGISTRY.gauge("write_behind_pending", "Записей в буферах отложенной записи", labels=("buffer",),
+               callback=lambda: {user_writes.name: len(user_writes), status_writes.name: len(status_writes)})
+REGISTRY.gauge("updates_active", "Апдейтов в обработке", callback=lambda: admission.active)
+REGISTRY.gauge("updates_pending", "Апдейтов в очереди ожидания", callback=lambda: admission.queue_depth)
+REGISTRY.gauge("broadcasts_running", "Идущих рассылок", callback=lambda: len(broadcasts.running))
+REGISTRY.gauge("upscales_running", "Видео в обработке в этом процессе", callback=lambda: upscale_queue.active)
+
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "5000"))
+
+
+async def export_users(out, active_only: bool = False, since: datetime = None, compress: bool = False) -> int:
+    """Потоковый экспорт пользователей в CSV (server-side курсор, чтение чанками)"""
+    conditions, params = [], []
+    if active_only:
+        conditions.append("active = TRUE")
+    if since:
+        conditions.append("joined >= %s")
+        params.append(since)
+    query = "SELECT id, username, first_name, joined, active FROM users"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY joined DESC"
+
+    def _export_users(cur):
+        with cur.connection.cursor(name="export_users") as stream:
+            stream.itersize = EXPORT_CHUNK_SIZE
+            stream.execute(query, params)
+            return write_users_csv(out, stream, compress=compress)
+
+    return await db.run(_export_users, name="export_users")
+
+
+subscription_cache = TTLCache(maxsize=int(os.getenv("SUB_CACHE_SIZE", "100000")), name="subscriptions")
+SUB_CACHE_TTL = float(os.getenv("SUB_CACHE_TTL", "600"))
+SUB_CACHE_NEGATIVE_TTL = float(os.getenv("SUB_CACHE_NEGATIVE_TTL", "20"))
+
+
+def _subscription_ttl(result: tuple[bool, str]) -> float:
+    """Срок жизни ответа в кэше: ошибки не кэшируем, отказ живёт меньше подписки"""
+    is_sub, error = result
+    if error:
+        return 0
+    return SUB_CACHE_TTL if is_sub else SUB_CACHE_NEGATIVE_TTL
+
+
+subscription_index = SubscriptionIndex(
+    bot, db, CHANNEL_ID or "",
+    max_age=float(os.getenv("SUB_INDEX_MAX_AGE", "86400")),
+    rate=float(os.getenv("SUB_RECONCILE_RATE", "5")),
+    concurrency=int(os.getenv("SUB_RECONCILE_CONCURRENCY", "5")),
+)
+
+
+async def fetch_subscription(user_id: int, trust_negative: bool = True) -> tuple[bool, str]:
+    """Статус подписки из индекса channel_members, при его отсутствии — у Telegram"""
     try:
-        member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-        is_sub = member.status in ["creator", "administrator", "member", "restricted"]
-        return is_sub, ""
+        row = await subscription_index.lookup(user_id)
+        if row is not None and (row["subscribed"] or trust_negative):
+            return row["subscribed"], ""
+    except Exception as e:
+        logger.warning(f"Индекс подписок недоступен: {e}")
+
+    try:
+        status = await subscription_index.fetch(user_id)
+        return is_member(status), ""
     except Exception as e:
         logger.error(f"Ошибка проверки подписки для {user_id}: {e}")
         return False, str(e)
 
 
-@dp.callback_query(F.data == "check_subscription")
+async def check_subscription(user_id: int, trust_negative: bool = True) -> tuple[bool, str]:
+    """
+    Проверка подписки. Возвращает (True/False, ошибка).
+    trust_negative=False — отказ из индекса перепроверяется у Telegram (кнопка «Проверить подписку»).
+    """
+    if not CHANNEL_ID:
+        logger.warning("CHANNEL_ID не установлен")
+        return True, ""
+
+    key = (CHANNEL_ID, user_id)
+    if not trust_negative:
+        cached = subscription_cache.get(key)
+        if cached is not None and not cached[0]:
+            subscription_cache.invalidate(key)
+    return await subscription_cache.get_or_load(
+        key,
+        lambda: fetch_subscription(user_id, trust_negative),
+        ttl=_subscription_ttl
+    )
+
+
+@dp.chat_member()
+async def on_chat_member(event: ChatMemberUpdated):
+    """Обновление индекса и кэша подписки при изменении статуса участника канала"""
+    if not CHANNEL_ID or not await subscription_index.on_event(event):
+        return
+    result = (is_member(event.new_chat_member.status), "")
+    subscription_cache.set((CHANNEL_ID, event.new_chat_member.user.id), result, _subscription_ttl(result))
+
+
+@dp.my_chat_member(F.chat.type == "private")
+async def on_my_chat_member(event: ChatMemberUpdated):
+    """Пользователь заблокировал или разблокировал бота — активность меняется сразу, а не по ошибке рассылки"""
+    status = event.new_chat_member.status
+    if status in ("kicked", "left"):
+        await set_user_active(event.from_user.id, False, event.date)
+    elif status == "member":
+        await set_user_active(event.from_user.id, True, event.date)
+
+
+@dp.callback_query(F.data == "check_subscription", flags={"throttling": {"limit": 3, "window": 10}})
 async def callback_check_subscription(callback: CallbackQuery):
     """Обработчик кнопки проверки подписки"""
-    is_subscribed, error = await check_subscription(callback.from_user.id)
+    is_subscribed, error = await check_subscription(callback.from_user.id, trust_negative=False)
     
     if is_subscribed:
         await callback.message.delete()
@@ -163,7 +600,7 @@ async def callback_check_subscription(callback: CallbackQuery):
         await callback.answer(text, show_alert=True)
 
 
-@dp.message(Command("start"))
+@dp.message(Command("start"), flags={"throttling": {"limit": 3, "window": 10}})
 async def cmd_start(message: Message):
     """Обработчик команды /start"""
     # Проверка подписки
@@ -186,15 +623,16 @@ async def cmd_start(message: Message):
              caption += f"\n\n⚠️ <b>System Error:</b> {error}"
 
         
-        photo_path = "public/subscribe_banner.jpg"
-        if os.path.exists(photo_path):
-            photo = FSInputFile(photo_path)
-            await message.answer_photo(photo, caption=caption, reply_markup=builder.as_markup(), parse_mode="HTML")
+        if os.path.exists(BANNER_PATH):
+            await media.send_photo(
+                message.chat.id, BANNER_PATH,
+                caption=caption, reply_markup=builder.as_markup(), parse_mode="HTML"
+            )
         else:
             await message.answer(caption, reply_markup=builder.as_markup(), parse_mode="HTML")
         return
 
-    add_user(
+    await add_user(
         message.from_user.id,
         message.from_user.username,
         message.from_user.first_name
@@ -203,7 +641,7 @@ async def cmd_start(message: Message):
     builder = InlineKeyboardBuilder()
     builder.button(
         text="🎬 Улучшить видео",
-        web_app=WebAppInfo(url=WEBAPP_URL)
+        web_app=WebAppInfo(url=webapp_url())
     )
     
     await message.answer(
@@ -237,12 +675,59 @@ async def cmd_stats(message: Message):
     if ADMIN_ID and message.from_user.id != ADMIN_ID:
         return
     
-    stats = get_stats()
+    # /stats [7|30] — глубина гистограммы в днях
+    args = (message.text or "").split()[1:]
+    days = 30 if args and args[0] == "30" else 7
+
+    stats = await get_stats(days)
+    pool = db.snapshot()
+    subs = subscription_cache.snapshot()
+    index = subscription_index.snapshot()
+    flood = throttling.snapshot()
+    load = admission.snapshot()
+    upscales = upscaler.snapshot()
+    results = result_cache.snapshot()
+    scratch = stager.snapshot()
+    uploads = upload_store.snapshot()
     await message.answer(
         f"📊 <b>Статистика бота</b>\n\n"
         f"👥 Всего в базе: <b>{stats['total']}</b>\n"
         f"📈 Новых за 24 часа: <b>{stats['new_24h']}</b>\n"
-        f"✅ Активных: <b>{stats['active']}</b>",
+        f"✅ Активных: <b>{stats['active']}</b>\n\n"
+        f"📅 Новые за {days} дн.:\n<pre>{format_histogram(stats['history'], days)}</pre>\n"
+        f"🗄 Пул БД: {pool['in_use']}/{pool['size']}, "
+        f"ожидание {pool['wait_avg'] * 1000:.1f} мс (макс {pool['wait_max'] * 1000:.0f}), "
+        f"запрос {pool['query_avg'] * 1000:.1f} мс (макс {pool['query_max'] * 1000:.0f}), "
+        f"таймаутов {pool['timeouts']}\n"
+        f"🔎 Кэш подписок: {subs['size']} записей, "
+        f"попаданий {subs['hits']}, промахов {subs['misses']}, "
+        f"объединено {subs['coalesced']} ({subs['hit_rate']:.0%})\n"
+        f"📇 Индекс подписок: из БД {index['index_hits']} ({index['hit_rate']:.0%}), "
+        f"запросов к Telegram {index['live']}, событий {index['events']}, "
+        f"сверено {index['reconciled']} (ошибок {index['reconcile_errors']})\n"
+        f"🛡 Антифлуд: отклонено {flood['throttled']}, объединено нажатий {flood['merged']}, "
+        f"отслеживается {flood['tracked']}\n"
+        f"🚦 Нагрузка: в работе {load['active']}/{load['limit']}, в очереди {load['pending']}, "
+        f"сброшено {load['shed_full'] + load['shed_timeout'] + load['shed_evicted']}\n"
+        f"📨 Рассылки: отправлено {BROADCAST_MESSAGES.value(status='sent'):.0f}, "
+        f"ошибок {BROADCAST_MESSAGES.value(status='failed') + BROADCAST_MESSAGES.value(status='blocked'):.0f}, "
+        f"ошибок Bot API {sum(value for _, value in TELEGRAM_ERRORS.items()):.0f}\n"
+        f"🎬 Апскейл: в работе {upscale_queue.active}, готово {upscales['jobs']}, ошибок {upscales['failed']}, "
+        f"в среднем {upscales['avg_seconds']:.0f} с на {upscales['workers']} процессах\n"
+        f"♻️ Кэш результатов: попаданий {results['hits']}, промахов {results['misses']} "
+        f"({results['hit_rate']:.0%}), локально {results['files']} файлов, "
+        f"{results['bytes'] / 1024 ** 2:.0f} МБ\n"
+        f"💾 Scratch: занято {scratch['reserved'] / 1024 ** 2:.0f}/{scratch['quota'] / 1024 ** 2:.0f} МБ, "
+        f"задач {scratch['active']}, ждали места {scratch['waited']}, "
+        f"загружено {scratch['bytes'] / 1024 ** 2:.0f} МБ\n"
+        f"📥 Загрузки из Mini App: идёт {uploads['uploading']}, ждут обработки {uploads['queued']}, "
+        f"занято {uploads['reserved'] / 1024 ** 2:.0f}/{uploads['quota'] / 1024 ** 2:.0f} МБ, "
+        f"чанков {uploads['chunks']}, возобновлено {uploads['resumed']}, "
+        f"неверных сумм {uploads['bad_checksum']}\n\n"
+        f"⏱ Задержки (кол-во, p50, p95 мс):\n"
+        f"<pre>{html.escape(latency_table(HANDLER_LATENCY, 'handler'))}</pre>\n"
+        f"<pre>{html.escape(latency_table(TELEGRAM_LATENCY, 'method'))}</pre>\n"
+        f"<pre>{html.escape(latency_table(DB_QUERY_LATENCY, 'query'))}</pre>",
         parse_mode="HTML"
     )
 
@@ -253,24 +738,31 @@ async def cmd_export(message: Message):
     if ADMIN_ID and message.from_user.id != ADMIN_ID:
         return
     
+    # /export [active] [since=YYYY-MM-DD] [gzip]
+    args = (message.text or "").split()[1:]
+    active_only = "active" in args
+    compress = "gzip" in args or "gz" in args
+    since = None
     try:
-        users = export_users()
-        
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerow(['ID', 'Username', 'Name', 'Joined', 'Active'])
-        for user in users:
-            writer.writerow([
-                user['id'],
-                user['username'] or '',
-                user['first_name'] or '',
-                user['joined'],
-                user['active']
-            ])
-        
-        csv_bytes = output.getvalue().encode('utf-8')
-        file = BufferedInputFile(csv_bytes, filename=f"users_{datetime.now().strftime('%Y%m%d')}.csv")
-        await message.answer_document(file, caption=f"📁 База пользователей ({len(users)} записей)")
+        for arg in args:
+            if arg.startswith("since="):
+                since = datetime.strptime(arg.split("=", 1)[1], "%Y-%m-%d")
+    except ValueError:
+        await message.answer(
+            "Использование:\n"
+            "<code>/export [active] [since=ГГГГ-ММ-ДД] [gzip]</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    try:
+        with spooled_file() as out:
+            count = await export_users(out, active_only=active_only, since=since, compress=compress)
+            filename = f"users_{datetime.now().strftime('%Y%m%d')}.csv" + (".gz" if compress else "")
+            await message.answer_document(
+                SpooledInputFile(out, filename=filename),
+                caption=f"📁 База пользователей ({count} записей)"
+            )
     except Exception as e:
         await message.answer(f"❌ Ошибка: {e}")
 
@@ -282,55 +774,327 @@ async def cmd_broadcast(message: Message):
         return
     
     text = message.text.replace("/broadcast", "").strip()
+    # --subs — только подписчикам канала (по индексу channel_members, без запросов к Telegram)
+    subscribers_only = text.startswith("--subs")
+    if subscribers_only:
+        text = text[len("--subs"):].strip()
     
     if not text:
         await message.answer(
             "📢 <b>Рассылка</b>\n\n"
             "Использование:\n"
-            "<code>/broadcast Ваше сообщение</code>",
+            "<code>/broadcast Ваше сообщение</code>\n"
+            "<code>/broadcast --subs Сообщение только подписчикам канала</code>",
             parse_mode="HTML"
         )
         return
+    if subscribers_only and not CHANNEL_ID:
+        await message.answer("❌ CHANNEL_ID не задан — рассылать подписчикам некому.")
+        return
     
-    user_ids = get_all_user_ids()
-    sent = 0
-    failed = 0
-    
-    status_msg = await message.answer(f"📤 Рассылка... 0/{len(user_ids)}")
-    
-    for i, user_id in enumerate(user_ids):
-        try:
-            await bot.send_message(user_id, text, parse_mode="HTML")
-            sent += 1
-        except Exception as e:
-            failed += 1
-            if "blocked" in str(e).lower() or "deactivated" in str(e).lower():
-                mark_inactive(user_id)
-        
-        if (i + 1) % 20 == 0:
-            await status_msg.edit_text(f"📤 Рассылка... {i+1}/{len(user_ids)}")
-        
-        await asyncio.sleep(0.05)
-    
-    await status_msg.edit_text(
-        f"✅ <b>Рассылка завершена!</b>\n\n"
-        f"📨 Отправлено: {sent}\n"
-        f"❌ Не доставлено: {failed}",
-        parse_mode="HTML"
+    status_msg = await message.answer("📤 Рассылка запускается...")
+    job_id, total = await broadcasts.start(
+        text, status_msg.chat.id, status_msg.message_id,
+        subscribers_of=CHANNEL_ID if subscribers_only else None,
+    )
+    await status_msg.edit_text(f"📤 Рассылка #{job_id}... 0/{total}")
+
+
+# Облачный Bot API отдаёт боту файлы до 20 МБ и принимает до 50 МБ;
+# с локальным telegram-bot-api (TELEGRAM_API_URL, TELEGRAM_API_LOCAL=1) лимиты можно поднять до 2000 МБ
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_MB", "50")) * 1024 * 1024
+PROGRESS_INTERVAL = 3.0
+
+stager = VideoStager(
+    bot,
+    root=os.getenv("UPSCALE_DIR", ".cache/upscale"),
+    max_file_size=int(os.getenv("MAX_VIDEO_MB", "20")) * 1024 * 1024,
+    quota=int(os.getenv("SCRATCH_QUOTA_MB", "10240")) * 1024 * 1024,
+    concurrency=int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "2")),
+)
+
+upscaler = UpscalePipeline(
+    workers=int(os.getenv("UPSCALE_WORKERS", "0")) or None,
+    segment_seconds=float(os.getenv("UPSCALE_SEGMENT_SECONDS", "10")),
+    factor=float(os.getenv("UPSCALE_FACTOR", "2")),
+    max_side=int(os.getenv("UPSCALE_MAX_SIDE", "1920")),
+    crf=int(os.getenv("UPSCALE_CRF", "20")),
+    preset=os.getenv("UPSCALE_PRESET", "veryfast"),
+    timeout_ratio=float(os.getenv("UPSCALE_TIMEOUT_RATIO", "30")),
+)
+result_cache = ResultCache(
+    bot, db,
+    cache_dir=os.getenv("RESULT_CACHE_DIR", ".cache/results"),
+    max_bytes=int(os.getenv("RESULT_CACHE_MAX_MB", "2048")) * 1024 * 1024,
+    max_age=float(os.getenv("RESULT_CACHE_MAX_AGE_DAYS", "7")) * 86400,
+)
+
+
+class UserFacingError(Exception):
+    """Ошибка обработки, текст которой показывается пользователю; повтор не поможет"""
+
+
+async def edit_status(job: dict, text: str):
+    """Правка сообщения о ходе обработки; ошибки правки не мешают обработке"""
+    if not job["status_message_id"]:
+        return
+    try:
+        await bot.edit_message_text(text, chat_id=job["chat_id"], message_id=job["status_message_id"])
+    except (TelegramBadRequest, TelegramForbiddenError) as e:
+        logger.debug(f"Не удалось обновить статус: {e}")
+
+
+async def delete_status(job: dict):
+    """Удаление сообщения о ходе обработки; результат уже отправлен, поэтому ошибка не валит задачу"""
+    if not job["status_message_id"]:
+        return
+    try:
+        await bot.delete_message(job["chat_id"], job["status_message_id"])
+    except (TelegramBadRequest, TelegramForbiddenError) as e:
+        logger.debug(f"Не удалось удалить статус: {e}")
+
+
+async def send_cached_result(chat_id: int, file_unique_id: str, count: bool = True) -> bool:
+    """Ответить готовым результатом из кэша, если это видео уже обрабатывали с теми же параметрами"""
+    row = await result_cache.get(result_cache.key(file_unique_id, upscaler.signature), count=count)
+    if row is None:
+        return False
+    message = await result_cache.send(
+        chat_id,
+        row,
+        width=row["width"],
+        height=row["height"],
+        caption=f"✅ Готово: {row['width']}×{row['height']}",
+        supports_streaming=True,
     )
+    return message is not None
+
+
+async def process_video(job: dict):
+    """Задача очереди: скачать видео, прогнать через апскейл и отправить результат"""
+    last_edit = 0.0
+
+    async def report(done: int, total: int):
+        nonlocal last_edit
+        now = asyncio.get_running_loop().time()
+        if done < total and now - last_edit < PROGRESS_INTERVAL:
+            return
+        last_edit = now
+        await edit_status(job, f"⚙️ Апскейл: {done}/{total} фрагментов ({done * 100 // total}%)")
+
+    try:
+        # Дубликат мог встать в очередь, пока первая копия ещё обрабатывалась;
+        # промах здесь уже посчитан при приёме видео
+        if await send_cached_result(job["chat_id"], job["file_unique_id"], count=False):
+            await delete_status(job)
+            if job["upload_id"]:
+                upload_store.discard(job["upload_id"])
+            return
+
+        if job["upload_id"]:
+            staged = stager.local(upload_store.path(job["upload_id"]), prefix="upload-")
+        else:
+            await edit_status(job, "⬇️ Загружаю видео...")
+            # Файл пишется на диск потоком; ffmpeg читает его по пути, в память он целиком не попадает
+            staged = stager.staged(job["file_id"], job["file_size"], prefix=f"{job['file_unique_id']}-")
+        async with staged as (workdir, source):
+            result = os.path.join(workdir, "result.mp4")
+            try:
+                size = await upscaler.run(source, result, report)
+            except UpscaleTimeout:
+                # Зависший ffmpeg убит; ошибка не в fatal, задачу повторит очередь
+                raise
+            except UpscaleError as e:
+                raise UserFacingError("❌ Не удалось обработать это видео.") from e
+            if size is None:
+                raise UserFacingError("ℹ️ Видео уже в максимальном разрешении.")
+            if os.path.getsize(result) > MAX_UPLOAD_SIZE:
+                raise UserFacingError(
+                    f"❌ Результат больше {MAX_UPLOAD_SIZE // 1024 ** 2} МБ — отправьте видео покороче."
+                )
+
+            await edit_status(job, "📤 Отправляю результат...")
+            sent = await bot.send_video(
+                job["chat_id"],
+                FSInputFile(result, filename="upscaled.mp4"),
+                width=size[0],
+                height=size[1],
+                caption=f"✅ Готово: {size[0]}×{size[1]}",
+                supports_streaming=True,
+            )
+            await result_cache.put(
+                result_cache.key(job["file_unique_id"], upscaler.signature),
+                job["file_unique_id"], sent.video.file_id, size, result,
+            )
+        await delete_status(job)
+        if job["upload_id"]:
+            upload_store.discard(job["upload_id"])
+    except TelegramForbiddenError:
+        # Пользователь заблокировал бота: повтор только заново прогнал бы апскейл (ошибка в fatal)
+        await mark_inactive(job["user_id"])
+        raise
+    except FileTooLarge as e:
+        raise UserFacingError(f"❌ Видео слишком большое: {e}.") from e
+    except FileNotFoundError as e:
+        # Загрузку удалили по сроку или она лежит на диске другого хоста
+        raise UserFacingError("❌ Загруженный файл не найден, загрузите видео заново.") from e
+    except asyncio.CancelledError:
+        await edit_status(job, "⏸ Обработка прервана перезапуском, продолжится автоматически.")
+        raise
+
+
+async def on_job_failed(job: dict, error: str):
+    """Задача окончательно не выполнена — сообщаем пользователю"""
+    if job["upload_id"]:
+        upload_store.discard(job["upload_id"])
+    if job["status_message_id"]:
+        text = error if error.startswith(("❌", "ℹ️")) else "❌ Ошибка обработки, попробуйте позже."
+        await edit_status(job, text)
+
+
+upscale_queue = JobQueue(
+    db,
+    process_video,
+    on_failed=on_job_failed,
+    fatal=(UserFacingError, TelegramForbiddenError),
+    concurrency=int(os.getenv("UPSCALE_JOB_WORKERS", "2")),
+    lease=float(os.getenv("UPSCALE_JOB_LEASE", "120")),
+    max_attempts=int(os.getenv("UPSCALE_JOB_ATTEMPTS", "3")),
+    per_user_running=int(os.getenv("UPSCALE_USER_RUNNING", "1")),
+    per_user_queued=int(os.getenv("UPSCALE_USER_QUEUED", "3")),
+)
+
+
+upload_store = UploadStore(
+    root=os.getenv("UPLOAD_DIR", ".cache/uploads"),
+    # Больше, чем бот может отправить, загружать бессмысленно: результат апскейла всё равно не уйдёт
+    max_size=min(int(os.getenv("UPLOAD_MAX_MB", "2000")) * 1024 * 1024, MAX_UPLOAD_SIZE),
+    chunk_size=int(os.getenv("UPLOAD_CHUNK_MB", "8")) * 1024 * 1024,
+    quota=int(os.getenv("UPLOAD_QUOTA_MB", "10240")) * 1024 * 1024,
+    per_user=int(os.getenv("UPLOAD_USER_ACTIVE", "2")),
+    ttl=float(os.getenv("UPLOAD_TTL_HOURS", "24")) * 3600,
+)
+
+
+def uploads_enabled() -> bool:
+    return bool(UPLOAD_URL) and upscaler.available
+
+
+def webapp_url() -> str:
+    """Адрес Mini App; при включённых загрузках в него передаётся адрес эндпоинта загрузки"""
+    if not uploads_enabled():
+        return WEBAPP_URL
+    separator = "&" if "?" in WEBAPP_URL else "?"
+    return f"{WEBAPP_URL}{separator}upload={quote(UPLOAD_URL, safe='')}"
+
+
+async def upload_allowed(user_id: int) -> bool:
+    subscribed, _ = await check_subscription(user_id)
+    return subscribed
+
+
+async def handle_upload(upload: dict) -> dict:
+    """Загрузка из Mini App завершена: готовый результат из кэша или задача в очереди апскейла"""
+    chat_id = upload["user_id"]
+    # Ключ по содержимому: повторно загруженное то же видео отвечается из кэша результатов
+    file_unique_id = f"upload:{upload['sha256']}"
+    try:
+        if await send_cached_result(chat_id, file_unique_id):
+            return {"state": "done"}
+        status = await bot.send_message(chat_id, "⏳ Видео загружено, ставлю в очередь...")
+    except TelegramForbiddenError as e:
+        raise UploadError("разблокируйте бота и повторите", 403) from e
+
+    try:
+        job = await upscale_queue.enqueue(
+            upload["user_id"],
+            chat_id,
+            None,
+            file_unique_id,
+            file_size=upload["size"],
+            status_message_id=status.message_id,
+            priority=1 if upload["user_id"] == ADMIN_ID else 0,
+            upload_id=upload["id"],
+        )
+    except QueueFull as e:
+        # Файл остаётся на диске: Mini App повторит завершение, когда очередь освободится
+        await status.delete()
+        raise UploadError(f"дождитесь обработки предыдущих видео: {e}", 429) from e
+    await status.edit_text(f"⏳ Видео в очереди, позиция {job['position']}.")
+    return {"state": "queued", "position": job["position"]}
+
+
+upload_server = UploadServer(
+    upload_store,
+    BOT_TOKEN,
+    handle_upload,
+    authorize=upload_allowed,
+    path=UPLOAD_PATH,
+    cors_origin=os.getenv("UPLOAD_CORS_ORIGIN", "*"),
+)
 
 
 @dp.message(F.video)
 async def handle_video(message: Message):
-    """Обработчик видео"""
-    builder = InlineKeyboardBuilder()
-    builder.button(
-        text="🎬 Открыть апскейлер",
-        web_app=WebAppInfo(url=WEBAPP_URL)
-    )
+    """Обработчик видео: очередь апскейла на сервере, без ffmpeg или для больших файлов — Mini App"""
+    too_large = (message.video.file_size or 0) > stager.max_file_size
+    if not upscaler.available or too_large:
+        builder = InlineKeyboardBuilder()
+        builder.button(
+            text="🎬 Открыть апскейлер",
+            web_app=WebAppInfo(url=webapp_url())
+        )
+        await message.answer(
+            "📹 Видео нужно загрузить через апскейлер.\nНажмите кнопку ниже:",
+            reply_markup=builder.as_markup()
+        )
+        return
+
+    if await send_cached_result(message.chat.id, message.video.file_unique_id):
+        return
+
+    status = await message.answer("⏳ Видео принято, ставлю в очередь...")
+    try:
+        job = await upscale_queue.enqueue(
+            message.from_user.id,
+            message.chat.id,
+            message.video.file_id,
+            message.video.file_unique_id,
+            file_size=message.video.file_size,
+            status_message_id=status.message_id,
+            priority=1 if message.from_user.id == ADMIN_ID else 0,
+        )
+    except QueueFull as e:
+        await status.edit_text(f"⏳ Дождитесь обработки предыдущих видео: {e}.")
+        return
+    await status.edit_text(f"⏳ Видео в очереди, позиция {job['position']}.")
+
+
+@dp.message(Command("queue"))
+async def cmd_queue(message: Message):
+    """Состояние очереди апскейла (только для админа)"""
+    if ADMIN_ID and message.from_user.id != ADMIN_ID:
+        return
+
+    overview = await upscale_queue.overview()
+    states = overview["states"]
+    users = "\n".join(f"{row['user_id']}: {row['n']}" for row in overview["users"]) or "—"
+    running = "\n".join(
+        f"#{row['id']} {row['user_id']} {row['worker']} {row['running_for']:.0f} с, "
+        f"аренда {row['lease_left']:.0f} с, попытка {row['attempts']}"
+        for row in overview["running"]
+    ) or "—"
+    local = upscale_queue.snapshot()
     await message.answer(
-        "📹 Видео нужно загрузить через апскейлер.\nНажмите кнопку ниже:",
-        reply_markup=builder.as_markup()
+        f"🎬 <b>Очередь апскейла</b>\n\n"
+        f"В очереди: <b>{states.get('queued', 0)}</b>, старейшая ждёт {overview['oldest']:.0f} с\n"
+        f"В работе: <b>{states.get('running', 0)}</b>\n"
+        f"За 24 часа: готово {states.get('done', 0)}, ошибок {states.get('failed', 0)}\n"
+        f"Этот процесс: {local['active']}/{local['concurrency']}, повторов {local['retried']}, "
+        f"возвращено по аренде {local['reaped']}\n\n"
+        f"Больше всего в очереди:\n<pre>{html.escape(users)}</pre>\n"
+        f"В работе:\n<pre>{html.escape(running)}</pre>",
+        parse_mode="HTML"
     )
 
 
@@ -349,6 +1113,17 @@ async def check_bot_admin_status():
     except Exception as e:
         logger.critical(f"⚠️ Ошибка проверки прав бота в канале {CHANNEL_ID}: {e}. Убедитесь, что ID правильный и бот добавлен в канал.")
 
+def webhook_secret() -> str:
+    """
+    Секрет вебхука: без него любой может прислать апдейт от имени админа.
+    Если WEBHOOK_SECRET не задан, он выводится из токена — одинаковый на всех репликах,
+    иначе каждая реплика при set_webhook перетирала бы секрет остальных.
+    """
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    return hmac.new(BOT_TOKEN.encode(), b"webhook-secret", hashlib.sha256).hexdigest()
+
+
 async def main():
     """Запуск бота"""
     logger.info("🚀 Starting Upscaler Video Bot...")
@@ -363,25 +1138,104 @@ async def main():
 
     # 2. Пробуем подключиться к БД
     try:
-        init_db()
+        await db.open()
+        await init_db()
+        user_writes.start()
+        status_writes.start()
+        await broadcasts.resume()
+        if CHANNEL_ID:
+            subscription_index.start()
         logger.info("✅ Database connected successfully")
     except Exception as e:
         logger.critical(f"❌ DATABASE ERROR: {e}")
         return # Без базы работать нельзя
-    
-    # 3. Проверка прав
+
+    # 3. Остальная подготовка: сбой любого шага не мешает запуску бота
+    if upscaler.available:
+        try:
+            # До запуска очереди, чтобы не удалить каталоги её воркеров
+            stager.cleanup()
+        except Exception as e:
+            logger.warning(f"⚠️ Scratch cleanup failed: {e}")
+        upscale_queue.start()
+        try:
+            await result_cache.evict()
+        except Exception as e:
+            logger.warning(f"⚠️ Result cache eviction failed: {e}")
+    if uploads_enabled():
+        try:
+            upload_server.start()
+        except Exception as e:
+            logger.error(f"⚠️ Upload store load failed: {e}")
+    if os.path.exists(BANNER_PATH):
+        try:
+            await media.prepare(BANNER_PATH)
+        except Exception as e:
+            # send_photo подготовит баннер сам при первой отправке
+            logger.warning(f"⚠️ Banner preparation failed: {e}")
+
+    # 4. Проверка прав
     try:
         await check_bot_admin_status()
     except Exception as e:
          logger.error(f"⚠️ Admin check failed: {e}")
     
-    # 4. Запуск поллинга
+    # 5. Запуск вебхука или поллинга
+    server = None
+    metrics_runner = None
     try:
-        logger.info("✅ Starting polling...")
-        await bot.delete_webhook(drop_pending_updates=True)
-        await dp.start_polling(bot)
+        if WEBHOOK_URL:
+            logger.info("✅ Starting webhook...")
+            server = WebhookServer(
+                dp, bot,
+                path=WEBHOOK_PATH,
+                secret_token=webhook_secret(),
+                # Одновременность ограничивает admission (MAX_CONCURRENT_UPDATES), здесь — только память
+                max_inflight=int(os.getenv("WEBHOOK_MAX_INFLIGHT", "10000")),
+                dedup=UpdateDeduplicator(db),
+            )
+            app = server.app()
+            app.router.add_get("/metrics", metrics_handler)
+            if uploads_enabled():
+                upload_server.setup(app)
+            await server.start(WEBHOOK_HOST, PORT, app)
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=server.secret_token,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "100")),
+            )
+            # Поллинг ловит сигналы сам (handle_signals), здесь — вручную: по SIGTERM при деплое
+            # finally дорабатывает принятые апдейты и сбрасывает буферы записи
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(sig, stop.set)
+            await stop.wait()
+            logger.info("Получен сигнал остановки, дорабатываю очередь апдейтов...")
+        else:
+            logger.info("✅ Starting polling...")
+            if METRICS_PORT:
+                metrics_runner = await start_metrics_server(WEBHOOK_HOST, METRICS_PORT)
+            if uploads_enabled():
+                await upload_server.serve(WEBHOOK_HOST, PORT)
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
     except Exception as e:
         logger.critical(f"❌ POLLING ERROR: {e}")
+    finally:
+        if server is not None:
+            await server.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await upload_server.stop()
+        await broadcasts.stop()
+        await subscription_index.stop()
+        await upscale_queue.stop()
+        upscaler.stop()
+        await user_writes.stop()
+        await status_writes.stop()
+        await db.close()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,336 @@
+"""
+Движок рассылок: параллельная отправка с глобальным ограничением скорости,
+учётом retry_after и сохранением прогресса в БД для продолжения после рестарта.
+Каждую рассылку ведёт одна реплика — та, что держит её аренду в таблице leases.
+"""
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from psycopg2.extras import execute_values
+
+from db import Database
+from leases import Lease
+from metrics import BROADCAST_MESSAGES
+from tracing import tracer
+from write_behind import WriteBehindBuffer
+
+logger = logging.getLogger(__name__)
+
+# Статусы получателя в broadcast_recipients
+PENDING = 0
+SENT = 1
+FAILED = 2
+BLOCKED = 3
+
+STATUS_NAMES = {SENT: "sent", FAILED: "failed", BLOCKED: "blocked"}
+
+
+class TokenBucket:
+    """Глобальный ограничитель скорости (токенов в секунду) с паузой по retry_after"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Остановить выдачу токенов на seconds секунд"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+        # Токены копятся только после паузы, иначе сразу по её окончании ушла бы полная пачка
+        self._updated = self._paused_until
+
+    async def acquire(self):
+        """Дождаться одного токена"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BroadcastEngine:
+    """Рассылка сообщений всем активным пользователям"""
+
+    def __init__(self, bot: Bot, db: Database, on_blocked, rate: float = 28,
+                 concurrency: int = 20, chunk_size: int = 1000,
+                 progress_interval: float = 5.0, max_attempts: int = 5, lease_ttl: float = 60.0):
+        self.bot = bot
+        self.db = db
+        self.on_blocked = on_blocked
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.progress_interval = progress_interval
+        self.max_attempts = max_attempts
+        self.lease_ttl = lease_ttl
+        self._tasks = {}
+        self._watcher = None
+
+    @property
+    def running(self) -> list[int]:
+        """ID рассылок, которые сейчас идут в этом процессе"""
+        return list(self._tasks)
+
+    async def start(self, text: str, chat_id: int, message_id: int,
+                    subscribers_of: str = None) -> tuple[int, int]:
+        """
+        Создать рассылку по всем активным пользователям или, если задан subscribers_of,
+        только по подписчикам этого канала из channel_members. Возвращает (id, число получателей).
+        """
+        def _create_broadcast(cur):
+            cur.execute(
+                "INSERT INTO broadcasts (text, chat_id, message_id) VALUES (%s, %s, %s) RETURNING id",
+                (text, chat_id, message_id)
+            )
+            job_id = cur.fetchone()['id']
+            if subscribers_of is None:
+                cur.execute("""
+                    INSERT INTO broadcast_recipients (broadcast_id, user_id)
+                    SELECT %s, id FROM users WHERE active = TRUE
+                """, (job_id,))
+            else:
+                cur.execute("""
+                    INSERT INTO broadcast_recipients (broadcast_id, user_id)
+                    SELECT %s, u.id FROM users u
+                    JOIN channel_members m ON m.channel_id = %s AND m.user_id = u.id AND m.subscribed
+                    WHERE u.active = TRUE
+                """, (job_id, subscribers_of))
+            total = cur.rowcount
+            cur.execute("UPDATE broadcasts SET total = %s WHERE id = %s", (total, job_id))
+            return job_id, total
+
+        job_id, total = await self.db.run(_create_broadcast)
+        lease = self._lease(job_id)
+        await lease.acquire()
+        self._spawn(job_id, lease)
+        return job_id, total
+
+    def _lease(self, job_id: int) -> Lease:
+        return Lease(self.db, f"broadcast:{job_id}", self.lease_ttl)
+
+    async def _adopt(self):
+        """Взять в работу идущие рассылки, аренду которых никто не держит"""
+        rows = await self.db.fetchall(
+            "SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id",
+            name="broadcast_resume"
+        )
+        for row in rows:
+            if row['id'] in self._tasks:
+                continue
+            lease = self._lease(row['id'])
+            if await lease.acquire():
+                logger.info(f"Продолжаем рассылку #{row['id']}")
+                self._spawn(row['id'], lease)
+
+    async def _watch(self):
+        # Рассылки реплики, которая остановилась или упала, подхватываются без рестарта этой
+        while True:
+            await asyncio.sleep(self.lease_ttl / 2)
+            try:
+                await self._adopt()
+            except Exception as e:
+                logger.error(f"Проверка прерванных рассылок: {e}")
+
+    async def resume(self):
+        """Продолжить рассылки, прерванные перезапуском, и следить за рассылками других реплик"""
+        await self._adopt()
+        if self._watcher is None:
+            self._watcher = asyncio.create_task(self._watch(), name="broadcast-watcher")
+
+    async def stop(self):
+        """Остановить рассылки (прогресс сохраняется, аренды отдаются другим репликам)"""
+        tasks = list(self._tasks.values())
+        if self._watcher is not None:
+            tasks.append(self._watcher)
+            self._watcher = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, job_id: int, lease: Lease):
+        if job_id in self._tasks:
+            return
+        # Рассылка живёт дольше апдейта /broadcast, из которого запущена: у неё своя трасса
+        task = tracer.background(self._run(job_id, lease), name=f"broadcast-{job_id}")
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda t: self._on_done(job_id, t))
+
+    def _on_done(self, job_id: int, task: asyncio.Task):
+        self._tasks.pop(job_id, None)
+        if not task.cancelled() and task.exception():
+            logger.error(f"Рассылка #{job_id} прервана ошибкой: {task.exception()}")
+
+    async def _load_job(self, job_id: int) -> dict:
+        def _load_broadcast(cur):
+            cur.execute("SELECT * FROM broadcasts WHERE id = %s", (job_id,))
+            job = dict(cur.fetchone())
+            cur.execute("""
+                SELECT status, COUNT(*) AS cnt FROM broadcast_recipients
+                WHERE broadcast_id = %s GROUP BY status
+            """, (job_id,))
+            job["counts"] = {row['status']: row['cnt'] for row in cur.fetchall()}
+            return job
+
+        return await self.db.run(_load_broadcast)
+
+    async def _fetch_pending(self, job_id: int, after: int) -> list[int]:
+        rows = await self.db.fetchall("""
+            SELECT user_id FROM broadcast_recipients
+            WHERE broadcast_id = %s AND status = 0 AND user_id > %s
+            ORDER BY user_id LIMIT %s
+        """, (job_id, after, self.chunk_size), name="broadcast_fetch")
+        return [row['user_id'] for row in rows]
+
+    def _results_buffer(self, job_id: int) -> WriteBehindBuffer:
+        async def _flush_results(rows: list):
+            def _save_results(cur):
+                execute_values(cur, """
+                    UPDATE broadcast_recipients AS r SET status = v.status
+                    FROM (VALUES %s) AS v(broadcast_id, user_id, status)
+                    WHERE r.broadcast_id = v.broadcast_id AND r.user_id = v.user_id
+                """, [(job_id, user_id, status) for user_id, status in rows],
+                    template="(%s::integer, %s::bigint, %s::smallint)")
+                sent = sum(1 for _, status in rows if status == SENT)
+                cur.execute(
+                    "UPDATE broadcasts SET sent = sent + %s, failed = failed + %s WHERE id = %s",
+                    (sent, len(rows) - sent, job_id)
+                )
+
+            await self.db.run(_save_results, name="broadcast_progress")
+
+        return WriteBehindBuffer(_flush_results, name=f"broadcast-{job_id}", batch_size=200,
+                                 flush_interval=1.0, max_pending=self.concurrency * 50)
+
+    async def _send(self, user_id: int, text: str) -> int:
+        for _ in range(self.max_attempts):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(user_id, text, parse_mode="HTML")
+                return SENT
+            except TelegramRetryAfter as e:
+                logger.warning(f"Флуд-лимит Telegram, пауза {e.retry_after} с")
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                return BLOCKED
+            except TelegramBadRequest as e:
+                if "blocked" in str(e).lower() or "deactivated" in str(e).lower():
+                    return BLOCKED
+                return FAILED
+            except (TelegramNetworkError, TelegramServerError) as e:
+                logger.warning(f"Ошибка сети при рассылке для {user_id}: {e}")
+                await asyncio.sleep(1)
+            except Exception as e:
+                logger.error(f"Ошибка рассылки для {user_id}: {e}")
+                return FAILED
+        return FAILED
+
+    async def _edit_progress(self, job: dict, text: str):
+        if not job.get("chat_id") or not job.get("message_id"):
+            return
+        try:
+            await self.bot.edit_message_text(text, chat_id=job["chat_id"], message_id=job["message_id"],
+                                             parse_mode="HTML")
+        except Exception as e:
+            logger.debug(f"Не удалось обновить прогресс рассылки: {e}")
+
+    async def _run(self, job_id: int, lease: Lease):
+        try:
+            with tracer.trace("broadcast", **{"broadcast.id": job_id}):
+                await self._deliver(job_id, lease)
+        finally:
+            # Прогресс уже сброшен в БД: другая реплика продолжит без повторных отправок
+            await lease.release()
+
+    async def _deliver(self, job_id: int, lease: Lease):
+        job = await self._load_job(job_id)
+        counts = job["counts"]
+        sent = counts.get(SENT, 0)
+        failed = counts.get(FAILED, 0) + counts.get(BLOCKED, 0)
+        total = job["total"]
+        started = time.monotonic()
+
+        results = self._results_buffer(job_id)
+        results.start()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def worker():
+            nonlocal sent, failed
+            while True:
+                user_id = await queue.get()
+                try:
+                    status = await self._send(user_id, job["text"])
+                    BROADCAST_MESSAGES.inc(status=STATUS_NAMES[status])
+                    if status == SENT:
+                        sent += 1
+                    else:
+                        failed += 1
+                    if status == BLOCKED:
+                        await self.on_blocked(user_id)
+                    await results.put(user_id, (user_id, status))
+                finally:
+                    queue.task_done()
+
+        run_task = asyncio.current_task()
+
+        async def reporter():
+            while True:
+                await asyncio.sleep(self.progress_interval)
+                try:
+                    if not await lease.acquire():
+                        logger.warning(f"Рассылка #{job_id}: аренду забрала другая реплика, останавливаемся")
+                        run_task.cancel()
+                        return
+                except Exception as e:
+                    logger.warning(f"Рассылка #{job_id}: не удалось продлить аренду: {e}")
+                await self._edit_progress(job, f"📤 Рассылка... {sent + failed}/{total}")
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        progress = asyncio.create_task(reporter())
+        try:
+            last_id = 0
+            while True:
+                chunk = await self._fetch_pending(job_id, last_id)
+                if not chunk:
+                    break
+                for user_id in chunk:
+                    await queue.put(user_id)
+                last_id = chunk[-1]
+            await queue.join()
+        finally:
+            for task in workers + [progress]:
+                task.cancel()
+            await asyncio.gather(*workers, progress, return_exceptions=True)
+            await results.stop()
+
+        await self.db.execute(
+            "UPDATE broadcasts SET status = 'done', finished = CURRENT_TIMESTAMP WHERE id = %s",
+            (job_id,), name="broadcast_finish"
+        )
+        elapsed = time.monotonic() - started
+        logger.info(f"Рассылка #{job_id} завершена за {elapsed:.0f} с: {sent} отправлено, {failed} ошибок")
+        await self._edit_progress(
+            job,
+            f"✅ <b>Рассылка завершена!</b>\n\n"
+            f"📨 Отправлено: {sent}\n"
+            f"❌ Не доставлено: {failed}"
+        )
@@ -0,0 +1,120 @@
+"""
+In-process кэш с ограничением размера (LRU), сроком жизни записей
+и объединением параллельных загрузок одного ключа.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Ограниченный LRU-кэш с TTL на каждую запись"""
+
+    def __init__(self, maxsize: int = 100_000, name: str = "cache", purge_interval: float = 10.0):
+        self.maxsize = maxsize
+        self.name = name
+        self.purge_interval = purge_interval
+        self._next_purge = time.monotonic() + purge_interval
+        self._data = OrderedDict()
+        self._inflight = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "invalidations": 0, "expired": 0}
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Значение из кэша или default, если записи нет или она устарела"""
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float):
+        """Сохранить значение на ttl секунд"""
+        if not ttl or ttl <= 0:
+            return
+        now = time.monotonic()
+        self._data[key] = (now + ttl, value)
+        self._data.move_to_end(key)
+        if now >= self._next_purge:
+            self._next_purge = now + self.purge_interval
+            self.purge(now)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def purge(self, now: float = None) -> int:
+        """
+        Удалить устаревшие записи с начала LRU-списка, до первой живой.
+        Без этого записи, которые больше не читают, уходили бы только по maxsize.
+        """
+        now = now or time.monotonic()
+        removed = 0
+        while self._data:
+            key, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            del self._data[key]
+            removed += 1
+        self.stats["expired"] += removed
+        return removed
+
+    def invalidate(self, key):
+        """Удалить запись (и не сохранять результат загрузки, которая уже идёт)"""
+        removed = self._data.pop(key, None) is not None
+        removed = self._inflight.pop(key, None) is not None or removed
+        if removed:
+            self.stats["invalidations"] += 1
+
+    async def get_or_load(self, key, loader, ttl):
+        """
+        Значение из кэша либо результат loader().
+        ttl — число секунд или функция от результата; 0 означает «не кэшировать».
+        Параллельные вызовы для одного ключа ждут одну и ту же загрузку.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            self.stats["hits"] += 1
+            return value
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(future)
+
+        self.stats["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение уже получил вызывающий; не даём asyncio ругаться на непрочитанное
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            if self._inflight.get(key) is future:
+                self.set(key, value, ttl(value) if callable(ttl) else ttl)
+            return value
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    def snapshot(self) -> dict:
+        """Счётчики кэша"""
+        stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+        stats["size"] = len(self._data)
+        stats["hit_rate"] = (stats["hits"] + stats["coalesced"]) / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,203 @@
+"""
+Пул соединений PostgreSQL для бота.
+Запросы psycopg2 выполняются в отдельных потоках, чтобы не блокировать event loop aiogram.
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+from metrics import DB_POOL_WAIT, DB_QUERY_LATENCY
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Не удалось получить соединение из пула за отведённое время"""
+
+
+class Database:
+    """Общий пул соединений с ограничением размера, проверкой живости и таймаутом ожидания"""
+
+    def __init__(self, dsn: str, min_size: int = 1, max_size: int = 10,
+                 acquire_timeout: float = 5.0, health_check_interval: float = 30.0):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+
+        self._pool = None
+        self._executor = None
+        self._slots = None
+        self._last_used = {}
+        self._in_use = 0
+        self._lock = threading.Lock()
+
+        self.stats = {
+            "acquired": 0,
+            "timeouts": 0,
+            "wait_total": 0.0,
+            "wait_max": 0.0,
+            "queries": 0,
+            "query_errors": 0,
+            "query_total": 0.0,
+            "query_max": 0.0,
+            "reconnects": 0,
+        }
+        self.query_stats = {}
+
+    async def open(self):
+        """Создание пула (минимальное число соединений открывается сразу)"""
+        if self._pool is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self.max_size, thread_name_prefix="db")
+        self._slots = asyncio.Semaphore(self.max_size)
+        loop = asyncio.get_running_loop()
+        self._pool = await loop.run_in_executor(
+            self._executor,
+            lambda: ThreadedConnectionPool(self.min_size, self.max_size, self.dsn, cursor_factory=RealDictCursor)
+        )
+        logger.info(f"Пул БД открыт (min={self.min_size}, max={self.max_size})")
+
+    async def close(self):
+        """Закрытие всех соединений пула"""
+        if self._pool is None:
+            return
+        pool, self._pool = self._pool, None
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, pool.closeall)
+        self._executor.shutdown(wait=False)
+        self._executor = None
+        self._last_used.clear()
+        logger.info("Пул БД закрыт")
+
+    def _is_alive(self, conn) -> bool:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self):
+        """Взять соединение из пула, заменив его, если оно умерло"""
+        conn = self._pool.getconn()
+        idle_since = self._last_used.get(id(conn))
+        stale = idle_since is None or time.monotonic() - idle_since > self.health_check_interval
+        if conn.closed or (stale and not self._is_alive(conn)):
+            logger.warning("Соединение с БД потеряно, переподключение")
+            with self._lock:
+                self.stats["reconnects"] += 1
+            self._pool.putconn(conn, close=True)
+            conn = self._pool.getconn()
+        return conn
+
+    def _checkin(self, conn):
+        if conn.closed:
+            self._last_used.pop(id(conn), None)
+            self._pool.putconn(conn, close=True)
+            return
+        if conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        self._last_used[id(conn)] = time.monotonic()
+        self._pool.putconn(conn)
+
+    def _execute(self, fn, args, kwargs):
+        conn = self._checkout()
+        try:
+            with conn.cursor() as cur:
+                result = fn(cur, *args, **kwargs)
+            conn.commit()
+            return result
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self._checkin(conn)
+
+    def _record_query(self, name: str, elapsed: float, failed: bool):
+        self.stats["queries"] += 1
+        self.stats["query_total"] += elapsed
+        self.stats["query_max"] = max(self.stats["query_max"], elapsed)
+        if failed:
+            self.stats["query_errors"] += 1
+        per_query = self.query_stats.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+        per_query["count"] += 1
+        per_query["total"] += elapsed
+        per_query["max"] = max(per_query["max"], elapsed)
+        DB_QUERY_LATENCY.observe(elapsed, query=name)
+
+    async def run(self, fn, *args, name: str = None, **kwargs):
+        """Выполнить fn(cur, *args, **kwargs) в транзакции на соединении из пула"""
+        if self._pool is None:
+            raise RuntimeError("Пул БД не открыт")
+
+        wait_start = time.monotonic()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise PoolTimeout(f"Нет свободных соединений с БД за {self.acquire_timeout} с")
+        waited = time.monotonic() - wait_start
+        self._in_use += 1
+        self.stats["acquired"] += 1
+        self.stats["wait_total"] += waited
+        self.stats["wait_max"] = max(self.stats["wait_max"], waited)
+        DB_POOL_WAIT.observe(waited)
+
+        query_start = time.monotonic()
+        failed = False
+        try:
+            loop = asyncio.get_running_loop()
+            with tracer.span(f"db {name or fn.__name__}", kind=3, **{
+                "db.system": "postgresql", "db.pool.wait_ms": round(waited * 1000, 3)
+            }):
+                return await loop.run_in_executor(self._executor, self._execute, fn, args, kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._in_use -= 1
+            self._slots.release()
+            self._record_query(name or fn.__name__, time.monotonic() - query_start, failed)
+
+    async def execute(self, sql: str, params=None, name: str = None):
+        """Выполнить запрос без результата"""
+        def _execute(cur):
+            cur.execute(sql, params)
+        await self.run(_execute, name=name or "execute")
+
+    async def fetchone(self, sql: str, params=None, name: str = None):
+        """Выполнить запрос и вернуть одну строку"""
+        def _fetchone(cur):
+            cur.execute(sql, params)
+            return cur.fetchone()
+        return await self.run(_fetchone, name=name or "fetchone")
+
+    async def fetchall(self, sql: str, params=None, name: str = None):
+        """Выполнить запрос и вернуть все строки"""
+        def _fetchall(cur):
+            cur.execute(sql, params)
+            return cur.fetchall()
+        return await self.run(_fetchall, name=name or "fetchall")
+
+    def snapshot(self) -> dict:
+        """Текущие метрики пула"""
+        stats = dict(self.stats)
+        acquired = stats["acquired"] or 1
+        queries = stats["queries"] or 1
+        stats["wait_avg"] = stats["wait_total"] / acquired
+        stats["query_avg"] = stats["query_total"] / queries
+        stats["in_use"] = self._in_use
+        stats["size"] = self.max_size
+        return stats
@@ -0,0 +1,55 @@
+"""
+Потоковый экспорт в CSV: строки пишутся во временный файл (в памяти до порога, дальше на диск),
+файл отправляется в Telegram чанками, без полной копии в памяти.
+"""
+import asyncio
+import csv
+import gzip
+import io
+import tempfile
+
+from aiogram.types.input_file import DEFAULT_CHUNK_SIZE, InputFile
+
+USERS_HEADER = ['ID', 'Username', 'Name', 'Joined', 'Active']
+
+
+def spooled_file(max_memory: int = 1024 * 1024):
+    """Временный файл: до max_memory байт в памяти, дальше на диске"""
+    return tempfile.SpooledTemporaryFile(max_size=max_memory, mode="w+b")
+
+
+def write_users_csv(out, rows, compress: bool = False) -> int:
+    """Записать строки пользователей в бинарный файл out. Возвращает число строк."""
+    raw = gzip.GzipFile(fileobj=out, mode="wb") if compress else out
+    text = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+    writer = csv.writer(text)
+    writer.writerow(USERS_HEADER)
+    count = 0
+    for user in rows:
+        writer.writerow([
+            user['id'],
+            user['username'] or '',
+            user['first_name'] or '',
+            user['joined'],
+            user['active']
+        ])
+        count += 1
+    text.flush()
+    text.detach()
+    if compress:
+        # Закрывает только gzip-поток, сам out остаётся открытым
+        raw.close()
+    return count
+
+
+class SpooledInputFile(InputFile):
+    """Загрузка в Telegram из открытого файлового объекта чанками"""
+
+    def __init__(self, file, filename: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.file = file
+
+    async def read(self, bot):
+        self.file.seek(0)
+        while chunk := await asyncio.to_thread(self.file.read, self.chunk_size):
+            yield chunk
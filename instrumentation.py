@@ -0,0 +1,81 @@
+"""
+Сбор метрик и трасс с aiogram: время хендлеров, время и ошибки вызовов Bot API,
+HTTP-эндпоинт /metrics.
+"""
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject, Update
+
+from metrics import CONTENT_TYPE, HANDLER_ERRORS, HANDLER_LATENCY, REGISTRY, TELEGRAM_ERRORS, TELEGRAM_LATENCY
+from tracing import tracer
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Outer-middleware на апдейты: корневой спан трассы (вход в диспетчер)"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not tracer.enabled or not isinstance(event, Update):
+            return await handler(event, data)
+        with tracer.trace("update", **{"update.id": event.update_id, "update.type": event.event_type}):
+            return await handler(event, data)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner-middleware: время работы хендлера с меткой по его имени"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        name = data["handler"].callback.__name__
+        start = time.perf_counter()
+        try:
+            with tracer.span(f"handler {name}"):
+                return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - start, handler=name)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: время и ошибки каждого вызова Bot API по методу"""
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        start = time.perf_counter()
+        try:
+            with tracer.span(f"telegram {name}", kind=3, **{"rpc.method": name}):
+                return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(method=name, error=type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - start, method=name)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """GET /metrics в формате Prometheus"""
+    return web.Response(body=REGISTRY.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """Отдельный HTTP-сервер с /metrics (для режима поллинга)"""
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,283 @@
+"""
+Очередь задач апскейла в PostgreSQL (таблица upscale_jobs, создаётся в init_db).
+Задачи забираются через SELECT ... FOR UPDATE SKIP LOCKED, поэтому очередь можно
+разбирать из нескольких процессов и хостов сразу. Взятая задача держит аренду,
+которую воркер продлевает; задачи с истёкшей арендой возвращаются в очередь.
+"""
+import asyncio
+import logging
+import os
+import socket
+from typing import Awaitable, Callable
+
+from db import Database
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class QueueFull(Exception):
+    """У пользователя уже слишком много задач в очереди"""
+
+
+# Справедливая доля: сначала приоритет, потом пользователи, у которых сейчас меньше
+# всего задач в работе, потом возраст задачи. Лимит на пользователя мягкий: два воркера
+# могут одновременно увидеть один и тот же счётчик.
+_CLAIM = """
+    WITH running AS (
+        SELECT user_id, count(*) AS n FROM upscale_jobs
+        WHERE state = 'running' AND lease_until > now()
+        GROUP BY user_id
+    ), candidate AS (
+        SELECT j.id FROM upscale_jobs j
+        LEFT JOIN running r ON r.user_id = j.user_id
+        WHERE j.state = 'queued' AND j.run_after <= now()
+          AND coalesce(r.n, 0) < %(per_user)s
+        ORDER BY j.priority DESC, coalesce(r.n, 0), j.created
+        LIMIT 1
+        FOR UPDATE OF j SKIP LOCKED
+    )
+    UPDATE upscale_jobs j
+    SET state = 'running', attempts = j.attempts + 1, worker = %(worker)s,
+        lease_until = now() + %(lease)s * interval '1 second', started = now()
+    FROM candidate WHERE j.id = candidate.id
+    RETURNING j.*
+"""
+
+# Задачи упавших воркеров: повтор, пока не кончились попытки
+_REAP = """
+    UPDATE upscale_jobs
+    SET state = CASE WHEN attempts < %(max_attempts)s THEN 'queued' ELSE 'failed' END,
+        error = CASE WHEN attempts < %(max_attempts)s THEN error ELSE 'истекла аренда' END,
+        finished = CASE WHEN attempts < %(max_attempts)s THEN NULL ELSE now() END,
+        worker = NULL, lease_until = NULL, run_after = now()
+    WHERE state = 'running' AND lease_until < now()
+    RETURNING id, state
+"""
+
+
+class JobQueue:
+    """Воркеры очереди апскейла в этом процессе"""
+
+    def __init__(self, db: Database, handler: Callable[[dict], Awaitable[None]],
+                 on_failed: Callable[[dict, str], Awaitable[None]] = None, fatal: tuple = (),
+                 concurrency: int = 2, lease: float = 120.0, max_attempts: int = 3,
+                 per_user_running: int = 1, per_user_queued: int = 3,
+                 retry_delay: float = 30.0, poll_interval: float = 2.0):
+        self.db = db
+        self.handler = handler
+        self.on_failed = on_failed
+        self.fatal = fatal
+        self.concurrency = concurrency
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.per_user_running = per_user_running
+        self.per_user_queued = per_user_queued
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+        self._workers = []
+        self._running = {}
+        self._wakeup = asyncio.Event()
+        self.stats = {"claimed": 0, "done": 0, "failed": 0, "retried": 0, "reaped": 0, "lost": 0}
+
+    @property
+    def active(self) -> int:
+        return len(self._running)
+
+    async def enqueue(self, user_id: int, chat_id: int, file_id: str, file_unique_id: str,
+                      file_size: int = None, status_message_id: int = None, priority: int = 0,
+                      upload_id: str = None) -> dict:
+        """
+        Поставить видео в очередь. Возвращает {"id", "position"}; QueueFull при превышении лимита.
+        Видео из Telegram задаётся file_id, загруженное через Mini App — upload_id.
+        """
+        def _enqueue(cur):
+            # Блокировка по пользователю, чтобы параллельные вставки не обошли лимит
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (user_id,))
+            cur.execute(
+                "SELECT count(*) AS n FROM upscale_jobs WHERE user_id = %s AND state IN ('queued', 'running')",
+                (user_id,)
+            )
+            if cur.fetchone()["n"] >= self.per_user_queued:
+                return None
+            cur.execute("""
+                INSERT INTO upscale_jobs (user_id, chat_id, file_id, file_unique_id, file_size,
+                                          status_message_id, priority, upload_id)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING id, created
+            """, (user_id, chat_id, file_id, file_unique_id, file_size, status_message_id, priority, upload_id))
+            job = cur.fetchone()
+            cur.execute(
+                "SELECT count(*) AS n FROM upscale_jobs WHERE state = 'queued' AND "
+                "(priority > %s OR (priority = %s AND created <= %s))",
+                (priority, priority, job["created"])
+            )
+            return {"id": job["id"], "position": cur.fetchone()["n"]}
+
+        job = await self.db.run(_enqueue, name="job_enqueue")
+        if job is None:
+            raise QueueFull(f"не больше {self.per_user_queued} видео в очереди")
+        self._wakeup.set()
+        return job
+
+    def start(self):
+        for _ in range(self.concurrency):
+            self._workers.append(asyncio.create_task(self._worker()))
+
+    async def stop(self):
+        """Остановить воркеров; незавершённые задачи возвращаются в очередь"""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+    async def _claim(self):
+        return await self.db.fetchone(_CLAIM, {
+            "per_user": self.per_user_running,
+            "worker": self.worker_id,
+            "lease": self.lease,
+        }, name="job_claim")
+
+    async def _reap(self):
+        rows = await self.db.fetchall(_REAP, {"max_attempts": self.max_attempts}, name="job_reap")
+        for row in rows:
+            self.stats["reaped"] += 1
+            logger.warning(f"Задача #{row['id']}: истекла аренда, теперь {row['state']}")
+
+    async def _worker(self):
+        while True:
+            try:
+                await self._reap()
+                job = await self._claim()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Очередь апскейла: ошибка БД: {e}")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.stats["claimed"] += 1
+            await self._execute(job)
+
+    async def _extend(self, job_id: int) -> bool:
+        """Продлить аренду; False — задачу уже забрали (аренда истекла и её переназначили)"""
+        row = await self.db.fetchone("""
+            UPDATE upscale_jobs SET lease_until = now() + %s * interval '1 second'
+            WHERE id = %s AND worker = %s AND state = 'running'
+            RETURNING id
+        """, (self.lease, job_id, self.worker_id), name="job_heartbeat")
+        return row is not None
+
+    async def _execute(self, job: dict):
+        job_id = job["id"]
+        self._running[job_id] = job
+        task = asyncio.create_task(self.handler(job))
+        try:
+            while not task.done():
+                await asyncio.wait({task}, timeout=self.lease / 3)
+                if task.done():
+                    break
+                try:
+                    extended = await self._extend(job_id)
+                except Exception as e:
+                    logger.warning(f"Задача #{job_id}: не удалось продлить аренду: {e}")
+                    continue
+                if not extended:
+                    self.stats["lost"] += 1
+                    logger.warning(f"Задача #{job_id}: аренда потеряна, обработка остановлена")
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    return
+        except asyncio.CancelledError:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await self._release(job_id)
+            raise
+        finally:
+            self._running.pop(job_id, None)
+
+        error = task.exception()
+        try:
+            if error is None:
+                self.stats["done"] += 1
+                await self._finish(job_id, DONE)
+            elif isinstance(error, self.fatal) or job["attempts"] >= self.max_attempts:
+                self.stats["failed"] += 1
+                logger.error(f"Задача #{job_id} не выполнена: {error}")
+                await self._finish(job_id, FAILED, str(error))
+                if self.on_failed is not None:
+                    await self.on_failed(job, str(error))
+            else:
+                self.stats["retried"] += 1
+                logger.warning(f"Задача #{job_id}: попытка {job['attempts']} не удалась ({error}), повтор")
+                await self._retry(job_id, str(error), self.retry_delay * job["attempts"])
+        except Exception as e:
+            # Если запись не удалась, задачу вернёт в очередь истечение аренды
+            logger.error(f"Задача #{job_id}: не удалось сохранить результат: {e}")
+
+    async def _finish(self, job_id: int, state: str, error: str = None):
+        await self.db.execute("""
+            UPDATE upscale_jobs SET state = %s, error = %s, finished = now(), lease_until = NULL
+            WHERE id = %s AND worker = %s
+        """, (state, error, job_id, self.worker_id), name="job_finish")
+
+    async def _retry(self, job_id: int, error: str, delay: float):
+        await self.db.execute("""
+            UPDATE upscale_jobs SET state = 'queued', error = %s, worker = NULL, lease_until = NULL,
+                                    run_after = now() + %s * interval '1 second'
+            WHERE id = %s AND worker = %s
+        """, (error, delay, job_id, self.worker_id), name="job_retry")
+
+    async def _release(self, job_id: int):
+        """Вернуть задачу в очередь при остановке, не расходуя попытку"""
+        try:
+            await self.db.execute("""
+                UPDATE upscale_jobs SET state = 'queued', attempts = attempts - 1,
+                                        worker = NULL, lease_until = NULL
+                WHERE id = %s AND worker = %s AND state = 'running'
+            """, (job_id, self.worker_id), name="job_release")
+        except Exception as e:
+            logger.warning(f"Задача #{job_id} вернётся в очередь по истечении аренды: {e}")
+
+    async def overview(self) -> dict:
+        """Сводка для /queue: задачи по состояниям, кто в очереди, что в работе"""
+        def _overview(cur):
+            cur.execute("""
+                SELECT state, count(*) AS n FROM upscale_jobs
+                WHERE state IN ('queued', 'running') OR finished > now() - interval '24 hours'
+                GROUP BY state
+            """)
+            states = {row["state"]: row["n"] for row in cur.fetchall()}
+            cur.execute("""
+                SELECT extract(epoch FROM now() - min(created)) AS age
+                FROM upscale_jobs WHERE state = 'queued'
+            """)
+            oldest = cur.fetchone()["age"]
+            cur.execute("""
+                SELECT user_id, count(*) AS n FROM upscale_jobs WHERE state = 'queued'
+                GROUP BY user_id ORDER BY n DESC LIMIT 5
+            """)
+            users = cur.fetchall()
+            cur.execute("""
+                SELECT id, user_id, worker, attempts,
+                       extract(epoch FROM now() - started) AS running_for,
+                       extract(epoch FROM lease_until - now()) AS lease_left
+                FROM upscale_jobs WHERE state = 'running' ORDER BY started LIMIT 10
+            """)
+            return {"states": states, "oldest": float(oldest or 0), "users": users, "running": cur.fetchall()}
+
+        return await self.db.run(_overview, name="job_overview")
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "active": self.active, "concurrency": self.concurrency}
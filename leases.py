@@ -0,0 +1,44 @@
+"""
+Аренды в таблице leases (создаётся в init_db): фоновую работу, которая должна идти
+в одном экземпляре (продолжение рассылки, сверка подписок), берёт одна реплика.
+Владелец продлевает аренду; если он упал, по истечении срока её забирает другая реплика.
+"""
+import logging
+import os
+import socket
+
+from db import Database
+
+logger = logging.getLogger(__name__)
+
+HOLDER = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Lease:
+    """Именованная аренда на ttl секунд"""
+
+    def __init__(self, db: Database, name: str, ttl: float = 60.0, holder: str = HOLDER):
+        self.db = db
+        self.name = name
+        self.ttl = ttl
+        self.holder = holder
+
+    async def acquire(self) -> bool:
+        """Взять или продлить аренду; False — её держит другая реплика"""
+        row = await self.db.fetchone("""
+            INSERT INTO leases (name, holder, expires) VALUES (%s, %s, now() + %s * interval '1 second')
+            ON CONFLICT (name) DO UPDATE SET holder = EXCLUDED.holder, expires = EXCLUDED.expires
+            WHERE leases.holder = EXCLUDED.holder OR leases.expires < now()
+            RETURNING name
+        """, (self.name, self.holder, self.ttl), name="lease_acquire")
+        return row is not None
+
+    async def release(self):
+        """Отдать аренду сразу, не дожидаясь истечения (при остановке или по завершении работы)"""
+        try:
+            await self.db.execute(
+                "DELETE FROM leases WHERE name = %s AND holder = %s",
+                (self.name, self.holder), name="lease_release"
+            )
+        except Exception as e:
+            logger.warning(f"Аренда {self.name} освободится по истечении срока: {e}")
@@ -0,0 +1,137 @@
+"""
+Кэш file_id для статических картинок: каждый файл загружается в Telegram один раз,
+дальше отправляется по file_id. Ключ — SHA-256 содержимого загружаемого файла.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+
+from db import Database
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow не обязателен: без него отправляем оригинал
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+
+def _file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def optimize_image(path: str, cache_dir: str, max_side: int = 1280, quality: int = 82) -> str:
+    """Пережатая копия картинки для отправки; если выигрыша нет или нет Pillow — исходный путь"""
+    if Image is None:
+        return path
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+    target = os.path.join(cache_dir, f"{stem}-{_file_hash(path)[:12]}-{max_side}q{quality}.jpg")
+    if not os.path.exists(target):
+        os.makedirs(cache_dir, exist_ok=True)
+        with Image.open(path) as im:
+            im = im.convert("RGB")
+            im.thumbnail((max_side, max_side))
+            tmp = target + ".tmp"
+            im.save(tmp, "JPEG", quality=quality, optimize=True, progressive=True)
+        os.replace(tmp, target)
+
+    if os.path.getsize(target) >= os.path.getsize(path):
+        return path
+    return target
+
+
+def _is_bad_file_id(error: TelegramBadRequest) -> bool:
+    text = str(error).lower()
+    return "file identifier" in text or "file_id" in text or "remote file" in text
+
+
+class MediaCache:
+    """Отправка статических картинок по сохранённому file_id с автоматической перезагрузкой"""
+
+    def __init__(self, bot: Bot, db: Database, cache_dir: str = ".cache/media",
+                 max_side: int = 1280, quality: int = 82):
+        self.bot = bot
+        self.db = db
+        self.cache_dir = cache_dir
+        self.max_side = max_side
+        self.quality = quality
+        self._assets = {}
+        self._file_ids = {}
+        self._locks = {}
+        self.stats = {"cached": 0, "uploaded": 0, "reuploaded": 0}
+
+    async def prepare(self, path: str) -> tuple[str, str]:
+        """Подготовить картинку: пережать, посчитать хеш, подтянуть file_id из БД"""
+        try:
+            upload_path = await asyncio.to_thread(optimize_image, path, self.cache_dir, self.max_side, self.quality)
+        except Exception as e:
+            # Битая картинка или ошибка Pillow — не повод не отправлять баннер
+            logger.warning(f"{path}: не удалось пережать, отправляем оригинал: {e}")
+            upload_path = path
+        key = await asyncio.to_thread(_file_hash, upload_path)
+        self._assets[path] = (key, upload_path)
+
+        row = await self.db.fetchone(
+            "SELECT file_id FROM media_cache WHERE content_hash = %s", (key,), name="media_cache_get"
+        )
+        if row:
+            self._file_ids[key] = row['file_id']
+        if upload_path != path:
+            logger.info(
+                f"{path}: {os.path.getsize(path) // 1024} КБ -> {os.path.getsize(upload_path) // 1024} КБ"
+            )
+        return key, upload_path
+
+    async def _remember(self, key: str, file_id: str):
+        self._file_ids[key] = file_id
+        await self.db.execute("""
+            INSERT INTO media_cache (content_hash, file_id) VALUES (%s, %s)
+            ON CONFLICT (content_hash) DO UPDATE SET file_id = EXCLUDED.file_id, updated = CURRENT_TIMESTAMP
+        """, (key, file_id), name="media_cache_set")
+
+    async def _forget(self, key: str, file_id: str):
+        if self._file_ids.get(key) == file_id:
+            del self._file_ids[key]
+        await self.db.execute(
+            "DELETE FROM media_cache WHERE content_hash = %s AND file_id = %s",
+            (key, file_id), name="media_cache_delete"
+        )
+
+    async def send_photo(self, chat_id: int, path: str, **kwargs) -> Message:
+        """Отправить картинку по file_id, а если его нет или Telegram его не принял — загрузить"""
+        key, upload_path = self._assets.get(path) or await self.prepare(path)
+
+        file_id = self._file_ids.get(key)
+        if file_id:
+            try:
+                message = await self.bot.send_photo(chat_id, file_id, **kwargs)
+                self.stats["cached"] += 1
+                return message
+            except TelegramBadRequest as e:
+                if not _is_bad_file_id(e):
+                    raise
+                logger.warning(f"Telegram не принял file_id для {path}, загружаем заново: {e}")
+                self.stats["reuploaded"] += 1
+                await self._forget(key, file_id)
+
+        # Первая загрузка одна на ключ, остальные ждут и берут готовый file_id
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            file_id = self._file_ids.get(key)
+            if file_id:
+                self.stats["cached"] += 1
+                return await self.bot.send_photo(chat_id, file_id, **kwargs)
+
+            message = await self.bot.send_photo(chat_id, FSInputFile(upload_path), **kwargs)
+            self.stats["uploaded"] += 1
+            await self._remember(key, message.photo[-1].file_id)
+            return message
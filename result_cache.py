@@ -0,0 +1,136 @@
+"""
+Кэш результатов апскейла: ключ — file_unique_id исходного видео плюс параметры апскейла,
+значение — file_id уже отправленного результата. Повторное видео отвечается мгновенно.
+Локальные копии результатов хранятся для перезагрузки, если Telegram не примет file_id,
+и вытесняются по возрасту и суммарному размеру.
+"""
+import asyncio
+import logging
+import os
+import shutil
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+
+from db import Database
+from media_cache import _is_bad_file_id
+
+logger = logging.getLogger(__name__)
+
+
+def _evict_files(cache_dir: str, max_bytes: int, max_age: float) -> tuple[int, int]:
+    """Удалить старые файлы, затем самые давно использованные сверх max_bytes. Возвращает (файлов, байт)."""
+    now = time.time()
+    files = []
+    for entry in os.scandir(cache_dir):
+        if not entry.is_file():
+            continue
+        stat = entry.stat()
+        if now - stat.st_mtime > max_age:
+            os.remove(entry.path)
+            continue
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    while files and total > max_bytes:
+        _, size, path = files.pop(0)
+        os.remove(path)
+        total -= size
+    return len(files), total
+
+
+class ResultCache:
+    """file_id готовых результатов в таблице upscale_results + локальные копии в cache_dir"""
+
+    def __init__(self, bot: Bot, db: Database, cache_dir: str = ".cache/results",
+                 max_bytes: int = 2 * 1024 ** 3, max_age: float = 7 * 86400, row_max_age: float = 90 * 86400):
+        self.bot = bot
+        self.db = db
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.row_max_age = row_max_age
+        self._local = (0, 0)
+        self.stats = {"hits": 0, "misses": 0, "stored": 0, "reuploaded": 0, "stale": 0}
+
+    @staticmethod
+    def key(file_unique_id: str, signature: str) -> str:
+        return f"{file_unique_id}:{signature}"
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key.replace(":", "_").replace("/", "_") + ".mp4")
+
+    async def get(self, key: str, count: bool = True):
+        """Запись о готовом результате или None; count=False — служебная перепроверка, не в статистику"""
+        row = await self.db.fetchone("""
+            UPDATE upscale_results SET hits = hits + 1, last_hit = now()
+            WHERE cache_key = %s
+            RETURNING cache_key, file_id, width, height
+        """, (key,), name="result_cache_get")
+        if count:
+            self.stats["hits" if row else "misses"] += 1
+        return row
+
+    async def put(self, key: str, file_unique_id: str, file_id: str, size: tuple, path: str = None):
+        """Запомнить file_id результата; локальный файл переносится в кэш"""
+        await self.db.execute("""
+            INSERT INTO upscale_results (cache_key, file_unique_id, file_id, width, height)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (cache_key) DO UPDATE SET file_id = EXCLUDED.file_id, last_hit = now()
+        """, (key, file_unique_id, file_id, size[0], size[1]), name="result_cache_put")
+        self.stats["stored"] += 1
+        if path and os.path.exists(path):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            await asyncio.to_thread(shutil.move, path, self._path(key))
+            await self.evict()
+
+    async def send(self, chat_id: int, row: dict, **kwargs):
+        """
+        Отправить готовый результат. Если Telegram не принял file_id — загрузить локальную копию;
+        если и её нет, запись удаляется и возвращается None (видео нужно обработать заново).
+        """
+        try:
+            return await self.bot.send_video(chat_id, row["file_id"], **kwargs)
+        except TelegramBadRequest as e:
+            if not _is_bad_file_id(e):
+                raise
+            logger.warning(f"Telegram не принял file_id результата {row['cache_key']}: {e}")
+
+        path = self._path(row["cache_key"])
+        if not os.path.exists(path):
+            self.stats["stale"] += 1
+            await self.db.execute(
+                "DELETE FROM upscale_results WHERE cache_key = %s AND file_id = %s",
+                (row["cache_key"], row["file_id"]), name="result_cache_delete"
+            )
+            return None
+
+        message: Message = await self.bot.send_video(
+            chat_id, FSInputFile(path, filename="upscaled.mp4"), **kwargs
+        )
+        self.stats["reuploaded"] += 1
+        os.utime(path)
+        await self.db.execute(
+            "UPDATE upscale_results SET file_id = %s WHERE cache_key = %s",
+            (message.video.file_id, row["cache_key"]), name="result_cache_put"
+        )
+        return message
+
+    async def evict(self):
+        """Вытеснить локальные копии по возрасту и размеру и давно не нужные записи"""
+        if os.path.isdir(self.cache_dir):
+            self._local = await asyncio.to_thread(_evict_files, self.cache_dir, self.max_bytes, self.max_age)
+        await self.db.execute(
+            "DELETE FROM upscale_results WHERE last_hit < now() - %s * interval '1 second'",
+            (self.row_max_age,), name="result_cache_evict"
+        )
+
+    def snapshot(self) -> dict:
+        stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        stats["files"], stats["bytes"] = self._local
+        return stats
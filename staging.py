@@ -0,0 +1,165 @@
+"""
+Потоковая загрузка входящих видео в scratch-каталог: файл идёт из Bot API чанками сразу
+на диск, размер проверяется до загрузки, одновременных загрузок не больше заданного,
+а место на диске резервируется под квоту с запасом на промежуточные файлы обработки.
+"""
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import time
+from contextlib import asynccontextmanager
+
+from aiogram import Bot
+
+logger = logging.getLogger(__name__)
+
+
+class StagingError(Exception):
+    """Не удалось подготовить файл (временная проблема — задачу можно повторить)"""
+
+
+class FileTooLarge(StagingError):
+    """Файл больше допустимого размера; повтор не поможет"""
+
+
+class VideoStager:
+    """
+    staged(file_id, file_size) отдаёт рабочий каталог задачи и путь к скачанному файлу.
+    Под каталог резервируется headroom × размер файла (сегменты, результат);
+    пока квота занята, новые задачи ждут освобождения места.
+    """
+
+    def __init__(self, bot: Bot, root: str = ".cache/upscale", max_file_size: int = 20 * 1024 * 1024,
+                 quota: int = 10 * 1024 ** 3, concurrency: int = 2, chunk_size: int = 1024 * 1024,
+                 headroom: float = 4.0, min_speed: int = 512 * 1024):
+        self.bot = bot
+        self.root = root
+        self.max_file_size = max_file_size
+        self.quota = quota
+        self.chunk_size = chunk_size
+        self.headroom = headroom
+        self.min_speed = min_speed
+        self._downloads = asyncio.Semaphore(concurrency)
+        self._space = asyncio.Condition()
+        self._reserved = {}
+        self.stats = {"staged": 0, "bytes": 0, "rejected": 0, "waited": 0, "cleaned": 0}
+
+    @property
+    def reserved(self) -> int:
+        return sum(self._reserved.values())
+
+    def check_size(self, file_size: int = None):
+        """Проверка размера до загрузки (по данным из апдейта или getFile)"""
+        if file_size and file_size > self.max_file_size:
+            self.stats["rejected"] += 1
+            raise FileTooLarge(
+                f"файл {file_size / 1024 ** 2:.0f} МБ больше лимита {self.max_file_size / 1024 ** 2:.0f} МБ"
+            )
+
+    def cleanup(self):
+        """Удалить каталоги, оставшиеся от прошлых запусков (вызывать при старте)"""
+        if not os.path.isdir(self.root):
+            return
+        for entry in os.scandir(self.root):
+            if entry.path in self._reserved:
+                continue
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+            self.stats["cleaned"] += 1
+
+    async def _reserve(self, workdir_prefix: str, need: int) -> str:
+        if need > self.quota:
+            self.stats["rejected"] += 1
+            raise FileTooLarge(f"для обработки нужно {need / 1024 ** 2:.0f} МБ, квота {self.quota / 1024 ** 2:.0f} МБ")
+        async with self._space:
+            if self.reserved + need > self.quota:
+                self.stats["waited"] += 1
+                await self._space.wait_for(lambda: self.reserved + need <= self.quota)
+            os.makedirs(self.root, exist_ok=True)
+            if shutil.disk_usage(self.root).free < need:
+                raise StagingError("на диске нет места для обработки")
+            workdir = tempfile.mkdtemp(prefix=workdir_prefix, dir=self.root)
+            self._reserved[workdir] = need
+            return workdir
+
+    async def _release(self, workdir: str):
+        await asyncio.to_thread(shutil.rmtree, workdir, True)
+        async with self._space:
+            self._reserved.pop(workdir, None)
+            self._space.notify_all()
+
+    async def _download(self, file_path: str, size: int, destination: str):
+        api = self.bot.session.api
+        if api.is_local:
+            # Локальный Bot API-сервер отдаёт путь на диске: копия ядром, без буфера в памяти
+            await asyncio.to_thread(shutil.copyfile, str(api.wrap_local_file.to_local(file_path)), destination)
+            return
+
+        # Таймаут на всю загрузку — от размера файла и минимальной приемлемой скорости
+        timeout = 30 + size // self.min_speed
+        written = 0
+        with open(destination, "wb") as f:
+            stream = self.bot.session.stream_content(
+                api.file_url(self.bot.token, file_path),
+                timeout=timeout,
+                chunk_size=self.chunk_size,
+            )
+            try:
+                async for chunk in stream:
+                    written += len(chunk)
+                    if written > self.max_file_size:
+                        raise FileTooLarge("файл оказался больше лимита")
+                    await asyncio.to_thread(f.write, chunk)
+            finally:
+                await stream.aclose()
+        self.stats["bytes"] += written
+
+    @asynccontextmanager
+    async def staged(self, file_id: str, file_size: int = None, prefix: str = "job-"):
+        """Скачать файл в новый рабочий каталог; каталог удаляется при выходе из блока"""
+        self.check_size(file_size)
+        async with self._downloads:
+            try:
+                file = await self.bot.get_file(file_id)
+            except Exception as e:
+                raise StagingError(f"getFile: {e}") from e
+            size = file.file_size or file_size or self.max_file_size
+            self.check_size(size)
+            workdir = await self._reserve(prefix, int(size * self.headroom))
+            source = os.path.join(workdir, "source")
+            started = time.monotonic()
+            try:
+                await self._download(file.file_path, size, source)
+            except FileTooLarge:
+                await self._release(workdir)
+                raise
+            except BaseException as e:
+                await self._release(workdir)
+                if isinstance(e, Exception):
+                    raise StagingError(f"загрузка: {e}") from e
+                raise
+        self.stats["staged"] += 1
+        logger.info(f"Загружено {size / 1024 ** 2:.1f} МБ за {time.monotonic() - started:.1f} с")
+        try:
+            yield workdir, source
+        finally:
+            await self._release(workdir)
+
+    @asynccontextmanager
+    async def local(self, path: str, prefix: str = "job-"):
+        """Рабочий каталог для файла, который уже лежит на диске (загрузка из Mini App); файл не удаляется"""
+        size = os.path.getsize(path)
+        # Исходник уже занимает место, резервируем только под промежуточные файлы
+        workdir = await self._reserve(prefix, int(size * max(self.headroom - 1, 0)))
+        self.stats["staged"] += 1
+        try:
+            yield workdir, path
+        finally:
+            await self._release(workdir)
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "reserved": self.reserved, "quota": self.quota, "active": len(self._reserved)}
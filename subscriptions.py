@@ -0,0 +1,226 @@
+"""
+Индекс подписчиков канала в таблице channel_members: обновляется из апдейтов chat_member,
+из живых проверок getChatMember и фоновой сверкой устаревших записей с ограничением скорости.
+Сверку ведёт одна реплика (аренда в таблице leases), иначе лимит getChatMember умножался бы на их число.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from psycopg2.extras import execute_values
+
+from broadcast import TokenBucket
+from db import Database
+from leases import Lease
+from write_behind import WriteBehindBuffer
+
+logger = logging.getLogger(__name__)
+
+MEMBER_STATUSES = ("creator", "administrator", "member", "restricted")
+
+
+def is_member(status: str) -> bool:
+    return status in MEMBER_STATUSES
+
+
+class SubscriptionIndex:
+    """Состояние подписки пользователей на один канал"""
+
+    def __init__(self, bot: Bot, db: Database, channel_id: str, max_age: float = 86400.0,
+                 rate: float = 5.0, concurrency: int = 5, batch_size: int = 200, interval: float = 60.0):
+        self.bot = bot
+        self.db = db
+        self.channel_id = str(channel_id)
+        self.max_age = max_age
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.interval = interval
+        self.writes = WriteBehindBuffer(self._flush, name="channel_members")
+        # Аренда переживает паузу между проходами и сам проход (batch_size проверок по rate в секунду)
+        self.lease = Lease(db, f"subscription-reconciler:{self.channel_id}",
+                           ttl=3 * interval + 2 * batch_size / rate)
+        # Обход пользователей по (joined, id) ищет тех, кого в индексе ещё нет
+        self._cursor = (datetime(1970, 1, 1), 0)
+        self._task = None
+        self.stats = {"index_hits": 0, "index_misses": 0, "live": 0, "events": 0,
+                      "reconciled": 0, "reconcile_errors": 0}
+
+    def matches(self, chat) -> bool:
+        """Апдейт относится к нашему каналу (CHANNEL_ID бывает числом или @username)"""
+        if self.channel_id.startswith("@"):
+            return (chat.username or "").lower() == self.channel_id[1:].lower()
+        return str(chat.id) == self.channel_id
+
+    async def _flush(self, rows: list):
+        def _upsert_members(cur):
+            # Более старое событие не перетирает более свежую проверку
+            execute_values(cur, """
+                INSERT INTO channel_members (channel_id, user_id, status, subscribed, checked, next_check)
+                VALUES %s
+                ON CONFLICT (channel_id, user_id) DO UPDATE SET
+                    status = EXCLUDED.status,
+                    subscribed = EXCLUDED.subscribed,
+                    checked = EXCLUDED.checked,
+                    next_check = EXCLUDED.next_check
+                WHERE channel_members.checked <= EXCLUDED.checked
+            """, rows, page_size=len(rows))
+
+        await self.db.run(_upsert_members, name="channel_members_upsert")
+
+    async def record(self, user_id: int, status: str, checked: datetime = None):
+        """Запомнить статус (запись откладывается и объединяется в пакет)"""
+        checked = checked or datetime.now(timezone.utc)
+        await self.writes.put(user_id, (
+            self.channel_id, user_id, status, is_member(status), checked,
+            checked + timedelta(seconds=self.max_age),
+        ))
+
+    async def on_event(self, event) -> bool:
+        """Апдейт chat_member: записать новый статус. False, если апдейт не про наш канал."""
+        if not self.matches(event.chat):
+            return False
+        self.stats["events"] += 1
+        await self.record(event.new_chat_member.user.id, event.new_chat_member.status, event.date)
+        return True
+
+    async def lookup(self, user_id: int):
+        """Свежая запись индекса {"subscribed", "status"} или None"""
+        row = await self.db.fetchone("""
+            SELECT subscribed, status FROM channel_members
+            WHERE channel_id = %s AND user_id = %s AND checked > now() - %s * interval '1 second'
+        """, (self.channel_id, user_id, self.max_age), name="subscription_lookup")
+        self.stats["index_hits" if row else "index_misses"] += 1
+        return row
+
+    async def fetch(self, user_id: int) -> str:
+        """Живая проверка getChatMember; результат попадает в индекс"""
+        self.stats["live"] += 1
+        member = await self.bot.get_chat_member(chat_id=self.channel_id, user_id=user_id)
+        await self.record(user_id, member.status)
+        return member.status
+
+    def start(self):
+        self.writes.start()
+        if self._task is None:
+            self._task = asyncio.create_task(self._reconcile_loop(), name="subscription-reconciler")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            await self.lease.release()
+        await self.writes.stop()
+
+    async def _due(self) -> tuple[list[int], int]:
+        """
+        Записи индекса, у которых подошёл срок сверки (по индексу на next_check).
+        Срок сразу сдвигается на max_age: неудачная проверка считается попыткой, и постоянно
+        падающие (удалённые аккаунты) не занимают каждый пакет. Возвращает активных и число записей.
+        """
+        rows = await self.db.fetchall("""
+            UPDATE channel_members SET next_check = now() + %(max_age)s * interval '1 second'
+            WHERE channel_id = %(channel)s AND user_id IN (
+                SELECT user_id FROM channel_members
+                WHERE channel_id = %(channel)s AND next_check < now()
+                ORDER BY next_check
+                LIMIT %(limit)s
+            )
+            RETURNING user_id, EXISTS (
+                SELECT 1 FROM users u WHERE u.id = channel_members.user_id AND u.active = TRUE
+            ) AS active
+        """, {"channel": self.channel_id, "max_age": self.max_age, "limit": self.batch_size},
+            name="subscription_due")
+        return [row["user_id"] for row in rows if row["active"]], len(rows)
+
+    async def _unindexed(self) -> tuple[list[int], int]:
+        """
+        Следующая страница активных пользователей по (joined, id) — те из них, кого нет в индексе.
+        После первого полного обхода страница содержит только новых пользователей.
+        """
+        rows = await self.db.fetchall("""
+            SELECT u.id, u.joined, EXISTS (
+                SELECT 1 FROM channel_members m WHERE m.channel_id = %(channel)s AND m.user_id = u.id
+            ) AS indexed
+            FROM users u
+            WHERE u.active = TRUE AND (u.joined, u.id) > (%(joined)s, %(id)s)
+            ORDER BY u.joined, u.id
+            LIMIT %(limit)s
+        """, {"channel": self.channel_id, "joined": self._cursor[0], "id": self._cursor[1],
+              "limit": self.batch_size}, name="subscription_unindexed")
+        if rows:
+            self._cursor = (rows[-1]["joined"], rows[-1]["id"])
+        return [row["id"] for row in rows if not row["indexed"]], len(rows)
+
+    async def _record_failures(self, user_ids: list):
+        """Не проверенные новые пользователи попадают в индекс без статуса и ждут следующего срока"""
+        def _insert_failures(cur):
+            execute_values(cur, """
+                INSERT INTO channel_members (channel_id, user_id, status, subscribed, checked, next_check)
+                VALUES %s
+                ON CONFLICT (channel_id, user_id) DO NOTHING
+            """, [(self.channel_id, user_id, self.max_age) for user_id in user_ids],
+                template="(%s, %s, 'unknown', FALSE, '-infinity', now() + %s * interval '1 second')",
+                page_size=len(user_ids))
+
+        await self.db.run(_insert_failures, name="subscription_failures")
+
+    async def _recheck(self, user_id: int) -> bool:
+        """Проверка одного пользователя; False — не удалась"""
+        while True:
+            await self.bucket.acquire()
+            try:
+                await self.fetch(user_id)
+                self.stats["reconciled"] += 1
+                return True
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+            except Exception as e:
+                self.stats["reconcile_errors"] += 1
+                logger.debug(f"Сверка подписки {user_id} не удалась: {e}")
+                return False
+
+    async def _reconcile_loop(self):
+        while True:
+            due, unindexed = [], []
+            due_rows = page_rows = 0
+            try:
+                if await self.lease.acquire():
+                    due, due_rows = await self._due()
+                    unindexed, page_rows = await self._unindexed()
+            except Exception as e:
+                logger.error(f"Сверка подписок: ошибка БД: {e}")
+            errors = self.stats["reconcile_errors"]
+            if due or unindexed:
+                queue = asyncio.Queue()
+                for user_id in due + unindexed:
+                    queue.put_nowait(user_id)
+                new_users = set(unindexed)
+                failures = []
+
+                async def worker():
+                    while not queue.empty():
+                        user_id = queue.get_nowait()
+                        if not await self._recheck(user_id) and user_id in new_users:
+                            failures.append(user_id)
+
+                await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+                await self.writes.flush()
+                if failures:
+                    try:
+                        await self._record_failures(failures)
+                    except Exception as e:
+                        logger.error(f"Сверка подписок: не удалось записать ошибки: {e}")
+            # Полная страница без ошибок — сразу следующая, иначе ждём (ошибки обычно не проходят сами)
+            backlog = due_rows == self.batch_size or page_rows == self.batch_size
+            if not backlog or self.stats["reconcile_errors"] > errors:
+                await asyncio.sleep(self.interval)
+
+    def snapshot(self) -> dict:
+        stats = dict(self.stats)
+        lookups = stats["index_hits"] + stats["index_misses"]
+        stats["hit_rate"] = stats["index_hits"] / lookups if lookups else 0.0
+        return stats
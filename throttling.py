@@ -0,0 +1,127 @@
+"""
+Антифлуд: ограничение частоты апдейтов от одного пользователя (скользящее окно)
+с настройкой через флаги хендлера и объединением повторных нажатий одной кнопки.
+"""
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+from cache import TTLCache
+
+
+class SlidingWindowLimiter:
+    """
+    Приближённое скользящее окно на двух счётчиках (текущее и прошлое окно).
+    Состояние одного ключа — кортеж из четырёх чисел (последнее — когда сообщили о лимите),
+    устаревшие ключи периодически удаляются, при переполнении вытесняются по LRU.
+    """
+
+    def __init__(self, maxsize: int = 100_000):
+        self._state = TTLCache(maxsize=maxsize, name="throttling")
+
+    def hit(self, key, limit: int, window: float) -> bool:
+        """Учесть событие. False — лимит превышен."""
+        now = time.monotonic()
+        window_start, current, previous, notified = self._state.get(key) or (now, 0, 0, None)
+
+        elapsed = now - window_start
+        if elapsed >= window:
+            # Сдвигаем окно; если пропущено больше одного окна, прошлое обнуляется
+            previous = current if elapsed < 2 * window else 0
+            current = 0
+            window_start = now - (elapsed % window)
+            elapsed = now - window_start
+
+        estimate = previous * (1 - elapsed / window) + current
+        allowed = estimate < limit
+        if allowed:
+            current += 1
+        self._state.set(key, (window_start, current, previous, notified), ttl=2 * window)
+        return allowed
+
+    def notify_once(self, key, window: float) -> bool:
+        """True, если о превышении лимита по ключу ещё не сообщали в течение окна"""
+        state = self._state.get(key)
+        now = time.monotonic()
+        if state is None or (state[3] is not None and now - state[3] < window):
+            return False
+        self._state.set(key, state[:3] + (now,), ttl=2 * window)
+        return True
+
+    def __len__(self):
+        return len(self._state)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Лимит задаётся флагом хендлера: flags={"throttling": {"limit": 3, "window": 10}}.
+    Без флага действует лимит по умолчанию, flags={"throttling": False} отключает лимит.
+    Ключ окна — (пользователь, хендлер).
+    """
+
+    def __init__(self, limit: int = 5, window: float = 10.0, exempt: set = None, maxsize: int = 100_000):
+        self.limit = limit
+        self.window = window
+        self.exempt = exempt or set()
+        self.limiter = SlidingWindowLimiter(maxsize=maxsize)
+        self._inflight = set()
+        self.stats = {"passed": 0, "throttled": 0, "merged": 0}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = getattr(event, "from_user", None)
+        if user is None or user.id in self.exempt:
+            return await handler(event, data)
+
+        options = get_flag(data, "throttling")
+        if options is False:
+            return await handler(event, data)
+        options = options or {}
+        limit = options.get("limit", self.limit)
+        window = options.get("window", self.window)
+        name = data["handler"].callback.__name__
+
+        # Повторное нажатие той же кнопки, пока первое ещё обрабатывается, — один ответ на всех
+        inflight_key = None
+        if isinstance(event, CallbackQuery):
+            inflight_key = (user.id, event.data)
+            if inflight_key in self._inflight:
+                self.stats["merged"] += 1
+                await event.answer()
+                return None
+
+        if not self.limiter.hit((user.id, name), limit, window):
+            self.stats["throttled"] += 1
+            await self._notify(event, user.id, name, window)
+            return None
+
+        self.stats["passed"] += 1
+        if inflight_key is None:
+            return await handler(event, data)
+        self._inflight.add(inflight_key)
+        try:
+            return await handler(event, data)
+        finally:
+            self._inflight.discard(inflight_key)
+
+    async def _notify(self, event: TelegramObject, user_id: int, name: str, window: float):
+        """Сообщить о лимите не чаще раза за окно, чтобы не тратить квоту на флудера"""
+        if isinstance(event, CallbackQuery):
+            # На callback ответить нужно всегда, иначе у пользователя крутится индикатор
+            await event.answer("⏳ Слишком часто, подождите немного")
+            return
+        if not self.limiter.notify_once((user_id, name), window):
+            return
+        if isinstance(event, Message):
+            await event.answer("⏳ Слишком много запросов, попробуйте через несколько секунд.")
+
+    def snapshot(self) -> dict:
+        """Счётчики антифлуда"""
+        return {**self.stats, "tracked": len(self.limiter)}
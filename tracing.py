@@ -0,0 +1,200 @@
+"""
+Трассировка апдейтов: спаны для диспетчера, хендлеров, вызовов Bot API и запросов к БД.
+Сохраняется доля трасс по sample_rate плюс все медленные и упавшие (решение в конце трассы).
+Экспорт — JSONL с ротацией, одна трасса на строку в раскладке OTLP/JSON (resourceSpans).
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import random
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "upscale-video-bot"
+MAX_SPANS_PER_TRACE = 256
+
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_current = contextvars.ContextVar("current_span", default=None)
+
+
+def _attribute(key, value) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        # В OTLP/JSON int64 передаётся строкой
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class _Trace:
+    __slots__ = ("trace_id", "sampled", "spans", "dropped")
+
+    def __init__(self, trace_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans = []
+        self.dropped = 0
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns",
+                 "attributes", "status", "status_message")
+
+    def __init__(self, trace: _Trace, name: str, parent_id: str = "", kind: int = 1, attributes: dict = None):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = dict(attributes or {})
+        self.status = STATUS_UNSET
+        self.status_message = ""
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_error(self, error: BaseException):
+        self.status = STATUS_ERROR
+        self.status_message = f"{type(error).__name__}: {error}"
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [_attribute(k, v) for k, v in self.attributes.items()],
+            "status": {"code": self.status},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.status_message:
+            span["status"]["message"] = self.status_message
+        return span
+
+
+class Tracer:
+    """Сэмплирующий трассировщик с хвостовым отбором медленных трасс"""
+
+    def __init__(self):
+        self.sample_rate = 0.0
+        self.slow_threshold = 1.0
+        self._writer = None
+        self.stats = {"traces": 0, "exported": 0, "slow": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self._writer is not None
+
+    def configure(self, path: str, sample_rate: float = 0.01, slow_threshold: float = 1.0,
+                  max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5):
+        """Включить экспорт в ротируемый JSONL-файл"""
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        writer = logging.getLogger(f"{__name__}.export")
+        writer.propagate = False
+        writer.setLevel(logging.INFO)
+        writer.handlers = [handler]
+        self._writer = writer
+        logger.info(f"Трассировка: {path}, сэмплинг {sample_rate:.1%}, медленные от {slow_threshold * 1000:.0f} мс")
+
+    @contextmanager
+    def trace(self, name: str, **attributes):
+        """Корневой спан новой трассы (на каждый апдейт)"""
+        if not self.enabled:
+            yield None
+            return
+        trace = _Trace(os.urandom(16).hex(), random.random() < self.sample_rate)
+        root = Span(trace, name, kind=2, attributes=attributes)
+        token = _current.set(root)
+        try:
+            yield root
+        except BaseException as e:
+            root.set_error(e)
+            raise
+        finally:
+            _current.reset(token)
+            root.end_ns = time.time_ns()
+            trace.spans.append(root)
+            self._finish(trace, root)
+
+    @staticmethod
+    def background(coro, name: str = None) -> asyncio.Task:
+        """
+        Задача с чистым контекстом: долгая работа, запущенная из хендлера (рассылка), иначе
+        унаследовала бы его спан и дописывала дочерние в уже экспортированную трассу.
+        Своя трасса открывается внутри задачи через trace().
+        """
+        return asyncio.create_task(coro, name=name, context=contextvars.Context())
+
+    @contextmanager
+    def span(self, name: str, kind: int = 1, **attributes):
+        """Дочерний спан текущей трассы; вне трассы ничего не делает"""
+        parent = _current.get()
+        if parent is None:
+            yield None
+            return
+        span = Span(parent.trace, name, parent_id=parent.span_id, kind=kind, attributes=attributes)
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set_error(e)
+            raise
+        finally:
+            _current.reset(token)
+            span.end_ns = time.time_ns()
+            if len(span.trace.spans) < MAX_SPANS_PER_TRACE:
+                span.trace.spans.append(span)
+            else:
+                span.trace.dropped += 1
+
+    def _finish(self, trace: _Trace, root: Span):
+        self.stats["traces"] += 1
+        duration = (root.end_ns - root.start_ns) / 1e9
+        slow = duration >= self.slow_threshold
+        failed = any(span.status == STATUS_ERROR for span in trace.spans)
+        if not (trace.sampled or slow or failed):
+            return
+        if slow:
+            self.stats["slow"] += 1
+        if trace.dropped:
+            root.set_attribute("trace.dropped_spans", trace.dropped)
+        record = {
+            "resourceSpans": [{
+                "resource": {"attributes": [_attribute("service.name", SERVICE_NAME)]},
+                "scopeSpans": [{
+                    "scope": {"name": __name__},
+                    "spans": [span.to_otlp() for span in trace.spans],
+                }],
+            }]
+        }
+        try:
+            self._writer.info(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+            self.stats["exported"] += 1
+        except Exception as e:
+            logger.error(f"Не удалось записать трассу: {e}")
+
+
+tracer = Tracer()
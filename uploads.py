@@ -0,0 +1,434 @@
+"""
+Возобновляемая загрузка видео из Mini App по частям, в обход лимита Bot API на скачивание ботом.
+Клиент создаёт загрузку, шлёт чанки с указанием смещения и SHA-256 и после обрыва связи
+спрашивает подтверждённое смещение, с которого продолжать. Запросы подписаны initData Mini App.
+
+Файлы загрузок лежат на диске этого процесса: при нескольких хостах UPLOAD_DIR должен быть общим.
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import secrets
+import shutil
+import time
+from typing import Awaitable, Callable
+from urllib.parse import parse_qsl
+
+from aiohttp import StreamReader, web
+
+logger = logging.getLogger(__name__)
+
+UPLOADING = "uploading"
+COMPLETE = "complete"
+QUEUED = "queued"
+
+CHECKSUM_HEADER = "X-Chunk-SHA256"
+_UPLOAD_ID = re.compile(r"^[A-Za-z0-9_-]{22}$")
+_READ_SIZE = 256 * 1024
+
+
+class InitDataError(Exception):
+    """initData Mini App не прошла проверку"""
+
+
+def verify_init_data(init_data: str, bot_token: str, max_age: float = 86400.0) -> dict:
+    """Проверка подписи initData (HMAC-SHA256 от токена бота). Возвращает пользователя из initData."""
+    try:
+        fields = dict(parse_qsl(init_data, keep_blank_values=True, strict_parsing=True))
+    except ValueError as e:
+        raise InitDataError("initData не разбирается") from e
+    received = fields.pop("hash", "")
+    check_string = "\n".join(f"{key}={fields[key]}" for key in sorted(fields))
+    secret = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+    expected = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(received, expected):
+        raise InitDataError("неверная подпись initData")
+
+    try:
+        auth_date = int(fields.get("auth_date", "0"))
+        user = json.loads(fields["user"])
+        user_id = int(user["id"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise InitDataError("в initData нет пользователя") from e
+    if time.time() - auth_date > max_age:
+        raise InitDataError("initData устарела, откройте Mini App заново")
+    return {**user, "id": user_id}
+
+
+class UploadError(Exception):
+    """Запрос загрузки отклонён: status — HTTP-код, extra — дополнительные поля ответа"""
+
+    def __init__(self, message: str, status: int = 400, **extra):
+        super().__init__(message)
+        self.status = status
+        self.extra = extra
+
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(1024 * 1024):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class UploadStore:
+    """
+    Загрузки на диске: <id>.part с данными и <id>.json с подтверждённым смещением.
+    Смещение в .json сдвигается только после записи и fsync чанка с верной контрольной суммой,
+    поэтому после падения процесса хвост .part за смещением просто перезаписывается.
+    """
+
+    def __init__(self, root: str = ".cache/uploads", max_size: int = 50 * 1024 ** 2,
+                 chunk_size: int = 8 * 1024 ** 2, quota: int = 10 * 1024 ** 3, per_user: int = 2,
+                 ttl: float = 86400.0, queued_ttl: float = 7 * 86400.0):
+        self.root = root
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.quota = quota
+        self.per_user = per_user
+        self.ttl = ttl
+        self.queued_ttl = queued_ttl
+        self._uploads = {}
+        self._locks = {}
+        self.stats = {"created": 0, "resumed": 0, "chunks": 0, "bytes": 0, "bad_checksum": 0,
+                      "completed": 0, "expired": 0}
+
+    @property
+    def reserved(self) -> int:
+        return sum(upload["size"] for upload in self._uploads.values())
+
+    def path(self, upload_id: str) -> str:
+        """Путь к данным загрузки (для обработки завершённого файла)"""
+        return os.path.join(self.root, f"{upload_id}.part")
+
+    def _meta_path(self, upload_id: str) -> str:
+        return os.path.join(self.root, f"{upload_id}.json")
+
+    def _save(self, upload: dict):
+        tmp = self._meta_path(upload["id"]) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(upload, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._meta_path(upload["id"]))
+
+    def load(self):
+        """Поднять незавершённые загрузки после перезапуска (вызывать при старте)"""
+        os.makedirs(self.root, exist_ok=True)
+        for entry in os.scandir(self.root):
+            upload_id, ext = os.path.splitext(entry.name)
+            if ext != ".json":
+                continue
+            try:
+                with open(entry.path, encoding="utf-8") as f:
+                    upload = json.load(f)
+                if not os.path.exists(self.path(upload_id)):
+                    raise FileNotFoundError(self.path(upload_id))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Загрузка {upload_id} повреждена и удалена: {e}")
+                self.discard(upload_id)
+                continue
+            self._uploads[upload_id] = upload
+        # Данные без метаданных остаются от прерванного create или discard
+        for entry in os.scandir(self.root):
+            upload_id, ext = os.path.splitext(entry.name)
+            if upload_id not in self._uploads:
+                os.remove(entry.path)
+        logger.info(f"Загрузок на диске: {len(self._uploads)}, {self.reserved / 1024 ** 2:.0f} МБ")
+
+    def create(self, user_id: int, size: int, name: str = "") -> dict:
+        """Новая загрузка; место под неё резервируется сразу"""
+        if size <= 0:
+            raise UploadError("пустой файл")
+        if size > self.max_size:
+            raise UploadError(f"файл больше {self.max_size // 1024 ** 2} МБ", 413)
+        active = sum(1 for upload in self._uploads.values()
+                     if upload["user_id"] == user_id and upload["state"] != QUEUED)
+        if active >= self.per_user:
+            raise UploadError("дождитесь окончания других загрузок", 429)
+        os.makedirs(self.root, exist_ok=True)
+        if self.reserved + size > self.quota or shutil.disk_usage(self.root).free < size:
+            raise UploadError("сервер сейчас перегружен, попробуйте позже", 507)
+
+        now = time.time()
+        upload = {
+            "id": secrets.token_urlsafe(16),
+            "user_id": user_id,
+            "name": name[:255],
+            "size": size,
+            "offset": 0,
+            "state": UPLOADING,
+            "sha256": None,
+            "created": now,
+            "updated": now,
+        }
+        open(self.path(upload["id"]), "wb").close()
+        self._save(upload)
+        self._uploads[upload["id"]] = upload
+        self.stats["created"] += 1
+        return upload
+
+    def get(self, upload_id: str, user_id: int) -> dict:
+        """Загрузка пользователя; чужие и несуществующие неотличимы (404)"""
+        upload = self._uploads.get(upload_id) if _UPLOAD_ID.match(upload_id) else None
+        if upload is None or upload["user_id"] != user_id:
+            raise UploadError("загрузка не найдена", 404)
+        return upload
+
+    def _lock(self, upload_id: str) -> asyncio.Lock:
+        lock = self._locks.get(upload_id)
+        if lock is None:
+            lock = self._locks[upload_id] = asyncio.Lock()
+        return lock
+
+    async def write(self, upload_id: str, user_id: int, offset: int, length: int,
+                    content: StreamReader, checksum: str) -> dict:
+        """Дописать чанк по смещению; тело пишется на диск по мере чтения"""
+        upload = self.get(upload_id, user_id)
+        lock = self._lock(upload_id)
+        if lock.locked():
+            raise UploadError("чанк уже загружается", 409, offset=upload["offset"])
+        async with lock:
+            if upload["state"] != UPLOADING:
+                raise UploadError("загрузка уже завершена", 409, offset=upload["offset"])
+            if offset != upload["offset"]:
+                raise UploadError("неверное смещение", 409, offset=upload["offset"])
+            if not 0 < length <= self.chunk_size or offset + length > upload["size"]:
+                raise UploadError(f"чанк должен быть от 1 байта до {self.chunk_size} и не выходить за файл", 413)
+
+            digest = hashlib.sha256()
+            written = 0
+            f = await asyncio.to_thread(open, self.path(upload_id), "r+b")
+            try:
+                await asyncio.to_thread(f.truncate, offset)
+                f.seek(offset)
+                async for piece in content.iter_chunked(_READ_SIZE):
+                    written += len(piece)
+                    if written > length:
+                        raise UploadError("тело длиннее Content-Length")
+                    digest.update(piece)
+                    await asyncio.to_thread(f.write, piece)
+                if written != length:
+                    raise UploadError("чанк оборван", 400, offset=offset)
+                if not hmac.compare_digest(digest.hexdigest(), checksum.lower()):
+                    self.stats["bad_checksum"] += 1
+                    raise UploadError("контрольная сумма не совпала", 422, offset=offset)
+                await asyncio.to_thread(f.flush)
+                await asyncio.to_thread(os.fsync, f.fileno())
+            except BaseException:
+                # Обрыв связи, неверная сумма или отмена: частично записанный чанк отбрасываем
+                await asyncio.to_thread(f.truncate, offset)
+                raise
+            finally:
+                await asyncio.to_thread(f.close)
+
+            upload["offset"] = offset + length
+            upload["updated"] = time.time()
+            await asyncio.to_thread(self._save, upload)
+            self.stats["chunks"] += 1
+            self.stats["bytes"] += length
+            return upload
+
+    async def complete(self, upload_id: str, user_id: int,
+                       handoff: Callable[[dict], Awaitable[dict]]) -> dict:
+        """
+        Завершить загрузку и передать файл в обработку. handoff получает загрузку с sha256
+        и возвращает поля ответа; state "done" в ответе — файл больше не нужен.
+        Повторный вызов после успешной передачи ничего не делает.
+        """
+        self.get(upload_id, user_id)
+        async with self._lock(upload_id):
+            # Параллельный вызов мог уже передать и удалить загрузку
+            upload = self.get(upload_id, user_id)
+            if upload["state"] == QUEUED:
+                return {"state": QUEUED}
+            if upload["offset"] != upload["size"]:
+                raise UploadError("файл загружен не полностью", 409, offset=upload["offset"])
+            if upload["state"] == UPLOADING:
+                upload["sha256"] = await asyncio.to_thread(_file_sha256, self.path(upload_id))
+                upload["state"] = COMPLETE
+                await asyncio.to_thread(self._save, upload)
+                self.stats["completed"] += 1
+
+            result = await handoff(dict(upload))
+            if result.get("state") == "done":
+                self.discard(upload_id)
+            else:
+                upload["state"] = QUEUED
+                upload["updated"] = time.time()
+                await asyncio.to_thread(self._save, upload)
+            return result
+
+    def discard(self, upload_id: str):
+        """Удалить загрузку (после обработки или по истечении срока)"""
+        self._uploads.pop(upload_id, None)
+        self._locks.pop(upload_id, None)
+        for path in (self.path(upload_id), self._meta_path(upload_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def sweep(self):
+        """Удалить брошенные загрузки и файлы из очереди, которые так и не забрали"""
+        now = time.time()
+        for upload_id, upload in list(self._uploads.items()):
+            ttl = self.queued_ttl if upload["state"] == QUEUED else self.ttl
+            lock = self._locks.get(upload_id)
+            if now - upload["updated"] > ttl and not (lock and lock.locked()):
+                self.discard(upload_id)
+                self.stats["expired"] += 1
+
+    def snapshot(self) -> dict:
+        states = {UPLOADING: 0, COMPLETE: 0, QUEUED: 0}
+        for upload in self._uploads.values():
+            states[upload["state"]] += 1
+        return {**self.stats, **states, "reserved": self.reserved, "quota": self.quota}
+
+
+def _authorized(handler):
+    """
+    Обработчик UploadServer с проверенным пользователем; ошибки — JSON-ответом с CORS-заголовками.
+    Без них браузер покажет Mini App непрозрачную сетевую ошибку вместо ответа, который можно повторить.
+    """
+    async def wrapper(self, request: web.Request) -> web.Response:
+        try:
+            return await handler(self, request, await self._user(request))
+        except UploadError as e:
+            return self._json({"error": str(e), **e.extra}, e.status)
+        except Exception as e:
+            logger.exception(f"Загрузка {request.method} {request.path}: {e}")
+            return self._json({"error": "ошибка сервера, повторите запрос"}, 500)
+    return wrapper
+
+
+class UploadServer:
+    """
+    HTTP-интерфейс загрузок (все запросы с заголовком Authorization: tma <initData>):
+    POST {path} {"name", "size"} — создать; GET {path}/{id} — подтверждённое смещение;
+    PUT {path}/{id}?offset=N с заголовком X-Chunk-SHA256 — чанк; POST {path}/{id}/complete — в обработку.
+    """
+
+    def __init__(self, store: UploadStore, bot_token: str, handoff: Callable[[dict], Awaitable[dict]],
+                 authorize: Callable[[int], Awaitable[bool]] = None, path: str = "/upload",
+                 cors_origin: str = "*", init_data_max_age: float = 86400.0, sweep_interval: float = 600.0):
+        self.store = store
+        self.bot_token = bot_token
+        self.handoff = handoff
+        self.authorize = authorize
+        self.path = path.rstrip("/")
+        self.init_data_max_age = init_data_max_age
+        self.sweep_interval = sweep_interval
+        # Авторизация по заголовку, не по cookie, поэтому любой origin безопасен
+        self.cors_headers = {
+            "Access-Control-Allow-Origin": cors_origin,
+            "Access-Control-Allow-Methods": "GET, POST, PUT, OPTIONS",
+            "Access-Control-Allow-Headers": f"Authorization, Content-Type, {CHECKSUM_HEADER}",
+            "Access-Control-Max-Age": "86400",
+        }
+        self._task = None
+        self._runner = None
+
+    def _json(self, data: dict, status: int = 200) -> web.Response:
+        return web.json_response(data, status=status, headers=self.cors_headers)
+
+    @staticmethod
+    def _public(upload: dict) -> dict:
+        return {key: upload[key] for key in ("id", "name", "size", "offset", "state")}
+
+    async def _user(self, request: web.Request) -> int:
+        scheme, _, init_data = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "tma" or not init_data:
+            raise UploadError("нужна авторизация Mini App", 401)
+        try:
+            user_id = verify_init_data(init_data, self.bot_token, self.init_data_max_age)["id"]
+        except InitDataError as e:
+            raise UploadError(str(e), 401) from e
+        return user_id
+
+    @_authorized
+    async def create(self, request: web.Request, user_id: int) -> web.Response:
+        try:
+            data = await request.json()
+            size, name = int(data["size"]), str(data.get("name", ""))
+        except (KeyError, TypeError, ValueError) as e:
+            raise UploadError("ожидается JSON с size") from e
+        if self.authorize is not None and not await self.authorize(user_id):
+            raise UploadError("сначала подпишитесь на канал", 403)
+        upload = self.store.create(user_id, size, name)
+        logger.info(f"Загрузка {upload['id']} от {user_id}: {size / 1024 ** 2:.1f} МБ")
+        return self._json({**self._public(upload), "chunk_size": self.store.chunk_size}, 201)
+
+    @_authorized
+    async def status(self, request: web.Request, user_id: int) -> web.Response:
+        upload = self.store.get(request.match_info["upload_id"], user_id)
+        if upload["offset"]:
+            self.store.stats["resumed"] += 1
+        return self._json({**self._public(upload), "chunk_size": self.store.chunk_size})
+
+    @_authorized
+    async def chunk(self, request: web.Request, user_id: int) -> web.Response:
+        try:
+            offset = int(request.query["offset"])
+        except (KeyError, ValueError) as e:
+            raise UploadError("нужен параметр offset") from e
+        checksum = request.headers.get(CHECKSUM_HEADER)
+        if not checksum or request.content_length is None:
+            raise UploadError(f"нужны заголовки Content-Length и {CHECKSUM_HEADER}", 411)
+        upload = await self.store.write(
+            request.match_info["upload_id"], user_id, offset, request.content_length, request.content, checksum
+        )
+        return self._json(self._public(upload))
+
+    @_authorized
+    async def complete(self, request: web.Request, user_id: int) -> web.Response:
+        result = await self.store.complete(request.match_info["upload_id"], user_id, self.handoff)
+        return self._json(result)
+
+    async def preflight(self, request: web.Request) -> web.Response:
+        return web.Response(status=204, headers=self.cors_headers)
+
+    def setup(self, app: web.Application):
+        """Подключить маршруты к приложению (например, к серверу вебхука)"""
+        app.router.add_post(self.path, self.create)
+        app.router.add_get(self.path + "/{upload_id}", self.status)
+        app.router.add_put(self.path + "/{upload_id}", self.chunk)
+        app.router.add_post(self.path + "/{upload_id}/complete", self.complete)
+        app.router.add_route("OPTIONS", self.path + "{tail:.*}", self.preflight)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                self.store.sweep()
+            except Exception as e:
+                logger.error(f"Очистка загрузок: {e}")
+
+    def start(self):
+        """Поднять загрузки с диска и запустить периодическую очистку"""
+        self.store.load()
+        if self._task is None:
+            self._task = asyncio.create_task(self._sweep_loop(), name="upload-sweeper")
+
+    async def serve(self, host: str, port: int):
+        """Отдельный HTTP-сервер загрузок (для режима поллинга)"""
+        app = web.Application()
+        self.setup(app)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Загрузки слушают {host}:{port}{self.path}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
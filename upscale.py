@@ -0,0 +1,236 @@
+"""
+Апскейл видео на сервере: нарезка по ключевым кадрам без перекодирования,
+параллельное масштабирование сегментов в пуле процессов (CPU-фильтр scale, lanczos)
+и склейка готовых сегментов concat-демуксером тоже без перекодирования.
+"""
+import asyncio
+import csv
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import UPSCALE_LATENCY
+
+logger = logging.getLogger(__name__)
+
+FFMPEG = shutil.which("ffmpeg")
+FFPROBE = shutil.which("ffprobe")
+
+
+class UpscaleError(Exception):
+    """ffmpeg не смог прочитать или обработать видео"""
+
+
+class UpscaleTimeout(UpscaleError):
+    """ffmpeg не уложился во время и убит; в отличие от прочих ошибок, повтор может помочь"""
+
+
+def _run(args: list, timeout: float = None) -> bytes:
+    try:
+        # По истечении времени subprocess.run убивает процесс, так что зависший ffmpeg не держит воркер пула
+        result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise UpscaleTimeout(f"{os.path.basename(args[0])}: превышено время {timeout:.0f} с")
+    if result.returncode != 0:
+        tail = result.stderr.decode(errors="replace").strip().splitlines()[-3:]
+        raise UpscaleError(f"{os.path.basename(args[0])}: {' | '.join(tail) or result.returncode}")
+    return result.stdout
+
+
+def probe(path: str) -> dict:
+    """Размер кадра, длительность и наличие звука"""
+    output = _run([
+        FFPROBE, "-v", "error",
+        "-show_entries", "stream=codec_type,width,height:format=duration",
+        "-of", "json", path,
+    ], timeout=60)
+    info = json.loads(output)
+    video = next((s for s in info.get("streams", []) if s.get("codec_type") == "video"), None)
+    if video is None:
+        raise UpscaleError("в файле нет видеодорожки")
+    return {
+        "width": int(video["width"]),
+        "height": int(video["height"]),
+        "duration": float(info.get("format", {}).get("duration") or 0),
+        "audio": any(s.get("codec_type") == "audio" for s in info["streams"]),
+    }
+
+
+def target_size(width: int, height: int, factor: float, max_side: int):
+    """Итоговый размер кадра (чётный, не больше max_side) или None, если увеличивать некуда"""
+    scale = min(factor, max_side / max(width, height))
+    if scale <= 1:
+        return None
+    return int(width * scale) // 2 * 2, int(height * scale) // 2 * 2
+
+
+def split(src: str, workdir: str, segment_seconds: float, timeout: float = None) -> list[tuple[str, float]]:
+    """
+    Нарезка видеодорожки на сегменты; при -c copy разрез идёт только по ключевым кадрам,
+    поэтому сегмент бывает длиннее segment_seconds. Возвращает пути сегментов с длительностями.
+    """
+    pattern = os.path.join(workdir, "src%05d.mkv")
+    listing = os.path.join(workdir, "segments.csv")
+    _run([
+        FFMPEG, "-hide_banner", "-loglevel", "error", "-y", "-i", src,
+        "-map", "0:v:0", "-an", "-c", "copy",
+        "-f", "segment", "-segment_time", str(segment_seconds), "-reset_timestamps", "1",
+        "-segment_list", listing, "-segment_list_type", "csv",
+        pattern,
+    ], timeout=timeout)
+    segments = []
+    with open(listing, encoding="utf-8") as f:
+        for row in csv.reader(f):
+            # Строка списка: имя файла, начало, конец (в секундах)
+            segments.append((os.path.join(workdir, os.path.basename(row[0])), float(row[2]) - float(row[1])))
+    if not segments:
+        raise UpscaleError("не удалось нарезать видео")
+    return segments
+
+
+def upscale_segment(src: str, dst: str, width: int, height: int, crf: int, preset: str,
+                    timeout: float = None) -> str:
+    """
+    Масштабирование одного сегмента (выполняется в процессе пула).
+    ffmpeg ограничен одним потоком: параллельность даёт пул, по сегменту на ядро.
+    """
+    _run([
+        FFMPEG, "-hide_banner", "-loglevel", "error", "-y", "-i", src,
+        "-filter_threads", "1", "-vf", f"scale={width}:{height}:flags=lanczos",
+        "-c:v", "libx264", "-preset", preset, "-crf", str(crf), "-pix_fmt", "yuv420p",
+        "-threads", "1", dst,
+    ], timeout=timeout)
+    return dst
+
+
+def concat(segments: list[str], audio_src: str, dst: str, with_audio: bool, timeout: float = None):
+    """Склейка сегментов без перекодирования; звук берётся из исходника"""
+    listing = os.path.join(os.path.dirname(dst), "segments.txt")
+    with open(listing, "w", encoding="utf-8") as f:
+        for path in segments:
+            f.write(f"file '{os.path.abspath(path)}'\n")
+    args = [FFMPEG, "-hide_banner", "-loglevel", "error", "-y", "-f", "concat", "-safe", "0", "-i", listing]
+    if not with_audio:
+        _run(args + ["-c", "copy", "-movflags", "+faststart", dst], timeout=timeout)
+        return
+    args += ["-i", audio_src, "-map", "0:v", "-map", "1:a:0", "-c:v", "copy"]
+    try:
+        _run(args + ["-c:a", "copy", "-shortest", "-movflags", "+faststart", dst], timeout=timeout)
+    except UpscaleTimeout:
+        raise
+    except UpscaleError:
+        # Кодек звука не ложится в mp4 (vorbis и т.п.) — перекодируем только звук
+        _run(args + ["-c:a", "aac", "-b:a", "160k", "-shortest", "-movflags", "+faststart", dst],
+             timeout=timeout)
+
+
+class UpscalePipeline:
+    """Пул процессов для масштабирования сегментов, общий для всех видео"""
+
+    def __init__(self, workers: int = None, segment_seconds: float = 10.0, factor: float = 2.0,
+                 max_side: int = 1920, crf: int = 20, preset: str = "veryfast",
+                 timeout_ratio: float = 30.0, min_timeout: float = 60.0):
+        self.workers = workers or os.cpu_count() or 1
+        self.segment_seconds = segment_seconds
+        self.factor = factor
+        self.max_side = max_side
+        self.crf = crf
+        self.preset = preset
+        # Предел на вызов ffmpeg: min_timeout плюс timeout_ratio секунд на секунду масштабируемого видео;
+        # нарезка и склейка без перекодирования получают секунду на секунду видео
+        self.timeout_ratio = timeout_ratio
+        self.min_timeout = min_timeout
+        self._pool = None
+        self.stats = {"jobs": 0, "failed": 0, "segments": 0, "seconds": 0.0}
+
+    @property
+    def signature(self) -> str:
+        """Параметры, от которых зависит результат (часть ключа кэша результатов)"""
+        return f"x{self.factor:g}-{self.max_side}-crf{self.crf}-{self.preset}"
+
+    @property
+    def available(self) -> bool:
+        return FFMPEG is not None and FFPROBE is not None
+
+    def _time_limit(self, seconds: float, ratio: float) -> float:
+        return self.min_timeout + seconds * ratio
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    async def run(self, src: str, dst: str, progress=None):
+        """
+        Апскейл src в dst (mp4). progress(done, total) вызывается после каждого сегмента.
+        Возвращает итоговый (ширина, высота) или None, если видео уже максимального размера.
+        """
+        started = time.perf_counter()
+        try:
+            with UPSCALE_LATENCY.time(stage="probe"):
+                info = await asyncio.to_thread(probe, src)
+            size = target_size(info["width"], info["height"], self.factor, self.max_side)
+            if size is None:
+                return None
+
+            workdir = os.path.join(os.path.dirname(dst), "segments")
+            os.makedirs(workdir, exist_ok=True)
+            copy_limit = self._time_limit(info["duration"], 1.0)
+            with UPSCALE_LATENCY.time(stage="split"):
+                segments = await asyncio.to_thread(split, src, workdir, self.segment_seconds, copy_limit)
+
+            with UPSCALE_LATENCY.time(stage="scale"):
+                outputs = await self._scale(segments, size, progress)
+
+            with UPSCALE_LATENCY.time(stage="concat"):
+                await asyncio.to_thread(concat, outputs, src, dst, info["audio"], copy_limit)
+        except Exception:
+            self.stats["failed"] += 1
+            raise
+
+        elapsed = time.perf_counter() - started
+        UPSCALE_LATENCY.observe(elapsed, stage="total")
+        self.stats["jobs"] += 1
+        self.stats["segments"] += len(segments)
+        self.stats["seconds"] += elapsed
+        logger.info(f"Апскейл {info['width']}x{info['height']} -> {size[0]}x{size[1]}: "
+                    f"{len(segments)} сегм. за {elapsed:.1f} с")
+        return size
+
+    async def _scale(self, segments: list[tuple[str, float]], size: tuple, progress) -> list[str]:
+        loop = asyncio.get_running_loop()
+        pool = self._executor()
+        futures = [
+            loop.run_in_executor(
+                pool, upscale_segment, path, path[:-4] + ".mp4", size[0], size[1], self.crf, self.preset,
+                self._time_limit(seconds, self.timeout_ratio),
+            )
+            for path, seconds in segments
+        ]
+        try:
+            done = 0
+            for future in asyncio.as_completed(futures):
+                await future
+                done += 1
+                if progress is not None:
+                    await progress(done, len(futures))
+        except BaseException:
+            # Ещё не начатые сегменты не занимают пул; запущенные ffmpeg доработают сами
+            for future in futures:
+                future.cancel()
+            raise
+        return [path[:-4] + ".mp4" for path, _ in segments]
+
+    def snapshot(self) -> dict:
+        jobs = self.stats["jobs"]
+        return {**self.stats, "workers": self.workers,
+                "avg_seconds": self.stats["seconds"] / jobs if jobs else 0.0}
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,176 @@
+"""
+Режим вебхука для bot.py: aiohttp-приложение, которое сразу подтверждает апдейты
+и обрабатывает каждый в фоновой задаче, отбрасывая повторные доставки.
+Параллелизм и приоритеты — забота AdmissionController в диспетчере: своей FIFO-очереди
+здесь нет, иначе /start и колбэки ждали бы в ней за видео, не доходя до контроля нагрузки.
+При нескольких репликах окно дедупликации общее — таблица webhook_updates (создаётся в init_db).
+"""
+import asyncio
+import hmac
+import logging
+import time
+from collections import OrderedDict
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from db import Database
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class UpdateDeduplicator:
+    """
+    Окно последних update_id: повторная доставка того же апдейта отбрасывается.
+    С db окно общее для всех реплик (повтор часто приходит на другой экземпляр),
+    а память процесса — только быстрый путь для повторов, пришедших сюда же.
+    """
+
+    def __init__(self, db: Database = None, maxsize: int = 50_000, ttl: float = 600.0,
+                 purge_interval: float = 60.0):
+        self.db = db
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._seen = OrderedDict()
+        self._next_purge = 0.0
+
+    async def seen(self, update_id: int) -> bool:
+        """True, если апдейт уже был; иначе запоминает его"""
+        now = time.monotonic()
+        while self._seen:
+            oldest_id, ts = next(iter(self._seen.items()))
+            if now - ts <= self.ttl and len(self._seen) < self.maxsize:
+                break
+            self._seen.pop(oldest_id)
+        if update_id in self._seen:
+            return True
+        self._seen[update_id] = now
+        if self.db is None:
+            return False
+
+        if now >= self._next_purge:
+            self._next_purge = now + self.purge_interval
+            await self._purge()
+        try:
+            row = await self.db.fetchone("""
+                INSERT INTO webhook_updates (update_id) VALUES (%s)
+                ON CONFLICT (update_id) DO NOTHING
+                RETURNING update_id
+            """, (update_id,), name="webhook_dedup")
+        except Exception as e:
+            # Без БД лучше обработать повтор, чем потерять апдейт
+            logger.warning(f"Дедупликация апдейта {update_id} только в памяти: {e}")
+            return False
+        return row is None
+
+    async def _purge(self):
+        try:
+            await self.db.execute(
+                "DELETE FROM webhook_updates WHERE received < now() - %s * interval '1 second'",
+                (self.ttl,), name="webhook_dedup_purge"
+            )
+        except Exception as e:
+            logger.warning(f"Очистка webhook_updates: {e}")
+
+    async def forget(self, update_id: int):
+        """Убрать апдейт из окна (например, если его не удалось принять)"""
+        self._seen.pop(update_id, None)
+        if self.db is None:
+            return
+        try:
+            await self.db.execute(
+                "DELETE FROM webhook_updates WHERE update_id = %s", (update_id,), name="webhook_dedup_forget"
+            )
+        except Exception as e:
+            logger.warning(f"Апдейт {update_id} останется в окне дедупликации: {e}")
+
+
+class WebhookServer:
+    """Приём апдейтов по HTTP; max_inflight ограничивает только число принятых, но не обработанных апдейтов"""
+
+    def __init__(self, dp: Dispatcher, bot: Bot, secret_token: str, path: str = "/webhook",
+                 max_inflight: int = 10_000, dedup: UpdateDeduplicator = None):
+        self.dp = dp
+        self.bot = bot
+        if not secret_token:
+            raise ValueError("вебхук без secret_token принимает апдейты от кого угодно")
+        self.path = path
+        self.secret_token = secret_token
+        self.max_inflight = max_inflight
+        self.dedup = dedup or UpdateDeduplicator()
+        self._tasks = set()
+        self._runner = None
+        self.stats = {"received": 0, "duplicates": 0, "rejected": 0, "processed": 0, "errors": 0}
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._tasks)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(
+            request.headers.get(SECRET_HEADER, ""), self.secret_token
+        ):
+            return web.Response(status=401)
+
+        try:
+            data = await request.json()
+            update_id = data["update_id"]
+        except Exception:
+            return web.Response(status=400)
+
+        self.stats["received"] += 1
+        if await self.dedup.seen(update_id):
+            self.stats["duplicates"] += 1
+            return web.Response()
+
+        if len(self._tasks) >= self.max_inflight:
+            # Telegram доставит апдейт повторно — забываем его, чтобы не принять за дубль
+            await self.dedup.forget(update_id)
+            self.stats["rejected"] += 1
+            return web.Response(status=503)
+        task = asyncio.create_task(self._process(data))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({"ok": True, "queue": self.queue_depth, **self.stats})
+
+    async def _process(self, data: dict):
+        try:
+            update = Update.model_validate(data, context={"bot": self.bot})
+            await self.dp.feed_update(self.bot, update)
+            self.stats["processed"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.exception(f"Ошибка обработки апдейта {data.get('update_id')}: {e}")
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        app.router.add_get("/healthz", self.health)
+        return app
+
+    async def start(self, host: str, port: int, app: web.Application = None):
+        """Запуск HTTP-сервера"""
+        self._runner = web.AppRunner(app or self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Вебхук слушает {host}:{port}{self.path}")
+
+    async def stop(self, drain_timeout: float = 10.0):
+        """Остановка: перестаём принимать, дорабатываем принятые апдейты, остальные отменяем"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        if self._tasks:
+            _, pending = await asyncio.wait(set(self._tasks), timeout=drain_timeout)
+            if pending:
+                logger.warning(f"Не дождались обработки {len(pending)} апдейтов")
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
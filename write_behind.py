@@ -0,0 +1,102 @@
+"""
+Буфер отложенной записи: объединяет повторные записи по ключу в памяти
+и сбрасывает их пакетом по размеру или по таймеру.
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """Ограниченный буфер с объединением записей по ключу и пакетным сбросом"""
+
+    def __init__(self, flush, name: str, batch_size: int = 500,
+                 flush_interval: float = 1.0, max_pending: int = 10000):
+        self._flush = flush
+        self.name = name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self._items = {}
+        self._space = asyncio.Condition()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._closing = False
+
+        self.stats = {"queued": 0, "merged": 0, "flushed": 0, "flushes": 0, "errors": 0, "waits": 0}
+
+    def __len__(self):
+        return len(self._items)
+
+    def start(self):
+        """Запуск фонового сброса"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name=f"write-behind-{self.name}")
+
+    async def stop(self):
+        """Остановка с финальным сбросом всего, что накопилось"""
+        self._closing = True
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        while self._items:
+            if not await self.flush():
+                logger.error(f"[{self.name}] Не удалось сбросить {len(self._items)} записей при остановке")
+                break
+
+    async def put(self, key, value):
+        """Поставить запись в очередь. Ждёт, если буфер заполнен."""
+        if key in self._items:
+            self._items[key] = value
+            self.stats["merged"] += 1
+            return
+
+        if len(self._items) >= self.max_pending:
+            self.stats["waits"] += 1
+            self._wakeup.set()
+            async with self._space:
+                await self._space.wait_for(lambda: key in self._items or len(self._items) < self.max_pending)
+
+        if key in self._items:
+            self.stats["merged"] += 1
+        else:
+            self.stats["queued"] += 1
+        self._items[key] = value
+        if len(self._items) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self) -> bool:
+        """Сбросить накопленные записи. Возвращает False при ошибке записи."""
+        async with self._flush_lock:
+            if not self._items:
+                return True
+            batch, self._items = self._items, {}
+            try:
+                await self._flush(list(batch.values()))
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"[{self.name}] Ошибка пакетной записи ({len(batch)} шт.): {e}")
+                # Возвращаем неудачный пакет, не затирая более свежие значения
+                for key, value in batch.items():
+                    self._items.setdefault(key, value)
+                return False
+            else:
+                self.stats["flushed"] += len(batch)
+                self.stats["flushes"] += 1
+                return True
+            finally:
+                async with self._space:
+                    self._space.notify_all()
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()